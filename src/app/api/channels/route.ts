@@ -0,0 +1,54 @@
+import { prisma } from "@/lib/prisma";
+import { NextRequest, NextResponse } from "next/server";
+
+interface Params {
+    orderBy?: string,
+    desc?: string
+}
+
+const getColumnName = function (str: string): string {
+    switch (str) {
+        case 'Videos':
+            return 'videoCount';
+        case 'Comments':
+            return 'commentCount';
+        case 'Replies':
+            return 'replyCount';
+        case 'Crawled':
+            return 'crawledAt';
+        default:
+            return 'videoCount';
+    }
+}
+
+export async function GET(req: NextRequest) {
+    const params: Params = {
+        orderBy: req.nextUrl.searchParams.get("orderBy") ?? undefined,
+        desc: req.nextUrl.searchParams.get("desc") ?? undefined
+    }
+
+    const sortingOrder = params.desc === 'false' ? 'asc' : 'desc';
+    const orderByName = getColumnName(params.orderBy ?? '');
+
+    try {
+        // Totals are rolled up by update-db at the end of every run
+        const channels = await prisma.channel.findMany({
+            orderBy: {
+                [orderByName]: sortingOrder,
+            },
+        });
+
+        if (channels.length > 0) {
+            return NextResponse.json(channels, { status: 200 });
+        } else {
+            return NextResponse.json("no channels found", { status: 404 });
+        }
+    }
+
+    catch (error) {
+        if (error instanceof Error) {
+            console.log(error);
+        }
+        return NextResponse.json({ error: "Internal Server Error" }, { status: 500 });
+    }
+}
@@ -12,14 +12,18 @@ export async function GET(req: NextRequest) {
         userId: req.nextUrl.searchParams.get("userId") ?? undefined
     }
 
-    let where = {};
     if (params.videoId !== undefined) {
-        where = { videoId: params.videoId };
+        const resp = await prisma.comment.count({ where: { videoId: params.videoId } });
+        return NextResponse.json(resp, { status: 200 });
     }
-    else if (params.userId !== undefined) {
-        where = { userId: params.userId };
+    if (params.userId !== undefined) {
+        // Maintained by update-db, no need to count the comment table
+        const stats = await prisma.user_stats.findUnique({ where: { userId: params.userId } });
+        return NextResponse.json(stats?.commentCount ?? 0, { status: 200 });
     }
 
-    const resp = await prisma.comment.count({where: where});
-    return NextResponse.json(resp, { status: 200 });
+    // The comment view joins users, so counting it reads every row. The
+    // per-video counts are rolled up by update-db and their sum is exact.
+    const totals = await prisma.video.aggregate({ _sum: { commentCount: true } });
+    return NextResponse.json(totals._sum.commentCount ?? 0, { status: 200 });
 }
\ No newline at end of file
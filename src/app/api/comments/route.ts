@@ -57,6 +57,22 @@ export async function GET(req: NextRequest) {
   }
 
   try {
+    // Substring search through the comment_fts trigram index maintained by update-db.
+    // Terms shorter than a trigram are left to the LIKE scan below.
+    if (params.search !== undefined && params.search.length >= 3) {
+      const phrase = '"' + params.search.replace(/"/g, '""') + '"';
+      const matches = await prisma.$queryRawUnsafe<{ id: string }[]>(
+        `SELECT c.id FROM comment_fts f JOIN comment c ON c.rowid = f.rowid
+         WHERE comment_fts MATCH ? AND (? IS NULL OR c.videoId = ?) AND (? IS NULL OR c.userId = ?)
+         ORDER BY c.${orderByName} ${sortingOrder} LIMIT ? OFFSET ?`,
+        phrase, params.videoId ?? null, params.videoId ?? null,
+        params.userId ?? null, params.userId ?? null,
+        params.limit ?? -1, params.start ?? 0
+      );
+      where = { id: { in: matches.map((match) => match.id) } };
+      params.start = undefined;
+    }
+
     const comments = await prisma.comment.findMany({
       take: params.limit,
       skip: params.start,
@@ -2,6 +2,7 @@ import { prisma } from "@/lib/prisma";
 import { NextResponse } from "next/server";
 
 export async function GET() {
-    const resp = await prisma.reply.count();
-    return NextResponse.json(resp, { status: 200 });
+    // Rolled up per video by update-db, cheaper than counting the reply view
+    const totals = await prisma.video.aggregate({ _sum: { replyCount: true } });
+    return NextResponse.json(totals._sum.replyCount ?? 0, { status: 200 });
 }
\ No newline at end of file
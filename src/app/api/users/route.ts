@@ -0,0 +1,61 @@
+import { prisma } from "@/lib/prisma";
+import { NextRequest, NextResponse } from "next/server";
+
+interface Params {
+    search?: string,
+    orderBy?: string,
+    desc?: string,
+    start?: number,
+    limit?: number
+}
+
+const getColumnName = function (str: string): string {
+    switch (str) {
+        case 'Comments':
+            return 'commentCount';
+        case 'Replies':
+            return 'replyCount';
+        case 'Last seen':
+            return 'lastSeen';
+        default:
+            return 'commentCount';
+    }
+}
+
+export async function GET(req: NextRequest) {
+    const params: Params = {
+        search: req.nextUrl.searchParams.get("search") ?? undefined,
+        orderBy: req.nextUrl.searchParams.get("orderBy") ?? undefined,
+        desc: req.nextUrl.searchParams.get("desc") ?? undefined,
+        start: req.nextUrl.searchParams.get("start") ? parseInt(req.nextUrl.searchParams.get("start")!) : undefined,
+        limit: req.nextUrl.searchParams.get("limit") ? parseInt(req.nextUrl.searchParams.get("limit")!) : undefined
+    }
+
+    const sortingOrder = params.desc === 'false' ? 'asc' : 'desc';
+    const orderByName = getColumnName(params.orderBy ?? '');
+
+    try {
+        // Served from the user_stats rollup maintained by update-db
+        const users = await prisma.user_stats.findMany({
+            take: params.limit,
+            skip: params.start,
+            where: { username: { contains: params.search } },
+            orderBy: {
+                [orderByName]: sortingOrder,
+            },
+        });
+
+        if (users.length > 0) {
+            return NextResponse.json(users, { status: 200 });
+        } else {
+            return NextResponse.json("no users found", { status: 404 });
+        }
+    }
+
+    catch (error) {
+        if (error instanceof Error) {
+            console.log(error);
+        }
+        return NextResponse.json({ error: "Internal Server Error" }, { status: 500 });
+    }
+}
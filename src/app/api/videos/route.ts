@@ -3,6 +3,7 @@ import { NextRequest, NextResponse } from "next/server";
 
 interface Params {
     videoId?: string,
+    channelId?: string,
     start?: number,
     limit?: number
     search?: string,
@@ -20,6 +21,10 @@ const getTableName = function (str: string): string {
             return 'angerCount';
         case 'Comments':
             return 'commentCount';
+        case 'Replies':
+            return 'replyCount';
+        case 'Activity':
+            return 'lastActivityAt';
         case 'Runtime':
             return 'duration';
         case 'Views':
@@ -32,6 +37,7 @@ const getTableName = function (str: string): string {
 export async function GET(req: NextRequest) {
     const params: Params = {
         videoId: req.nextUrl.searchParams.get("videoId") ?? undefined,
+        channelId: req.nextUrl.searchParams.get("channelId") ?? undefined,
         start: req.nextUrl.searchParams.get("start") ? parseInt(req.nextUrl.searchParams.get("start")!) : undefined,
         limit: req.nextUrl.searchParams.get("limit") ? parseInt(req.nextUrl.searchParams.get("limit")!) : undefined,
         search: req.nextUrl.searchParams.get("search") ?? undefined,
@@ -41,6 +47,10 @@ export async function GET(req: NextRequest) {
 
     const sortingOrder = params.desc === 'false' ? 'asc' : 'desc';
     const orderByName = typeof params.orderBy === 'string' ? getTableName(params.orderBy) : 'createdAt';
+    // Videos listed by the channel, including the ones it shares with other channels
+    const channelFilter = params.channelId !== undefined
+        ? { channels: { some: { channelId: params.channelId } } }
+        : {};
 
     if (params.search !== undefined) {
         if (params.orderBy !== undefined) {
@@ -48,7 +58,8 @@ export async function GET(req: NextRequest) {
                 where: {
                     title: {
                         contains: params.search,
-                    }
+                    },
+                    ...channelFilter,
                 },
                 take: params.limit,
                 skip: params.start,
@@ -63,6 +74,7 @@ export async function GET(req: NextRequest) {
     try {
         if (params.orderBy !== undefined) {
             const videos = await prisma.video.findMany({
+                where: channelFilter,
                 take: params.limit,
                 skip: params.start,
                 orderBy: {
@@ -7,7 +7,9 @@ export interface Video {
     angerCount: number,
     duration?: number,
     createdAt: string,
-    commentCount: number
+    commentCount: number,
+    replyCount?: number,
+    lastActivityAt?: string
 }
 
 export interface SearchProps {
@@ -0,0 +1,297 @@
+"""
+Benchmark of the crawl phases of main.py against a synthetic local server.
+
+Starts bench/fake_server.py with the requested channel size, latency and rate
+of poisoned records, then runs every phase of main.py in its own process
+against it, on a scratch database, and reports per phase:
+
+- wall time of the phase,
+- requests and requests per second,
+- rows written (video, comment and reply) and rows per second,
+- peak RSS of the process.
+
+Results are compared with the stored baseline of the same scenario, and a
+phase that got slower or bigger than --tolerance is reported as a regression.
+
+Usage:
+    python bench/benchmark.py --videos 30 --comments 500 --replies 3
+    python bench/benchmark.py --save-baseline
+    python bench/benchmark.py --set REPLY_BATCH_SIZE=1 --set LIMIT=200
+    python bench/benchmark.py --channels 4 --shared 0.1
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+UPDATE_DB_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "results", "baseline.json")
+
+# Phases of main.py, in the order they are run
+PHASES = ("videos", "comments", "comment_dlq", "replies", "reply_dlq")
+
+# Tables whose row counts are reported
+TABLES = ("video", "comment", "reply")
+
+
+def _row_counts(cur):
+    """Number of rows per table
+
+    :param cur: SQLite cursor obj
+    """
+    counts = {}
+    for table in TABLES:
+        cur.execute(f"SELECT COUNT(*) FROM {table}")
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+
+def run_phase(phase, overrides):
+    """Run a single phase of main.py in this process and print its result
+
+    :param phase: Name of the phase
+    :param overrides: Dict of config.py settings to override
+    """
+    sys.path.insert(0, UPDATE_DB_DIR)
+    import config as conf  # pylint: disable=import-outside-toplevel
+    for key, value in overrides.items():
+        setattr(conf, key, value)
+    # pylint: disable=import-outside-toplevel
+    import main
+    from helpers.checkpoint import Checkpoint
+    from helpers.publish import Publisher
+    from helpers.transport import Transport
+
+    conf.setup_logger()
+    publisher = Publisher()
+    con, cur = main.open_database(publisher, False)
+    reader = publisher.open_reader()
+    transport = Transport()
+    checkpoint = Checkpoint.start(con, "full")
+    checkpoint.enter(phase)
+    totals = {"requests": 0, "recovered": 0, "poisoned": 0}
+    before = _row_counts(cur)
+
+    start = time.perf_counter()
+    if phase == "videos":
+        main.fetch_videos(cur, transport, checkpoint)
+    elif phase == "comments":
+        main.fetch_comments(cur, transport, checkpoint, reader, {}, True)
+    elif phase == "comment_dlq":
+        main.resolve_comment_errors(cur, transport, checkpoint, totals)
+    elif phase == "replies":
+        main.fetch_replies(con, cur, transport, checkpoint, reader)
+    elif phase == "reply_dlq":
+        main.resolve_reply_errors(cur, transport, checkpoint, totals)
+    checkpoint.leave()
+    wall = time.perf_counter() - start
+
+    after = _row_counts(cur)
+    checkpoint.finish()
+    publisher.close_reader(reader)
+    publisher.publish(con)
+    transport.close()
+    print(json.dumps({
+        "phase": phase,
+        "wall": wall,
+        "requests": sum(stats.requests for stats in transport.stats.values()),
+        "rows": sum(after[table] - before[table] for table in TABLES),
+        # ru_maxrss is reported in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(port, timeout=60):
+    """Wait until the fake server accepts connections
+
+    :param port: Port of the server
+    :param timeout: Seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Fake server did not start on port {port}")
+
+
+def scenario_key(args):
+    """Name of the scenario a result belongs to
+
+    :param args: Parsed command line arguments
+    """
+    key = (f"v{args.videos}-c{args.comments}-r{args.replies}"
+           f"-l{args.latency:g}-p{args.poison_rate:g}")
+    if args.channels > 1:
+        key += f"-ch{args.channels}-s{args.shared:g}"
+    if args.set:
+        key += "-" + "-".join(sorted(args.set))
+    return key
+
+
+def _parse_overrides(pairs):
+    """Dict of config overrides from KEY=VALUE pairs, values are JSON or strings
+
+    :param pairs: List of KEY=VALUE strings
+    """
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def run_benchmark(args):
+    """Run every phase against a fresh fake server and database
+
+    Returns a list of per phase results.
+
+    :param args: Parsed command line arguments
+    """
+    port = _free_port()
+    server = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_server.py"),
+        "--port", str(port), "--videos", str(args.videos),
+        "--comments", str(args.comments), "--replies", str(args.replies),
+        "--latency", str(args.latency), "--poison-rate", str(args.poison_rate),
+        "--channels", str(args.channels), "--shared", str(args.shared),
+    ], stdout=subprocess.PIPE, text=True)
+    results = []
+    try:
+        print(server.stdout.readline().strip())
+        _wait_for(port)
+        with tempfile.TemporaryDirectory() as workdir:
+            overrides = {
+                "HOST": f"http://127.0.0.1:{port}/graphql",
+                "MAIN_DB_PATH": os.path.join(workdir, "store.db"),
+                "TEMP_DB_PATH": os.path.join(workdir, "temp.db"),
+                "LOG_DIR": os.path.join(workdir, "logs"),
+                "CACHE_DIR": os.path.join(workdir, "cache"),
+                "REPLY_ERROR_PATH": os.path.join(workdir, "errors", "reply-errors"),
+                "COMMENT_ERROR_PATH": os.path.join(workdir, "errors", "comment-errors"),
+                "PUBLISH_MODE": "wal",
+                "CACHE_MODE": None,
+                # Measure the crawler, not the politeness limit
+                "RATE_LIMIT": 0,
+            }
+            if args.channels > 1:
+                overrides["CHANNEL_IDS"] = [f"ch{k}" for k in range(args.channels)]
+            overrides.update(_parse_overrides(args.set))
+            for phase in PHASES:
+                proc = subprocess.run(
+                    [sys.executable, __file__, "--phase", phase,
+                     "--overrides", json.dumps(overrides)],
+                    cwd=UPDATE_DB_DIR, capture_output=True, text=True, check=False)
+                if proc.returncode != 0:
+                    sys.exit(f"Phase {phase} failed:\n{proc.stderr}")
+                results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print the results as a Markdown table, returns the list of regressions
+
+    :param results: List of per phase results
+    :param baseline: Dict of phase to baseline result, may be empty
+    :param tolerance: Allowed relative slowdown or growth, e.g. 0.2
+    """
+    print("| Phase | Wall (s) | Requests | Req/s | Rows | Rows/s | Peak RSS (MB) | vs baseline |")
+    print("|---|---|---|---|---|---|---|---|")
+    regressions = []
+    for result in results:
+        wall = max(result["wall"], 1e-9)
+        compare = ""
+        base = baseline.get(result["phase"])
+        if base:
+            change = result["wall"] / max(base["wall"], 1e-9) - 1
+            compare = f"{change:+.0%} wall"
+            # Phases that take a few ms are too noisy to compare
+            if change > tolerance and result["wall"] > 0.05:
+                regressions.append(f"{result['phase']}: wall time {change:+.0%}")
+            growth = result["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9) - 1
+            if growth > tolerance:
+                regressions.append(f"{result['phase']}: peak RSS {growth:+.0%}")
+        print(f"| {result['phase']} | {result['wall']:.2f} | {result['requests']} "
+              f"| {result['requests'] / wall:.0f} | {result['rows']} "
+              f"| {result['rows'] / wall:.0f} | {result['peak_rss_mb']:.0f} | {compare} |")
+    return regressions
+
+
+def parse_args():
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the update-db phases")
+    parser.add_argument("--videos", type=int, default=30)
+    parser.add_argument("--comments", type=int, default=500,
+                        help="comments per video")
+    parser.add_argument("--replies", type=int, default=3,
+                        help="average replies per comment")
+    parser.add_argument("--latency", type=float, default=5,
+                        help="latency per request in ms")
+    parser.add_argument("--poison-rate", type=float, default=0.0005,
+                        help="fraction of comments and replies that fail their page")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="spread the videos over this many channels")
+    parser.add_argument("--shared", type=float, default=0,
+                        help="fraction of the videos listed by two channels")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config.py setting, may be repeated")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown or RSS growth against the baseline")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the baseline of the scenario")
+    parser.add_argument("--phase", help=argparse.SUPPRESS)
+    parser.add_argument("--overrides", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmark and compare it with the baseline"""
+    args = parse_args()
+    if args.phase:
+        run_phase(args.phase, json.loads(args.overrides))
+        return
+
+    key = scenario_key(args)
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding="UTF-8") as file:
+            baselines = json.load(file)
+    baseline = {result["phase"]: result for result in baselines.get(key, [])}
+
+    results = run_benchmark(args)
+    print(f"\nScenario {key}" + ("" if baseline else " (no baseline)"))
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baselines[key] = results
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w", encoding="UTF-8") as file:
+            json.dump(baselines, file, indent=2)
+        print(f"\nSaved baseline to {BASELINE_PATH}")
+    elif regressions:
+        print("\nRegressions:\n" + "\n".join(f"- {line}" for line in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
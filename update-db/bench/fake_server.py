@@ -0,0 +1,343 @@
+"""
+Local stand-in for the api.banned.video GraphQL endpoint.
+
+Serves a synthetic channel for the operations built by
+helpers/get_request_bodies, with injectable latency, errors, rate limits and
+poisoned records, so the crawler can be run, tuned and benchmarked without
+the real site. A page that contains a poisoned record is answered with a
+GraphQL error, like the real API does.
+
+Usage: python bench/fake_server.py --port 8765 --latency 20 --error-rate 0.01
+Then point conf.HOST at http://127.0.0.1:8765/graphql
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Aliased fields of a GetCommentRepliesBatch query
+_BATCH_FIELD = re.compile(r"(r\d+): getCommentReplies\(id: \$(id\d+)")
+# Aliased head and tail fields of a GetCommentReplyProbe query
+_PROBE_FIELD = re.compile(r"([ht]\d+): getCommentReplies\(id: \$(id\d+), "
+                          r"limit: \$limit, offset: \$(\w+)\)")
+
+
+def _user(n):
+    """Synthetic user
+
+    :param n: Number of the user
+    """
+    return {"_id": f"u{n % 97}", "username": f"user{n % 97}", "__typename": "User"}
+
+
+class Channel:
+    """
+    Deterministic synthetic channel of videos, comments and replies.
+    """
+
+    def __init__(self, videos, comments, replies, poison_rate=0.0, seed=0,
+                 channels=1, shared=0.0):
+        rng = random.Random(seed)
+        self.videos = []
+        self.listings = {}
+        self.comments = {}
+        self.replies = {}
+        self.poisoned = set()
+        for v in range(videos):
+            video_id = f"v{v}"
+            self.videos.append({
+                "_id": video_id, "title": f"Video {v}", "summary": "synthetic",
+                "playCount": rng.randint(0, 10**6), "likeCount": rng.randint(0, 10**4),
+                "angerCount": rng.randint(0, 100), "videoDuration": float(rng.randint(60, 7200)),
+                "createdAt": f"2024-01-{1 + v % 28:02d}T00:00:00.000Z",
+            })
+            video_comments = []
+            for c in range(comments):
+                comment_id = f"{video_id}c{c}"
+                reply_count = rng.randint(0, 2 * replies)
+                video_comments.append({
+                    "_id": comment_id, "content": f"comment {c}", "liked": False,
+                    "user": _user(c), "voteCount": {"positive": rng.randint(0, 50)},
+                    "linkedUser": None, "replyCount": reply_count,
+                    "createdAt": f"2024-02-{1 + c % 28:02d}T00:00:{c % 60:02d}.000Z",
+                })
+                self.replies[comment_id] = [{
+                    "_id": f"{comment_id}r{r}", "content": f"reply {r}", "liked": False,
+                    "user": _user(r), "voteCount": {"positive": r},
+                    "linkedUser": _user(c), "replyTo": {"_id": comment_id},
+                    "createdAt": "2024-03-01T00:00:00.000Z",
+                } for r in range(reply_count)]
+                if rng.random() < poison_rate:
+                    self.poisoned.add(comment_id)
+                self.poisoned.update(reply["_id"] for reply in self.replies[comment_id]
+                                     if rng.random() < poison_rate)
+            self.comments[video_id] = video_comments
+        if channels > 1:
+            self._split(channels, shared, random.Random(seed + 1))
+
+    def _split(self, channels, shared, rng):
+        """Spread the videos over several channels, ch0 to ch<n-1>
+
+        Every video belongs to one channel, and a `shared` fraction of them is
+        also listed by the next channel.
+
+        :param channels: Number of channels
+        :param shared: Fraction of the videos listed by two channels
+        :param rng: Random generator
+        """
+        self.listings = {f"ch{k}": [] for k in range(channels)}
+        for v, video in enumerate(self.videos):
+            owner = f"ch{v % channels}"
+            video["channel"] = {"_id": owner, "title": f"Channel {v % channels}"}
+            self.listings[owner].append(video)
+            if rng.random() < shared:
+                self.listings[f"ch{(v + 1) % channels}"].append(video)
+
+    def channel_videos(self, channel_id):
+        """Videos listed by a channel, every video without --channels
+
+        :param channel_id: Id of the channel
+        """
+        if not self.listings:
+            return self.videos
+        return self.listings.get(channel_id, [])
+
+    def rows(self):
+        """Total number of (videos, comments, replies)"""
+        return (len(self.videos),
+                sum(len(c) for c in self.comments.values()),
+                sum(len(r) for r in self.replies.values()))
+
+
+class Faults:
+    """
+    Injected latency, errors and rate limits.
+    """
+
+    def __init__(self, latency, jitter, error_rate, rate_limit, capacity, seed=0):
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.capacity = capacity
+        self.in_flight = 0
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Admit a request, returns an HTTP status to fail it with or None"""
+        with self._lock:
+            self.in_flight += 1
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            if self.rate_limit and self.window_count > self.rate_limit:
+                return 429
+            if self._rng.random() < self.error_rate:
+                return 503
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            # Past its capacity the server slows down with every extra request
+            if self.capacity and self.in_flight > self.capacity:
+                delay *= self.in_flight / self.capacity
+        time.sleep(delay)
+        return None
+
+    def leave(self):
+        """Mark a request as answered"""
+        with self._lock:
+            self.in_flight -= 1
+
+
+def _page(channel, items, offset, limit):
+    """Slice of a list, or None if it contains a poisoned record
+
+    :param channel: Synthetic channel
+    :param items: Full list of videos, comments or replies
+    :param offset: Offset of the page
+    :param limit: Size of the page
+    """
+    page = items[offset:offset + limit]
+    if any(item["_id"] in channel.poisoned for item in page):
+        return None
+    return page
+
+
+def _reply_page(channel, replies, offset, limit):
+    """Page of replies that also report the replyCount of their comment
+
+    :param channel: Synthetic channel
+    :param replies: Full list of replies of a comment
+    :param offset: Offset of the page
+    :param limit: Size of the page
+    """
+    page = _page(channel, replies, offset, limit)
+    if page is None:
+        return None
+    return [dict(reply, replyTo=dict(reply["replyTo"], replyCount=len(replies)))
+            for reply in page]
+
+
+def _field(channel, key, items, offset, limit):
+    """Response of a single field query
+
+    :param channel: Synthetic channel
+    :param key: Name of the queried field
+    :param items: Full list of comments or replies
+    :param offset: Offset of the page
+    :param limit: Size of the page
+    """
+    page = _page(channel, items, offset, limit)
+    if page is None:
+        return {"errors": [{"message": "Internal server error"}], "data": None}
+    return {"data": {key: page}}
+
+
+def resolve(channel, body):
+    """GraphQL response of a request body
+
+    :param channel: Synthetic channel
+    :param body: Parsed GraphQL request body
+    """
+    operation = body.get("operationName")
+    variables = body.get("variables", {})
+    limit = int(variables.get("limit", 0))
+    offset = int(variables.get("offset", 0))
+
+    if operation == "GetChannelVideos":
+        return {"data": {"getChannel": {
+            "videos": channel.channel_videos(variables["id"])[offset:offset + limit]}}}
+    if operation == "GetVideoComments":
+        if variables["id"] not in channel.comments:
+            return {"errors": [{"message": f"INVALID_ID: {variables['id']}"}]}
+        return _field(channel, "getVideoComments",
+                      channel.comments[variables["id"]], offset, limit)
+    if operation == "GetCommentReplies":
+        if variables["id"] not in channel.replies:
+            return {"errors": [{"message": f"INVALID_ID: {variables['id']}"}]}
+        page = _reply_page(channel, channel.replies[variables["id"]], offset, limit)
+        if page is None:
+            return {"errors": [{"message": "Internal server error"}], "data": None}
+        return {"data": {"getCommentReplies": page}}
+    if operation in ("GetCommentRepliesBatch", "GetCommentReplyProbe"):
+        if operation == "GetCommentRepliesBatch":
+            fields = [(alias, var, offset) for alias, var
+                      in _BATCH_FIELD.findall(body["query"])]
+        else:
+            fields = [(alias, var, int(variables[offset_var])) for alias, var, offset_var
+                      in _PROBE_FIELD.findall(body["query"])]
+        response = {"data": {}}
+        for alias, var, field_offset in fields:
+            page = _reply_page(channel, channel.replies.get(variables[var], []),
+                               field_offset, limit)
+            response["data"][alias] = page
+            if page is None:
+                response.setdefault("errors", []).append(
+                    {"message": "Internal server error", "path": [alias]})
+        return response
+    return {"errors": [{"message": f"Unknown operation: {operation}"}]}
+
+
+def make_handler(channel, faults):
+    """Request handler class serving a channel
+
+    :param channel: Synthetic channel
+    :param faults: Injected faults
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Keep-alive GraphQL handler.
+        """
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """Answer a GraphQL request"""
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            try:
+                status = faults.enter()
+                if status is None:
+                    self._send(200, resolve(channel, body))
+                else:
+                    self._send(status, {"errors": [{"message": "injected"}]},
+                               retry_after=1 if status == 429 else None)
+            finally:
+                faults.leave()
+
+        def _send(self, status, payload, retry_after=None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if retry_after:
+                self.send_header("Retry-After", str(retry_after))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description="Fake GraphQL server for update-db")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--videos", type=int, default=30)
+    parser.add_argument("--comments", type=int, default=200,
+                        help="comments per video")
+    parser.add_argument("--replies", type=int, default=2,
+                        help="average replies per comment")
+    parser.add_argument("--poison-rate", type=float, default=0,
+                        help="fraction of comments and replies that fail their page")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="spread the videos over channels ch0 to ch<n-1>, "
+                             "1 serves every video for any channel id")
+    parser.add_argument("--shared", type=float, default=0,
+                        help="fraction of the videos also listed by a second channel")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="base latency per request in ms")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="extra random latency per request in ms")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of requests answered with HTTP 503")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="requests per second before answering HTTP 429, 0 disables")
+    parser.add_argument("--capacity", type=int, default=0,
+                        help="concurrent requests before latency grows, 0 disables")
+    return parser.parse_args(argv)
+
+
+def serve(args):
+    """Build the channel and serve it until interrupted
+
+    :param args: Parsed command line arguments
+    """
+    channel = Channel(args.videos, args.comments, args.replies,
+                      args.poison_rate, args.seed, args.channels, args.shared)
+    faults = Faults(args.latency, args.jitter, args.error_rate,
+                    args.rate_limit, args.capacity, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                 make_handler(channel, faults))
+    videos, comments, replies = channel.rows()
+    print(f"Serving {videos} videos, {comments} comments, {replies} replies "
+          f"({len(channel.poisoned)} poisoned) "
+          f"on http://127.0.0.1:{args.port}/graphql", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(parse_args())
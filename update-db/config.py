@@ -12,27 +12,98 @@ def get_path(rel):
 
 
 HOST = "https://api.banned.video/graphql"
-CHANNEL_ID = "5b885d33e6646a0015a6fa2d"
+# Channels archived into the same database, crawled concurrently
+CHANNEL_IDS = [
+    "5b885d33e6646a0015a6fa2d",
+]
+# Legacy DLQ directories, imported into the dlq table on startup
 REPLY_ERROR_PATH = get_path("errors/reply-errors")
 COMMENT_ERROR_PATH = get_path("errors/comment-errors")
 MAIN_DB_PATH = get_path("../prisma/store.db")
 TEMP_DB_PATH = get_path("temp.db")
+REPLAY_DB_PATH = get_path("replay.db")  # Scratch copy of store.db for --replay runs
 LOG_DIR = get_path("logs")
+CACHE_DIR = get_path("cache")
+
+# How a run writes to and publishes store.db
+# "wal": write in place in WAL mode as one transaction, committed when the run is done,
+# "backup": work on a copy in temp.db and copy it back, needed for --resume
+PUBLISH_MODE = "wal"
 
 # Number of items to fetch per request
 LIMIT = 500             # Number of items to fetch per request
+PROBE_LIMIT = 1         # Size of the first page of a video that may be unchanged
+
+# Concurrency settings
+COMMENT_CONCURRENCY = 8  # Number of videos fetching comments at the same time
+CHANNEL_CONCURRENCY = 4  # Number of channels listing their videos at the same time
+REPLY_BATCH_SIZE = 25    # Small reply threads packed into one request, 1 disables
+BATCH_MAX_FAILURES = 3   # Malformed batch responses in a row before batching is switched off
+
+# Reply pipeline settings
+PIPELINE_FETCH_WORKERS = 8     # Threads sending requests
+PIPELINE_VALIDATE_WORKERS = 2  # Threads parsing responses
+PIPELINE_QUEUE_SIZE = 64       # Max jobs per stage queue, also bounds the threads in flight
+WRITER_COMMIT_EVERY = 200      # Pages written between two commits of the writer
+
+# HTTP transport settings
+POOL_SIZE = 16          # Max pooled keep-alive connections to HOST
+CONNECT_TIMEOUT = 10    # Seconds to establish a connection
+READ_TIMEOUT = 30       # Default seconds to wait for a response
+PHASE_TIMEOUTS = {      # Read timeout per crawl phase
+    "videos": 30,
+    "comments": 30,
+    "comment_dlq": 30,
+    "replies": 30,
+    "reply_refresh": 30,
+    "reply_dlq": 30,
+}
+
+# Rate control settings (see helpers/ratecontrol.py)
+AIMD_INITIAL_WINDOW = 4     # Requests in flight at the start of a run
+AIMD_MIN_WINDOW = 1         # Lowest window after backing off
+AIMD_MAX_WINDOW = 16        # Highest window, keep <= POOL_SIZE
+AIMD_INCREASE = 1           # Window growth per window of successful requests
+AIMD_DECREASE = 0.5         # Window factor on 429/5xx, timeouts and latency spikes
+LATENCY_SPIKE_FACTOR = 4.0  # Latency over this multiple of the baseline counts as a spike
+LATENCY_SPIKE_MIN = 2.0     # Seconds a response must at least take to count as a spike
+RATE_LIMIT = 20             # Max requests per second, 0 disables the token bucket
+RATE_MIN = 1                # Lowest requests per second after HTTP 429
+RATE_INCREASE = 1           # Requests per second added per second without HTTP 429
+RATE_BURST = 10             # Requests that may be sent at once after an idle period
+MAX_RETRY_AFTER = 120       # Cap on the seconds honoured from a Retry-After header
+
+# Response store settings (see helpers/replay.py)
+CACHE_MODE = None            # None, "record" or "replay", also set with --record/--replay
+CACHE_MAX_BYTES = 2 * 10**9  # Compressed size before the oldest responses are evicted, 0 disables
+
+# Checkpoint settings
+CHECKPOINT_INTERVAL = 100  # Completed videos/comments between commits
+
+# Database settings
+VIEWER_INDEXES = True  # Keep the indexes of the viewer's queries, see dbutils.VIEWER_INDEXES
+VIEWER_QUERIES_PATH = get_path("viewer_queries.sql")  # Queries checked by the plan report
+
+# Snapshot settings (see helpers/snapshot.py)
+SNAPSHOT_DIR = get_path("snapshots")  # Snapshots and deltas for consumers, None disables
+SNAPSHOT_KEEP = 2                     # Full snapshots kept, older ones are deleted
+DELTA_KEEP = 60                       # Deltas kept, so consumers can catch up on missed runs
 
 # DLQ settings
 EXP_BACKOFF_LIMIT = 50  # Used as initial limit for the exp. backoff
+DLQ_WORKERS = 4         # DLQ entries recovered at the same time
+DLQ_MAX_ATTEMPTS = 5    # Attempts before an entry is exhausted, until its item fails again
+DLQ_RETRY_DELAY = 3600  # Seconds before a failed entry is retried, doubles per attempt
 
 LOG_LEVEL = logging.INFO
 # LOG_LEVEL = logging.WARNING
 
-os.makedirs(COMMENT_ERROR_PATH, exist_ok=True)
-os.makedirs(REPLY_ERROR_PATH, exist_ok=True)
-
 # Set up logging
 LOG_FILE = f"{LOG_DIR}/{datetime.now().strftime('%y-%m-%d-%H-%M')}.txt"
+REPORT_FILE = f"{LOG_DIR}/{datetime.now().strftime('%y-%m-%d-%H-%M')}.json"
+PLAN_REPORT_FILE = f"{LOG_DIR}/{datetime.now().strftime('%y-%m-%d-%H-%M')}-plans.md"
+# Prometheus textfile, e.g. in the node_exporter textfile collector directory
+PROMETHEUS_TEXTFILE = get_path("metrics/update_db.prom")
 
 def setup_logger():
     """Sets up the logger for the application"""
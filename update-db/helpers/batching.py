@@ -0,0 +1,139 @@
+"""
+Batched transport for small GetCommentReplies queries and reply probes.
+
+Most pending comments only have a handful of replies, so instead of one HTTP
+round trip per comment, many comments are packed into one aliased query
+(see get_request_bodies.get_batched_comment_replies_request_body). The result
+is split and validated per comment. The threads of a batch that fails are
+left to the single requests of the caller. If the server rejects batched
+queries, or BATCH_MAX_FAILURES responses in a row are malformed, batching is
+switched off for the rest of the run.
+"""
+import logging
+
+import requests
+from pydantic import ValidationError
+
+import config as conf
+from helpers import validator as pyd
+from helpers import get_request_bodies
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses that mean the server does not accept the batched query itself
+_REJECTED_STATUSES = (400, 404, 405, 413, 422)
+
+
+class ReplyBatcher:
+    """
+    Fetches the first page of replies for many comments in a single POST.
+    """
+
+    def __init__(self, transport, limit, phase="replies"):
+        self.transport = transport
+        self.limit = limit
+        self.phase = phase
+        self.supported = True
+        self.requests = 0
+        self.batched = 0
+        # Malformed responses in a row
+        self.failures = 0
+
+    def fetch(self, comment_ids):
+        """Fetch the first page of replies of every comment in the batch
+
+        Returns a dict of comment id to its list of replies, for every comment
+        whose field succeeded. Comments that are missing from the result have
+        to be fetched with single requests.
+
+        :param comment_ids: Ids of the comments in the batch
+        """
+        if not self.supported or not comment_ids:
+            return {}
+
+        body = get_request_bodies.get_batched_comment_replies_request_body(
+            comment_ids, self.limit, 0)
+        data = self._post(body, "GetCommentRepliesBatch", len(comment_ids))
+        if data is None:
+            return {}
+
+        results = {}
+        for n, comment_id in enumerate(comment_ids):
+            replies = data.get(f"r{n}")
+            if replies is not None:
+                results[comment_id] = replies
+        self.batched += len(results)
+        return results
+
+    def probe(self, threads):
+        """Probe the head and the tail page of every thread in the batch
+
+        Returns a dict of comment id to the replies of both pages, for every
+        thread whose fields both succeeded.
+
+        :param threads: List of (comment id, offset of the tail page)
+        """
+        if not self.supported or not threads:
+            return {}
+
+        body = get_request_bodies.get_reply_probe_request_body(threads, self.limit)
+        data = self._post(body, "GetCommentReplyProbe", len(threads))
+        if data is None:
+            return {}
+
+        results = {}
+        for n, (comment_id, _) in enumerate(threads):
+            head, tail = data.get(f"h{n}"), data.get(f"t{n}")
+            if head is None or tail is None:
+                continue
+            results[comment_id] = head + tail
+        self.batched += len(results)
+        return results
+
+    def _post(self, body, operation, size):
+        """Send a batched query and validate its response
+
+        Returns the data of the response, or None if the whole batch failed.
+
+        :param body: Request body of the batched query
+        :param operation: GraphQL operation name of the query
+        :param size: Number of threads in the batch
+        """
+        self.requests += 1
+        try:
+            resp = self.transport.post(body, self.phase)
+            validation = pyd.validate_response(operation, resp.content)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in _REJECTED_STATUSES:
+                self._disable(f"HTTP {e.response.status_code}")
+            return None
+        except requests.RequestException as e:
+            logger.warning("Batch of %d comments failed: %s", size, e)
+            return None
+        except ValidationError:
+            # A single bad response is not a rejection, its threads go single
+            self.failures += 1
+            logger.warning("Malformed response for a batch of %d comments (%d in a row)",
+                           size, self.failures)
+            if self.failures >= conf.BATCH_MAX_FAILURES:
+                self._disable(f"{self.failures} malformed batch responses")
+            return None
+        self.failures = 0
+
+        if validation.data is None:
+            # Errors without a path concern the whole query, not a single field
+            if not validation.errors or not any(err.path for err in validation.errors):
+                self._disable(validation.errors[0].message if validation.errors
+                              else "empty response")
+            return None
+        return validation.data
+
+    def _disable(self, reason):
+        """Switch batching off for the rest of the run
+
+        :param reason: Why the server rejected the batch
+        """
+        if self.supported:
+            logger.warning("Server rejected batched replies (%s), "
+                           "falling back to single requests", reason)
+        self.supported = False
@@ -0,0 +1,120 @@
+"""
+Crash-safe checkpoints for long crawl runs.
+
+Progress is recorded in the crawl_run and crawl_checkpoint tables of the
+database being crawled, and it is committed in the same transaction as the
+crawled rows. After a crash, a run can be resumed from the last commit.
+"""
+import logging
+
+import config as conf
+from helpers import dbutils
+from helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+# Crawl phases, in the order they are run
+PHASES = ("videos", "comments", "comment_dlq", "replies", "reply_refresh", "reply_dlq")
+
+
+class Checkpoint:
+    """
+    Tracks the phase and the per-item progress of a crawl run.
+    """
+
+    def __init__(self, con, run_id, mode, phase, interval=None):
+        self.con = con
+        self.cur = con.cursor()
+        self.run_id = run_id
+        self.mode = mode
+        self.phase = phase
+        self.interval = interval or conf.CHECKPOINT_INTERVAL
+        self._progress = {}
+        self._completed = 0
+
+    @classmethod
+    def start(cls, con, mode):
+        """Start a new run at the first phase
+
+        :param con: SQLite connection obj
+        :param mode: Crawl mode of the run (full or incremental)
+        """
+        run_id = dbutils.start_run(con.cursor(), mode, PHASES[0])
+        con.commit()
+        logger.info("Started crawl run %d (%s)", run_id, mode)
+        return cls(con, run_id, mode, PHASES[0])
+
+    @classmethod
+    def resume(cls, con):
+        """Continue the last unfinished run, or return None if there is none
+
+        :param con: SQLite connection obj
+        """
+        run = dbutils.get_unfinished_run(con.cursor())
+        if run is None:
+            return None
+        run_id, mode, phase = run
+        logger.info("Resuming crawl run %d (%s) in phase %s", run_id, mode, phase)
+        return cls(con, run_id, mode, phase)
+
+    def enter(self, phase):
+        """Enter a phase, returns False if the run has already completed it
+
+        :param phase: Name of the phase
+        """
+        if PHASES.index(phase) < PHASES.index(self.phase):
+            logger.info("Skipping completed phase %s", phase)
+            return False
+
+        self.phase = phase
+        metrics.start_phase(phase)
+        dbutils.set_run_phase(self.cur, self.run_id, phase)
+        self._progress = dbutils.get_checkpoints(self.cur, self.run_id, phase)
+        self._completed = 0
+        self.con.commit()
+        return True
+
+    def pending(self, item_id):
+        """Offset to continue an item from, or None if it is already done
+
+        :param item_id: Video or comment id
+        """
+        offset, done = self._progress.get(item_id, (0, False))
+        return None if done else offset
+
+    def advance(self, item_id, offset):
+        """Record the offset of the next page of an item
+
+        :param item_id: Video or comment id
+        :param offset: Offset of the next page to fetch
+        """
+        dbutils.save_checkpoint(self.cur, self.run_id, self.phase,
+                                item_id, offset, False)
+        self._progress[item_id] = (offset, False)
+
+    def complete(self, item_id):
+        """Mark an item as done, commits every `interval` completed items
+
+        :param item_id: Video or comment id
+        """
+        dbutils.save_checkpoint(self.cur, self.run_id, self.phase,
+                                item_id, 0, True)
+        self._progress[item_id] = (0, True)
+        self._completed += 1
+        if self._completed % self.interval == 0:
+            self.con.commit()
+            logger.info("Checkpoint: %d items done in phase %s",
+                        self._completed, self.phase)
+
+    def leave(self):
+        """Commit the current phase as completed and move on to the next one"""
+        metrics.end_phase()
+        index = PHASES.index(self.phase) + 1
+        self.phase = PHASES[index] if index < len(PHASES) else self.phase
+        dbutils.set_run_phase(self.cur, self.run_id, self.phase)
+        self.con.commit()
+
+    def finish(self):
+        """Mark the run as finished"""
+        dbutils.finish_run(self.cur, self.run_id)
+        self.con.commit()
@@ -1,13 +1,110 @@
 """
 Docstring for update-db.helpers.dbutils
 """
-from datetime import datetime, timezone
-import sqlite3
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+
+from helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+# Max number of bound parameters used in a single IN (...) lookup
+CHUNK_SIZE = 500
+
+# Tables whose changed rows go into the delta of the next snapshot, with their
+# primary key, in the order a delta is applied (see helpers/snapshot.py).
+# Replies come before comments: inserting a reply bumps storedReplies of its
+# comment, and the comment row of the delta then sets the final value.
+CHANGE_LOG_TABLES = (("channel", "id"), ("video", "id"), ("video_channel", "id"),
+                     ("user", "id"), ("reply_v2", "rid"), ("comment_v2", "rid"),
+                     ("modified", "id"))
+
+# Tables whose content column has a full-text index, see setup_search
+SEARCH_TABLES = ("comment", "reply")
+
+# Storage table behind each compatibility view (layout v2, see initialize_tables)
+STORAGE_TABLES = {"comment": "comment_v2", "reply": "reply_v2"}
+
+# Small tables keyed by text that are stored WITHOUT ROWID
+_CONTROL_TABLES = {
+    "video_rollup_pending": """
+    CREATE TABLE IF NOT EXISTS video_rollup_pending (
+        videoId TEXT PRIMARY KEY NOT NULL
+    ) WITHOUT ROWID
+    """,
+    "crawl_state": """
+    CREATE TABLE IF NOT EXISTS crawl_state (
+        videoId TEXT PRIMARY KEY NOT NULL, commentCount INTEGER, newestCommentId TEXT,
+        newestCommentAt TEXT, metaHash TEXT, crawledAt TEXT
+    ) WITHOUT ROWID
+    """,
+    "reply_state": """
+    CREATE TABLE IF NOT EXISTS reply_state (
+        commentId TEXT PRIMARY KEY NOT NULL, replyCount INTEGER, newestReplyId TEXT,
+        newestReplyAt TEXT, checkedAt TEXT
+    ) WITHOUT ROWID
+    """,
+    "crawl_checkpoint": """
+    CREATE TABLE IF NOT EXISTS crawl_checkpoint (
+        runId INTEGER NOT NULL, phase TEXT NOT NULL, itemId TEXT NOT NULL,
+        pendingOffset INTEGER DEFAULT 0, done INTEGER DEFAULT 0,
+        PRIMARY KEY (runId, phase, itemId),
+        FOREIGN KEY (runId) REFERENCES crawl_run(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    """,
+    "change_log": """
+    CREATE TABLE IF NOT EXISTS change_log (
+        tbl TEXT NOT NULL, rowKey NOT NULL, PRIMARY KEY (tbl, rowKey)
+    ) WITHOUT ROWID
+    """,
+    "dlq": """
+    CREATE TABLE IF NOT EXISTS dlq (
+        kind TEXT NOT NULL, itemId TEXT NOT NULL, lastOffset INTEGER DEFAULT 0,
+        attempts INTEGER DEFAULT 0, lastError TEXT, nextEligible TEXT, enqueuedAt TEXT,
+        PRIMARY KEY (kind, itemId)
+    ) WITHOUT ROWID
+    """,
+}
+
+
+def iso_time(column):
+    """SQL expression formatting an epoch milliseconds column as the ISO text
+    of the v1 layout, e.g. 2024-02-01 00:00:00.123000+00:00
+
+    :param column: SQL expression of the epoch milliseconds value
+    """
+    return (f"(strftime('%Y-%m-%d %H:%M:%S', {column} / 1000, 'unixepoch') || "
+            f"CASE WHEN {column} % 1000 THEN printf('.%03d000', {column} % 1000) "
+            f"ELSE '' END || '+00:00')")
+
+
+def epoch_time(column):
+    """SQL expression parsing an ISO text column into epoch milliseconds
+
+    :param column: SQL expression of the ISO timestamp
+    """
+    return (f"(CAST(strftime('%s', {column}) AS INTEGER) * 1000 + "
+            f"CAST(substr(strftime('%f', {column}), 4) AS INTEGER))")
+
+
+def epoch_ms(value):
+    """Epoch milliseconds of a datetime, as stored in createdAt
+
+    :param value: Timezone aware datetime
+    """
+    return round(value.timestamp() * 1000)
 
 
 def initialize_tables(cur):
     """Initialize the database tables, if they don't already exist in the database
 
+    Comments and replies are stored in the compact v2 layout: users are kept
+    once in the user dictionary and referenced by integer keys, createdAt is
+    an epoch milliseconds integer and liked an integer. The comment and reply
+    views expose the v1 columns on top of it, so the Prisma schema keeps
+    reading the same tables.
+
     :param cur: SQLite cursor obj
     """
 
@@ -17,149 +114,848 @@ def initialize_tables(cur):
     CREATE TABLE IF NOT EXISTS video (
         id TEXT PRIMARY KEY NOT NULL, title TEXT, summary TEXT, playCount INTEGER,
         likeCount INTEGER, angerCount INTEGER, duration REAL, createdAt TEXT,
-        commentCount INTEGER DEFAULT 0
+        commentCount INTEGER DEFAULT 0, replyCount INTEGER DEFAULT 0, lastActivityAt TEXT,
+        channelId TEXT
     )
     """)
+    # Archived channels with their rolled up totals, see rollup_channels
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS comment (
-        id TEXT PRIMARY KEY NOT NULL, videoId TEXT, content TEXT, userId TEXT,
-        username TEXT, userType TEXT, posVotes INTEGER, linkedUserName TEXT,
-        linkedUserId TEXT, createdAt TEXT, replyCount INTEGER,
+    CREATE TABLE IF NOT EXISTS channel (
+        id TEXT PRIMARY KEY NOT NULL, title TEXT, videoCount INTEGER DEFAULT 0,
+        sharedVideoCount INTEGER DEFAULT 0, commentCount INTEGER DEFAULT 0,
+        replyCount INTEGER DEFAULT 0, crawledAt TEXT
+    )
+    """)
+    # Videos listed by each channel, a video may be listed by several. The
+    # integer key lets change_log and the snapshot deltas address a row.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS video_channel (
+        id INTEGER PRIMARY KEY, channelId TEXT NOT NULL, videoId TEXT NOT NULL,
+        UNIQUE (channelId, videoId),
         FOREIGN KEY (videoId) REFERENCES video(id) ON DELETE CASCADE
     )
     """)
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS reply (
-        id TEXT PRIMARY KEY NOT NULL, content TEXT, liked TEXT, userId TEXT,
-        userName TEXT, voteCount INTEGER, linkedUserName TEXT, linkedUserId TEXT, createdAt TEXT,
-        replyTo TEXT, FOREIGN KEY (replyTo) REFERENCES comment(id) ON DELETE CASCADE
+    CREATE TABLE IF NOT EXISTS user (
+        id INTEGER PRIMARY KEY, userId TEXT NOT NULL UNIQUE, username TEXT, userType TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS comment_v2 (
+        rid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, videoId TEXT, content TEXT,
+        userKey INTEGER REFERENCES user(id), linkedUserKey INTEGER REFERENCES user(id),
+        posVotes INTEGER, createdAt INTEGER, replyCount INTEGER,
+        storedReplies INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (videoId) REFERENCES video(id) ON DELETE CASCADE
     )
     """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS reply_v2 (
+        rid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, content TEXT, liked INTEGER,
+        userKey INTEGER REFERENCES user(id), voteCount INTEGER,
+        linkedUserKey INTEGER REFERENCES user(id), createdAt INTEGER, replyTo TEXT,
+        FOREIGN KEY (replyTo) REFERENCES comment_v2(id) ON DELETE CASCADE
+    )
+    """)
+    _create_views(cur)
     cur.execute(
         "CREATE TABLE IF NOT EXISTS modified (id INTEGER PRIMARY KEY AUTOINCREMENT, updated TEXT)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS crawl_run (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, mode TEXT, phase TEXT,
+        startedAt TEXT, finishedAt TEXT
+    )
+    """)
+    # One row per exported snapshot, keyed by the modified id it contains
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS snapshot_export (
+        modifiedId INTEGER PRIMARY KEY, exportedAt TEXT, baseId INTEGER,
+        deltaRows INTEGER, deltaBytes INTEGER, snapshotBytes INTEGER
+    )
+    """)
+    # video_rollup_pending holds the videos whose comments or replies changed
+    # since the last rollup_videos
+    for sql in _CONTROL_TABLES.values():
+        cur.execute(sql)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        userId TEXT PRIMARY KEY NOT NULL, username TEXT,
+        commentCount INTEGER NOT NULL DEFAULT 0, replyCount INTEGER NOT NULL DEFAULT 0,
+        commentVotes INTEGER NOT NULL DEFAULT 0, replyVotes INTEGER NOT NULL DEFAULT 0,
+        firstSeen TEXT, lastSeen TEXT
+    )
+    """)
+
 
+def _create_views(cur):
+    """Create the comment and reply compatibility views over the v2 tables
 
-def setup_indexes(cur):
-    """Create indexes for faster querying
+    The views also expose the rowid of the storage table, so the full-text
+    indexes can be joined on them.
 
     :param cur: SQLite cursor obj
     """
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS idx_comments_videoId ON comment (videoId)")
-    cur.execute(
-        "CREATE INDEX IF NOT EXISTS idx_replies_replyTo ON reply (replyTo)")
+    cur.execute(f"""
+    CREATE VIEW IF NOT EXISTS comment AS
+    SELECT c.rid AS rowid, c.id, c.videoId, c.content, u.userId, u.username, u.userType,
+        c.posVotes, l.username AS linkedUserName, l.userId AS linkedUserId,
+        {iso_time("c.createdAt")} AS createdAt, c.replyCount, c.storedReplies
+    FROM comment_v2 c
+        LEFT JOIN user u ON u.id = c.userKey
+        LEFT JOIN user l ON l.id = c.linkedUserKey
+    """)
+    cur.execute(f"""
+    CREATE VIEW IF NOT EXISTS reply AS
+    SELECT r.rid AS rowid, r.id, r.content, CAST(r.liked AS TEXT) AS liked, u.userId,
+        u.username AS userName, r.voteCount, l.username AS linkedUserName,
+        l.userId AS linkedUserId, {iso_time("r.createdAt")} AS createdAt, r.replyTo
+    FROM reply_v2 r
+        LEFT JOIN user u ON u.id = r.userKey
+        LEFT JOIN user l ON l.id = r.linkedUserKey
+    """)
 
 
-def add_video(cur, _id, title, summary, play_count, like_count,
-              anger_count, duration, created_at, comment_count):
-    """Adds or updates video in the database depending on the context.
+def migrate_tables(cur):
+    """Bring tables created by older versions up to date
+
+    Adds the comment.storedReplies counter and backfills it once from the
+    reply table, adds the video rollup columns and queues every video for
+    rollup_videos, adds video.channelId, which the next video phase fills in,
+    and moves v1 comment and reply tables into the v2 layout.
 
-    :param con: SQLite connection obj
     :param cur: SQLite cursor obj
-    :param id: Video id matching banned.video format
-    :param title: Display title of the video
-    :param summary: Summary for the video
-    :param playCount: Play count
-    :param likeCount: Like count
-    :param duration: Video duration
-    :param createdAt: Posted at
-    :param commentCount: Number of comments
     """
-    try:
+    cur.execute("SELECT type FROM sqlite_master WHERE name = 'comment'")
+    v1_layout = cur.fetchone()[0] == "table"
+
+    cur.execute("PRAGMA table_info(comment)")
+    if "storedReplies" not in [row[1] for row in cur.fetchall()]:
         cur.execute("""
-            INSERT INTO video (id, title, summary, playCount, likeCount, angerCount,
-            duration, createdAt, commentCount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (_id, title, summary, play_count, like_count,
-              anger_count, duration, created_at, comment_count))
-        return 1
-    except sqlite3.IntegrityError:
+            ALTER TABLE comment ADD COLUMN storedReplies INTEGER NOT NULL DEFAULT 0
+        """)
         cur.execute("""
-            UPDATE video
-            SET playCount = ?, likeCount = ?, angerCount = ?
-            WHERE id = ?
-        """, (play_count, like_count, anger_count, _id))
-        return 0
+            UPDATE comment SET storedReplies = r.actual_count
+            FROM (SELECT replyTo, COUNT(*) AS actual_count FROM reply GROUP BY replyTo) r
+            WHERE comment.id = r.replyTo
+        """)
 
+    cur.execute("PRAGMA table_info(video)")
+    if "lastActivityAt" not in [row[1] for row in cur.fetchall()]:
+        cur.execute("ALTER TABLE video ADD COLUMN replyCount INTEGER DEFAULT 0")
+        cur.execute("ALTER TABLE video ADD COLUMN lastActivityAt TEXT")
+        cur.execute("INSERT OR IGNORE INTO video_rollup_pending SELECT id FROM video")
+    cur.execute("PRAGMA table_info(video)")
+    if "channelId" not in [row[1] for row in cur.fetchall()]:
+        # Filled in by the video phase, which lists every video of a channel
+        cur.execute("ALTER TABLE video ADD COLUMN channelId TEXT")
 
-def add_comment(cur: sqlite3.Cursor, video_id, _id, content, user_id, username,
-                user_type, pos_votes, linked_user_name, linked_user_id, created_at, reply_count):
-    """Adds or updates comments in the database depending on the context.
+    if v1_layout:
+        migrate_storage(cur)
+
+
+def migrate_storage(cur):
+    """Move the comment and reply tables of the v1 layout into the v2 layout
+
+    Fills the user dictionary, copies every row into comment_v2 and reply_v2,
+    drops the v1 tables with their triggers, indexes and full-text indexes and
+    replaces them with the compatibility views. Runs in a single transaction
+    with foreign keys off, so the v1 rows are not cascaded away. The triggers,
+    indexes and full-text indexes are recreated by the setup functions, and
+    the freed pages are only returned to the file system by a VACUUM.
 
-    :param con: SQLite connection obj
     :param cur: SQLite cursor obj
-    :param videoId: id of the video
-    :param id: comment id
-    :param content: text content of the comment
-    :param userId: id of the commenting user
-    :param username: username of the commenting user
-    :param userType: not sure
-    :param posVotes: upvotes for the comment
-    :param linkedUserName: username of linked user
-    :param linkedUserId: user id of linked user
-    :param createdAt: time when the comment was posted
-    :param replyCount: reply count to this comment
-    """
-    try:
-        cur.execute("""
-            INSERT INTO comment (id, videoId, content, userId, username, userType,
-            posVotes, linkedUserName, linkedUserId, createdAt, replyCount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (_id, video_id, content, user_id, username, user_type,
-              pos_votes, linked_user_name, linked_user_id, created_at, reply_count))
-        return 1
-    except sqlite3.IntegrityError:
-        cur.execute("""
-            UPDATE comment
-            SET posVotes = ?, replyCount = ?
-            WHERE id = ?
-        """, (pos_votes, reply_count, _id))
-        return 0
+    """
+    con = cur.connection
+    con.commit()
+    cur.execute("PRAGMA foreign_keys = OFF")
+    cur.execute("BEGIN")
+    logger.info("Migrating comment and reply tables to the v2 layout")
+    cur.execute("""
+        INSERT OR IGNORE INTO user (userId, username, userType)
+        SELECT userId, MAX(username), MAX(userType) FROM (
+            SELECT userId, username, userType FROM comment
+            UNION ALL SELECT linkedUserId, linkedUserName, NULL FROM comment
+            UNION ALL SELECT userId, userName, NULL FROM reply
+            UNION ALL SELECT linkedUserId, linkedUserName, NULL FROM reply
+        )
+        WHERE userId IS NOT NULL GROUP BY userId
+    """)
+    cur.execute(f"""
+        INSERT INTO comment_v2 (id, videoId, content, userKey, linkedUserKey, posVotes,
+        createdAt, replyCount, storedReplies)
+        SELECT c.id, c.videoId, c.content, u.id, l.id, c.posVotes,
+            {epoch_time("c.createdAt")}, c.replyCount, c.storedReplies
+        FROM comment c
+            LEFT JOIN user u ON u.userId = c.userId
+            LEFT JOIN user l ON l.userId = c.linkedUserId
+        ORDER BY c.rowid
+    """)
+    cur.execute(f"""
+        INSERT INTO reply_v2 (id, content, liked, userKey, voteCount, linkedUserKey,
+        createdAt, replyTo)
+        SELECT r.id, r.content,
+            CASE WHEN r.liked IS NULL THEN NULL
+                 WHEN r.liked IN ('1', 'True', 'true') THEN 1 ELSE 0 END,
+            u.id, r.voteCount, l.id, {epoch_time("r.createdAt")}, r.replyTo
+        FROM reply r
+            LEFT JOIN user u ON u.userId = r.userId
+            LEFT JOIN user l ON l.userId = r.linkedUserId
+        ORDER BY r.rowid
+    """)
+    for table in ("comment_fts", "reply_fts", "reply", "comment"):
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+    _create_views(cur)
+    con.commit()
+    cur.execute("PRAGMA foreign_keys = ON")
 
 
-def add_reply(cur, _id, content, liked, user_id, user_name,
-              vote_count, linked_user_name, linked_user_id, created_at, reply_to):
-    """Adds or updates replies in the database depending on the context.
+def setup_triggers(cur):
+    """Create triggers that keep comment.storedReplies equal to the number
+    of stored replies of each comment
 
-    :param con: SQLite connection obj
     :param cur: SQLite cursor obj
-    :param videoId: id of the video
-    :param id: comment id
-    :param content: text content of the comment
-    :param userId: id of the commenting user
-    :param username: username of the commenting user
-    :param userType: not sure
-    :param posVotes: upvotes for the comment
-    :param linkedUser: not sure
-    :param createdAt: time when the comment was posted
-    :param replyCount: reply count to this comment
-    """
-    try:
-        cur.execute("""
-            INSERT INTO reply (id, content, liked, userId, userName,
-            voteCount, linkedUserName, linkedUserId, createdAt, replyTo) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (_id, content, liked, user_id, user_name, vote_count,
-              linked_user_name, linked_user_id, created_at, reply_to))
-        return 1
-    except sqlite3.IntegrityError:
+    """
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_reply_insert AFTER INSERT ON reply_v2
+    BEGIN
+        UPDATE comment_v2 SET storedReplies = storedReplies + 1 WHERE id = NEW.replyTo;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_reply_delete AFTER DELETE ON reply_v2
+    BEGIN
+        UPDATE comment_v2 SET storedReplies = storedReplies - 1 WHERE id = OLD.replyTo;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_reply_move AFTER UPDATE OF replyTo ON reply_v2
+    WHEN OLD.replyTo IS NOT NEW.replyTo
+    BEGIN
+        UPDATE comment_v2 SET storedReplies = storedReplies - 1 WHERE id = OLD.replyTo;
+        UPDATE comment_v2 SET storedReplies = storedReplies + 1 WHERE id = NEW.replyTo;
+    END
+    """)
+    # Queue the videos whose children change for rollup_videos
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_comment_rollup_{event.lower()}
+        AFTER {event} ON comment_v2 WHEN {row}.videoId IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO video_rollup_pending VALUES ({row}.videoId);
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reply_rollup_{event.lower()} AFTER {event} ON reply_v2
+        BEGIN
+            INSERT OR IGNORE INTO video_rollup_pending
+            SELECT videoId FROM comment_v2 WHERE id = {row}.replyTo AND videoId IS NOT NULL;
+        END
+        """)
+
+
+def _user_stats_triggers(cur, table, votes, count, vote_total):
+    """Create the triggers that roll the rows of a table up into user_stats
+
+    :param cur: SQLite cursor obj
+    :param table: Name of the view (comment or reply)
+    :param votes: Vote column of the table
+    :param count: Counter column of user_stats
+    :param vote_total: Vote total column of user_stats
+    """
+    storage = STORAGE_TABLES[table]
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_user_insert AFTER INSERT ON {storage}
+    WHEN NEW.userKey IS NOT NULL
+    BEGIN
+        INSERT INTO user_stats (userId, username, {count}, {vote_total}, firstSeen, lastSeen)
+        SELECT userId, username, 1, COALESCE(NEW.{votes}, 0),
+            {iso_time("NEW.createdAt")}, {iso_time("NEW.createdAt")}
+        FROM user WHERE id = NEW.userKey
+        ON CONFLICT(userId) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            {count} = {count} + 1,
+            {vote_total} = {vote_total} + excluded.{vote_total},
+            firstSeen = MIN(COALESCE(firstSeen, excluded.firstSeen),
+                            COALESCE(excluded.firstSeen, firstSeen)),
+            lastSeen = MAX(COALESCE(lastSeen, excluded.lastSeen),
+                           COALESCE(excluded.lastSeen, lastSeen));
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_user_delete AFTER DELETE ON {storage}
+    WHEN OLD.userKey IS NOT NULL
+    BEGIN
+        UPDATE user_stats SET {count} = {count} - 1,
+            {vote_total} = {vote_total} - COALESCE(OLD.{votes}, 0)
+        WHERE userId = (SELECT userId FROM user WHERE id = OLD.userKey);
+    END
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_user_votes AFTER UPDATE OF {votes} ON {storage}
+    WHEN OLD.{votes} IS NOT NEW.{votes} AND NEW.userKey IS NOT NULL
+    BEGIN
+        UPDATE user_stats
+        SET {vote_total} = {vote_total} + COALESCE(NEW.{votes}, 0) - COALESCE(OLD.{votes}, 0)
+        WHERE userId = (SELECT userId FROM user WHERE id = NEW.userKey);
+    END
+    """)
+
+
+def setup_user_stats(cur):
+    """Create the triggers that keep user_stats up to date
+
+    Every inserted comment or reply is added to the counters, vote totals and
+    first/last seen timestamps of its user, vote updates adjust the totals and
+    deleted rows are subtracted again. The timestamps are not moved back on
+    delete, rebuild_user_stats recomputes them exactly.
+
+    Returns True if the triggers were just created, user_stats then still has
+    to be filled with rebuild_user_stats.
+
+    :param cur: SQLite cursor obj
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'trg_comment_user_insert'")
+    created = cur.fetchone() is None
+    _user_stats_triggers(cur, "comment", "posVotes", "commentCount", "commentVotes")
+    _user_stats_triggers(cur, "reply", "voteCount", "replyCount", "replyVotes")
+    return created
+
+
+def rebuild_user_stats(cur):
+    """Recompute user_stats from the comment and reply tables
+
+    :param cur: SQLite cursor obj
+    """
+    cur.execute("DELETE FROM user_stats")
+    cur.execute(f"""
+        INSERT INTO user_stats (userId, username, commentCount, replyCount,
+        commentVotes, replyVotes, firstSeen, lastSeen)
+        SELECT u.userId, u.username, SUM(comments), SUM(replies), SUM(commentVotes),
+            SUM(replyVotes), {iso_time("MIN(firstSeen)")}, {iso_time("MAX(lastSeen)")}
+        FROM (
+            SELECT userKey, COUNT(*) AS comments, 0 AS replies,
+                COALESCE(SUM(posVotes), 0) AS commentVotes, 0 AS replyVotes,
+                MIN(createdAt) AS firstSeen, MAX(createdAt) AS lastSeen
+            FROM comment_v2 WHERE userKey IS NOT NULL GROUP BY userKey
+            UNION ALL
+            SELECT userKey, 0, COUNT(*), 0, COALESCE(SUM(voteCount), 0),
+                MIN(createdAt), MAX(createdAt)
+            FROM reply_v2 WHERE userKey IS NOT NULL GROUP BY userKey
+        ) s
+        JOIN user u ON u.id = s.userKey
+        GROUP BY s.userKey
+    """)
+
+
+# Indexes the crawler needs, by name. Every idx_ index of the database that is
+# not declared here or in VIEWER_INDEXES is dropped by setup_indexes.
+CRAWL_INDEXES = {
+    "idx_comments_videoId": "CREATE INDEX idx_comments_videoId ON comment_v2 (videoId)",
+    "idx_replies_replyTo": "CREATE INDEX idx_replies_replyTo ON reply_v2 (replyTo)",
+    # Date range scans over epoch integers, and the pages of a user
+    **{f"idx_{table}_createdAt": f"CREATE INDEX idx_{table}_createdAt ON {storage} (createdAt)"
+       for table, storage in STORAGE_TABLES.items()},
+    "idx_reply_userKey": "CREATE INDEX idx_reply_userKey ON reply_v2 (userKey, createdAt)",
+    # Only holds comments with missing replies, see get_pending_comments
+    "idx_comments_pending": """
+        CREATE INDEX idx_comments_pending ON comment_v2 (id, videoId, replyCount, storedReplies)
+        WHERE replyCount > storedReplies
+    """,
+    "idx_dlq_eligible": "CREATE INDEX idx_dlq_eligible ON dlq (kind, nextEligible)",
+    # Other channels of a video, see rollup_channels
+    "idx_video_channel_videoId":
+        "CREATE INDEX idx_video_channel_videoId ON video_channel (videoId)",
+}
+
+# Indexes of the viewer's query shapes, see viewer_queries.sql. The viewer
+# sorts the comment view by its ISO text createdAt, so those indexes are on
+# the same iso_time() expression; a declaration replaces the crawl index of the
+# same name.
+VIEWER_INDEXES = {
+    "idx_comments_videoId": f"""
+        CREATE INDEX idx_comments_videoId ON comment_v2 (videoId, {iso_time('createdAt')})
+    """,
+    "idx_comment_userKey": f"""
+        CREATE INDEX idx_comment_userKey ON comment_v2 (userKey, {iso_time('createdAt')})
+    """,
+    "idx_comments_date": f"""
+        CREATE INDEX idx_comments_date ON comment_v2 ({iso_time('createdAt')})
+    """,
+    "idx_comments_posVotes": "CREATE INDEX idx_comments_posVotes ON comment_v2 (posVotes)",
+    "idx_comments_replyCount": "CREATE INDEX idx_comments_replyCount ON comment_v2 (replyCount)",
+    **{f"idx_video_{column}": f"CREATE INDEX idx_video_{column} ON video ({column})"
+       for column in ("createdAt", "playCount", "likeCount", "angerCount", "commentCount",
+                      "duration", "replyCount", "lastActivityAt")},
+    **{f"idx_user_stats_{column}":
+       f"CREATE INDEX idx_user_stats_{column} ON user_stats ({column})"
+       for column in ("commentCount", "replyCount", "lastSeen")},
+}
+
+
+def _normalize_sql(sql):
+    """SQL text with collapsed whitespace, to compare index definitions"""
+    return " ".join(sql.split())
+
+
+def setup_indexes(cur, viewer=True):
+    """Bring the idx_ indexes in line with CRAWL_INDEXES and VIEWER_INDEXES
+
+    Indexes whose definition changed are rebuilt and undeclared ones dropped.
+    Returns the names of the indexes that were created.
+
+    :param cur: SQLite cursor obj
+    :param viewer: Also keep the indexes of the viewer's queries
+    """
+    declared = dict(CRAWL_INDEXES)
+    if viewer:
+        declared.update(VIEWER_INDEXES)
+    cur.execute(r"""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND name LIKE 'idx\_%' ESCAPE '\'
+    """)
+    existing = {name: _normalize_sql(sql) for name, sql in cur.fetchall() if sql}
+    created = []
+    for name, sql in existing.items():
+        if name not in declared or sql != _normalize_sql(declared[name]):
+            cur.execute(f"DROP INDEX {name}")
+    for name, sql in declared.items():
+        if existing.get(name) != _normalize_sql(sql):
+            cur.execute(sql)
+            created.append(name)
+    return created
+
+
+def optimize(cur):
+    """Refresh the query planner statistics after the writes of a run
+
+    Runs a full ANALYZE while an index has no statistics yet, e.g. after
+    setup_indexes created it or its table is empty, and PRAGMA optimize
+    otherwise. analysis_limit keeps ANALYZE to a sample of every index, so it
+    stays fast on a big archive.
+
+    :param cur: SQLite cursor obj
+    """
+    cur.execute("PRAGMA analysis_limit = 1000")
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    missing = cur.fetchone() is None
+    if not missing:
         cur.execute("""
-            UPDATE reply
-            SET voteCount = ?
-            WHERE id = ?
-        """, (vote_count, _id))
-        return 0
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL
+            AND name NOT IN (SELECT idx FROM sqlite_stat1 WHERE idx IS NOT NULL)
+        """)
+        missing = cur.fetchone()[0] > 0
+    cur.execute("ANALYZE" if missing else "PRAGMA optimize")
 
 
-def add_comment_count(cur, count, video_id):
-    """Update the comment count for a specific video
+def setup_search(cur):
+    """Create the FTS5 full-text indexes of comment and reply content
+
+    comment_fts and reply_fts are external-content tables: they only hold the
+    index and read the text from comment_v2 and reply_v2 by rowid. Triggers
+    keep them in sync with every insert, delete and content update. The
+    trigram tokenizer matches any substring of three or more characters, like
+    the LIKE '%term%' search of the viewer.
+
+    Returns the list of tables whose index was just created and still has to
+    be filled with rebuild_search.
 
-    :param con: SQLite connection obj
     :param cur: SQLite cursor obj
-    :param count: Updated count
-    :param video_id: Video ID
     """
-    if count > 0:  # Default value = 0 in database
+    created = []
+    for table in SEARCH_TABLES:
+        storage = STORAGE_TABLES[table]
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (f"{table}_fts",))
+        if cur.fetchone() is None:
+            created.append(table)
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+            content, content='{storage}', content_rowid='rid', tokenize='trigram'
+        )
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {storage}
+        BEGIN
+            INSERT INTO {table}_fts (rowid, content) VALUES (NEW.rid, NEW.content);
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {storage}
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, content)
+            VALUES ('delete', OLD.rid, OLD.content);
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF content ON {storage}
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, content)
+            VALUES ('delete', OLD.rid, OLD.content);
+            INSERT INTO {table}_fts (rowid, content) VALUES (NEW.rid, NEW.content);
+        END
+        """)
+    return created
+
+
+def rebuild_search(cur, tables=SEARCH_TABLES):
+    """Rebuild full-text indexes from their content tables and merge their segments
+
+    Needed once for archives that were crawled before the indexes existed.
+
+    :param cur: SQLite cursor obj
+    :param tables: Names of the content tables to reindex
+    """
+    for table in tables:
+        cur.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+        cur.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('optimize')")
+
+
+def _replace_trigger(cur, name, sql):
+    """Create a trigger, or recreate it if its definition changed
+
+    :param cur: SQLite cursor obj
+    :param name: Name of the trigger
+    :param sql: CREATE TRIGGER statement
+    """
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,))
+    row = cur.fetchone()
+    if row is not None and _normalize_sql(row[0]) == _normalize_sql(sql):
+        return
+    cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cur.execute(sql)
+
+
+def setup_change_log(cur, enabled=True):
+    """Create the triggers that record the key of every inserted, updated or
+    deleted row of CHANGE_LOG_TABLES in change_log
+
+    Updates that leave every column unchanged are not recorded, so re-crawled
+    rows stay out of the delta. A key that is already logged is skipped with
+    NOT EXISTS rather than OR IGNORE, as the ON CONFLICT clause of an UPSERT
+    overrides the conflict resolution of the statements in its triggers. The update triggers list the columns of their
+    table and are recreated when a migration adds one. With enabled False the
+    triggers are dropped, and the log and the list of exported snapshots are
+    emptied: changes are no longer recorded, so the next export can only be
+    a full snapshot.
+
+    :param cur: SQLite cursor obj
+    :param enabled: Keep a change log, False when no snapshots are exported
+    """
+    for table, key in CHANGE_LOG_TABLES:
+        if not enabled:
+            for event in ("insert", "update", "delete"):
+                cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_log_{event}")
+            continue
+        cur.execute(f"PRAGMA table_info({table})")
+        changed = " OR ".join(f'OLD."{row[1]}" IS NOT NEW."{row[1]}"'
+                              for row in cur.fetchall())
+        for event, row, when in (("INSERT", "NEW", ""), ("DELETE", "OLD", ""),
+                                 ("UPDATE", "NEW", f"WHEN {changed}")):
+            name = f"trg_{table}_log_{event.lower()}"
+            _replace_trigger(cur, name, f"""
+            CREATE TRIGGER {name} AFTER {event} ON {table} {when}
+            BEGIN
+                INSERT INTO change_log SELECT '{table}', {row}.{key}
+                WHERE NOT EXISTS (SELECT 1 FROM change_log
+                                  WHERE tbl = '{table}' AND rowKey = {row}.{key});
+            END
+            """)
+    if not enabled:
+        cur.execute("DELETE FROM change_log")
+        cur.execute("DELETE FROM snapshot_export")
+
+
+def prepare_database(cur, viewer_indexes=True, change_log=True):
+    """Create, migrate and index every table, and fill new derived tables
+
+    :param cur: SQLite cursor obj
+    :param viewer_indexes: Also keep the indexes of the viewer's queries
+    :param change_log: Record changed rows for the delta of the next snapshot
+    """
+    initialize_tables(cur)
+    migrate_tables(cur)
+    setup_triggers(cur)
+    setup_change_log(cur, change_log)
+    indexes = setup_indexes(cur, viewer_indexes)
+    if indexes:
+        logger.info("Created indexes %s", ", ".join(indexes))
+    created = setup_search(cur)
+    if created:
+        logger.info("Building full-text index of %s", ", ".join(created))
+        rebuild_search(cur, created)
+    if setup_user_stats(cur):
+        logger.info("Building user_stats")
+        rebuild_user_stats(cur)
+
+
+def search_content(cur, table, term, limit=100):
+    """
+    Fetches the ids of the comments or replies whose content contains a term,
+    newest first. Terms shorter than a trigram fall back to a LIKE scan.
+    """
+    storage = STORAGE_TABLES[table]
+    if len(term) < 3:
+        cur.execute(f"""
+            SELECT id FROM {storage} WHERE content LIKE ?
+            ORDER BY createdAt DESC LIMIT ?
+        """, (f"%{term}%", limit))
+    else:
+        phrase = '"' + term.replace('"', '""') + '"'
+        cur.execute(f"""
+            SELECT t.id FROM {table}_fts f JOIN {storage} t ON t.rid = f.rowid
+            WHERE {table}_fts MATCH ? ORDER BY t.createdAt DESC LIMIT ?
+        """, (phrase, limit))
+    return [row[0] for row in cur.fetchall()]
+
+
+def _count_existing(cur, table, ids):
+    """Count how many of the given ids already exist in a table
+
+    :param cur: SQLite cursor obj
+    :param table: Name of the table, must have an id primary key
+    :param ids: Iterable of unique ids
+    """
+    ids = list(ids)
+    existing = 0
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
         cur.execute(
-            "UPDATE video SET commentCount = ? WHERE id = ?", (count, video_id))
-        return f"Updated video {video_id} with comment count {count}"
+            f"SELECT COUNT(*) FROM {table} WHERE id IN ({placeholders})", chunk)
+        existing += cur.fetchone()[0]
+    return existing
+
+
+def _upsert_page(cur, table, sql, rows):
+    """Write a page of rows with a single executemany UPSERT
+
+    Returns a tuple of (new, updated) row counts.
+
+    :param cur: SQLite cursor obj
+    :param table: Name of the table the rows are written to, comment and reply
+        are counted in their storage table
+    :param sql: INSERT ... ON CONFLICT(id) DO UPDATE statement
+    :param rows: List of parameter tuples, the id must be the first value
+    """
+    if not rows:
+        return 0, 0
+    # Later duplicates in a page win, same as running the statements in order
+    rows = list({row[0]: row for row in rows}.values())
+    existing = _count_existing(cur, STORAGE_TABLES.get(table, table),
+                               (row[0] for row in rows))
+    cur.executemany(sql, rows)
+    metrics.record_rows(table, len(rows) - existing, existing)
+    return len(rows) - existing, existing
+
+
+def add_users(cur, items):
+    """Add the authors and linked users of a page to the user dictionary
+
+    New users are inserted and changed usernames updated, unchanged users
+    are not written.
+
+    :param cur: SQLite cursor obj
+    :param items: List of validated comments or replies
+    """
+    users = {}
+    for item in items:
+        users[item.user.id] = (item.user.username, getattr(item.user, "typename", None))
+        if item.linkedUser and item.linkedUser.id not in users:
+            users[item.linkedUser.id] = (item.linkedUser.username, None)
+    cur.executemany("""
+        INSERT INTO user (userId, username, userType) VALUES (?, ?, ?)
+        ON CONFLICT(userId) DO UPDATE SET
+            username = COALESCE(excluded.username, username),
+            userType = COALESCE(excluded.userType, userType)
+        WHERE COALESCE(excluded.username, username) IS NOT username
+            OR COALESCE(excluded.userType, userType) IS NOT userType
+    """, [(user_id, name, user_type) for user_id, (name, user_type) in users.items()])
+
+
+def _linked_user_id(item):
+    """Linked user id of a comment or reply, or None
+
+    :param item: Validated comment or reply
+    """
+    return item.linkedUser.id if item.linkedUser else None
+
+
+def add_videos(cur, videos, channel_id=None):
+    """Adds or updates a page of videos in one statement.
+
+    Existing videos get the current metadata, including every column that
+    video_fingerprint hashes.
+
+    Returns a tuple of (new, updated) video counts.
+
+    :param cur: SQLite cursor obj
+    :param videos: List of validated videos (validator.Video)
+    :param channel_id: Channel that listed the videos, stored as the channel of
+        a video whose response does not name one
+    """
+    rows = [(video.id, video.title, video.summary, video.playCount, video.likeCount,
+             video.angerCount, video.videoDuration, video.createdAt, 0,
+             video.channel.id if video.channel else channel_id)
+            for video in videos]
+    return _upsert_page(cur, "video", """
+        INSERT INTO video (id, title, summary, playCount, likeCount, angerCount,
+        duration, createdAt, commentCount, channelId)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            title = excluded.title, summary = excluded.summary,
+            duration = excluded.duration,
+            playCount = excluded.playCount, likeCount = excluded.likeCount,
+            angerCount = excluded.angerCount,
+            channelId = COALESCE(video.channelId, excluded.channelId)
+    """, rows)
+
+
+def link_videos(cur, channel_id, video_ids):
+    """Record that a channel lists the videos
+
+    :param cur: SQLite cursor obj
+    :param channel_id: Id of the channel
+    :param video_ids: Ids of the listed videos
+    """
+    cur.executemany("INSERT OR IGNORE INTO video_channel (channelId, videoId) VALUES (?, ?)",
+                    [(channel_id, video_id) for video_id in video_ids])
+
+
+def set_channel_crawled(cur, channel_id, title=None):
+    """Mark the video list of a channel as crawled
+
+    :param cur: SQLite cursor obj
+    :param channel_id: Id of the channel
+    :param title: Title of the channel, None keeps the stored one
+    """
+    crawled_at = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("""
+        INSERT INTO channel (id, title, crawledAt) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            title = COALESCE(excluded.title, channel.title), crawledAt = excluded.crawledAt
+    """, (channel_id, title, crawled_at))
+
+
+def get_channel_stats(cur):
+    """
+    Fetches the rolled up totals of every channel, as a dict of channel id to
+    a dict of the channel columns.
+    """
+    cur.execute("""
+        SELECT id, title, videoCount, sharedVideoCount, commentCount, replyCount, crawledAt
+        FROM channel ORDER BY id
+    """)
+    columns = [column[0] for column in cur.description]
+    return {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def rollup_channels(cur):
+    """Recompute the video, comment and reply totals of every channel
+
+    Runs after rollup_videos. A shared video counts for every channel that
+    lists it.
+
+    :param cur: SQLite cursor obj
+    """
+    cur.execute("""
+        WITH totals AS (
+            SELECT vc.channelId, COUNT(*) AS videos,
+                SUM(EXISTS (SELECT 1 FROM video_channel o
+                            WHERE o.videoId = vc.videoId AND o.channelId != vc.channelId))
+                    AS shared,
+                SUM(v.commentCount) AS comments, SUM(v.replyCount) AS replies
+            FROM video_channel vc JOIN video v ON v.id = vc.videoId
+            GROUP BY vc.channelId
+        )
+        UPDATE channel SET videoCount = totals.videos, sharedVideoCount = totals.shared,
+            commentCount = COALESCE(totals.comments, 0), replyCount = COALESCE(totals.replies, 0)
+        FROM totals WHERE channel.id = totals.channelId
+    """)
+
+
+def add_comments(cur, video_id, comments):
+    """Adds or updates a page of comments in one statement.
+
+    Returns a tuple of (new, updated) comment counts.
+
+    :param cur: SQLite cursor obj
+    :param video_id: id of the video the comments belong to
+    :param comments: List of validated comments (validator.Comment)
+    """
+    add_users(cur, comments)
+    rows = [(comment.id, video_id, comment.content, comment.user.id,
+             _linked_user_id(comment), comment.voteCount.positive,
+             epoch_ms(comment.createdAt), comment.replyCount)
+            for comment in comments]
+    return _upsert_page(cur, "comment", """
+        INSERT INTO comment_v2 (id, videoId, content, userKey, linkedUserKey,
+        posVotes, createdAt, replyCount)
+        VALUES (?, ?, ?, (SELECT id FROM user WHERE userId = ?),
+                (SELECT id FROM user WHERE userId = ?), ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            posVotes = excluded.posVotes, replyCount = excluded.replyCount
+    """, rows)
+
+
+def add_replies(cur, replies):
+    """Adds or updates a page of replies in one statement.
+
+    Returns a tuple of (new, updated) reply counts.
+
+    :param cur: SQLite cursor obj
+    :param replies: List of validated replies (validator.Reply)
+    """
+    add_users(cur, replies)
+    rows = [(reply.id, reply.content, int(reply.liked), reply.user.id,
+             reply.voteCount.positive, _linked_user_id(reply),
+             epoch_ms(reply.createdAt), reply.replyTo.id)
+            for reply in replies]
+    return _upsert_page(cur, "reply", """
+        INSERT INTO reply_v2 (id, content, liked, userKey, voteCount,
+        linkedUserKey, createdAt, replyTo)
+        VALUES (?, ?, ?, (SELECT id FROM user WHERE userId = ?), ?,
+                (SELECT id FROM user WHERE userId = ?), ?, ?)
+        ON CONFLICT(id) DO UPDATE SET voteCount = excluded.voteCount
+    """, rows)
+
+
+def rollup_videos(cur):
+    """Recompute the comment count, reply count and latest activity of every
+    video whose comments or replies changed, in one statement
+
+    The counts are taken from the stored rows, so they stay exact however the
+    rows were fetched (full, incremental, resumed or DLQ recovery).
+
+    Returns the number of videos updated.
+
+    :param cur: SQLite cursor obj
+    """
+    cur.execute(f"""
+        WITH comments AS (
+            SELECT c.videoId, COUNT(*) AS comments, SUM(c.storedReplies) AS replies,
+                MAX(c.createdAt) AS lastComment
+            FROM comment_v2 c WHERE c.videoId IN (SELECT videoId FROM video_rollup_pending)
+            GROUP BY c.videoId
+        ), replies AS (
+            SELECT c.videoId, MAX(r.createdAt) AS lastReply
+            FROM comment_v2 c JOIN reply_v2 r ON r.replyTo = c.id
+            WHERE c.videoId IN (SELECT videoId FROM video_rollup_pending)
+            GROUP BY c.videoId
+        )
+        UPDATE video SET commentCount = COALESCE(comments.comments, 0),
+            replyCount = COALESCE(comments.replies, 0),
+            lastActivityAt = {iso_time("MAX(COALESCE(comments.lastComment, replies.lastReply), "
+                                       "COALESCE(replies.lastReply, comments.lastComment))")}
+        FROM video_rollup_pending p
+            LEFT JOIN comments ON comments.videoId = p.videoId
+            LEFT JOIN replies ON replies.videoId = p.videoId
+        WHERE video.id = p.videoId
+    """)
+    # cursor.rowcount is not reported for statements starting with WITH
+    cur.execute("SELECT changes()")
+    updated = cur.fetchone()[0]
+    cur.execute("DELETE FROM video_rollup_pending")
+    return updated
 
 
 def add_timestamp(cur):
@@ -175,40 +971,380 @@ def add_timestamp(cur):
     return f"Dump finished at {timestamp}"
 
 
-def get_pending_comments(cur):
+def _iter_keyset(con, query, params=(), page_size=CHUNK_SIZE):
+    """Yields the rows of a query one keyset page at a time
+
+    The query must select its key first, filter on "key > ?" with the last key
+    of the previous page, order by the key and end with "LIMIT ?". Every page
+    is read in a statement of its own, so no statement stays open between
+    pages and only one page is held in memory.
+
+    :param con: SQLite connection obj, usually a reader (Publisher.open_reader)
+    :param query: SQL query, its last two parameters are the key and the limit
+    :param params: Parameters that come before the key
+    :param page_size: Rows per page
+    """
+    last = ""
+    while True:
+        rows = con.execute(query, (*params, last, page_size)).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1][0]
+
+
+def _pending_filter(max_replies):
+    """WHERE clause and parameters of the comments with missing replies"""
+    if max_replies is None:
+        return "replyCount > storedReplies", ()
+    return "replyCount > storedReplies AND replyCount < ?", (max_replies,)
+
+
+def iter_pending_comments(con, max_replies=None):
+    """
+    Yields (comment id, video id, reply count) of every comment where the
+    expected replyCount is greater than the number of replies currently
+    stored in the database, in id order.
+
+    :param con: SQLite connection obj
+    :param max_replies: Only yield comments expecting fewer replies than this
+    """
+    where, params = _pending_filter(max_replies)
+    query = f"""
+        SELECT id, videoId, replyCount FROM comment_v2
+        WHERE {where} AND id > ? ORDER BY id LIMIT ?
+    """
+    yield from _iter_keyset(con, query, params)
+
+
+def count_pending_comments(con, max_replies=None):
     """
-    Fetches only comments where the expected replyCount is greater 
-    than the number of replies currently stored in the database.
+    Counts the comments yielded by iter_pending_comments.
+    """
+    where, params = _pending_filter(max_replies)
+    return con.execute(f"SELECT COUNT(*) FROM comment_v2 WHERE {where}",
+                       params).fetchone()[0]
+
+
+def iter_videos(con, with_state=True):
+    """
+    Yields (video id, crawl state) of every video, in id order. The crawl
+    state is a dict of the stored watermark columns, or None if the video
+    has not been crawled before or with_state is False.
+
+    :param con: SQLite connection obj
+    :param with_state: Join the stored crawl state of every video
     """
     query = """
-        SELECT 
-            c.id, 
-            c.videoId, 
-            c.replyCount
-        FROM comment c
-        LEFT JOIN (
-            SELECT replyTo, COUNT(*) as actual_count 
-            FROM Reply 
-            GROUP BY replyTo
-        ) r ON c.id = r.replyTo
-        WHERE c.replyCount > 0 
-        AND c.replyCount > COALESCE(r.actual_count, 0)
-    """
-    cur.execute(query)
+        SELECT v.id, s.videoId, s.commentCount, s.newestCommentId, s.newestCommentAt,
+            s.metaHash
+        FROM video v LEFT JOIN crawl_state s ON s.videoId = v.id
+        WHERE v.id > ? ORDER BY v.id LIMIT ?
+    """
+    for row in _iter_keyset(con, query):
+        state = None
+        if with_state and row[1] is not None:
+            state = {"commentCount": row[2], "newestCommentId": row[3],
+                     "newestCommentAt": row[4], "metaHash": row[5]}
+        yield row[0], state
+
+
+def count_videos(con):
+    """
+    Counts the videos yielded by iter_videos.
+    """
+    return con.execute("SELECT COUNT(*) FROM video").fetchone()[0]
+
+def get_stored_comment_count(cur, video_id):
+    """
+    Fetches the number of comments stored in the database for a given video ID.
+    """
+    cur.execute("SELECT COUNT(*) FROM comment_v2 WHERE videoId = ?", (video_id,))
+    return cur.fetchone()[0]
+
+def video_fingerprint(video):
+    """Hash of the video metadata that is compared between incremental runs
+
+    The play count is left out as it changes with every view.
+
+    :param video: Validated video (validator.Video)
+    """
+    return _meta_hash(video.title, video.summary, video.likeCount,
+                      video.angerCount, video.videoDuration)
+
+
+def _meta_hash(*meta):
+    """
+    Hashes the metadata columns compared by video_fingerprint.
+    """
+    return hashlib.sha1(repr(meta).encode("UTF-8")).hexdigest()
+
+
+def get_video_fingerprints(con):
+    """Rebuild the video_fingerprint of every stored video
+
+    The video phase stores every column it hashes (see add_videos), so a
+    resumed run gets the same hashes as the video phase computed before the
+    interruption.
+    Returns a dict of video id to meta hash.
+
+    :param con: SQLite connection obj
+    """
+    query = """
+        SELECT id, title, summary, likeCount, angerCount, duration
+        FROM video WHERE id > ? ORDER BY id LIMIT ?
+    """
+    return {row[0]: _meta_hash(*row[1:]) for row in _iter_keyset(con, query)}
+
+
+def set_crawl_state(cur, video_id, newest_comment, meta_hash):
+    """Store the watermark of a successfully crawled video
+
+    Returns the number of comments stored for the video.
+
+    :param cur: SQLite cursor obj
+    :param video_id: Video ID
+    :param newest_comment: Newest comment fetched, None if the API was not
+        seen to return the comments newest first
+    :param meta_hash: Fingerprint of the video metadata (see video_fingerprint)
+    """
+    comment_count = get_stored_comment_count(cur, video_id)
+    newest_id = newest_comment.id if newest_comment else None
+    newest_at = newest_comment.createdAt if newest_comment else None
+    crawled_at = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("""
+        INSERT INTO crawl_state (videoId, commentCount, newestCommentId,
+        newestCommentAt, metaHash, crawledAt) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(videoId) DO UPDATE SET
+            commentCount = excluded.commentCount,
+            newestCommentId = excluded.newestCommentId,
+            newestCommentAt = excluded.newestCommentAt,
+            metaHash = excluded.metaHash, crawledAt = excluded.crawledAt
+    """, (video_id, comment_count, newest_id, newest_at, meta_hash, crawled_at))
+    return comment_count
+
+
+def set_reply_states(cur, threads):
+    """Store the fingerprint of fetched reply threads
+
+    The fingerprint is the reply count the server returned for the thread
+    and its newest reply, by createdAt and id, so it does not depend on the
+    order the API returns the replies in. A thread whose fingerprint changed
+    is re-synced by the reply_refresh phase, see iter_refresh_threads.
+
+    :param cur: SQLite cursor obj
+    :param threads: List of (comment id, reply count, newest reply or None)
+    """
+    checked_at = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.executemany("""
+        INSERT INTO reply_state (commentId, replyCount, newestReplyId, newestReplyAt, checkedAt)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(commentId) DO UPDATE SET
+            replyCount = excluded.replyCount, newestReplyId = excluded.newestReplyId,
+            newestReplyAt = excluded.newestReplyAt, checkedAt = excluded.checkedAt
+    """, [(comment_id, reply_count, newest.id if newest else None,
+           newest.createdAt if newest else None, checked_at)
+          for comment_id, reply_count, newest in threads])
+
+
+def iter_refresh_threads(con):
+    """
+    Yields (comment id, reply count, stored fingerprint) of every comment
+    that has replies and none missing, in id order. The stored fingerprint
+    is a dict of the reply_state columns, or None if the thread has not been
+    fingerprinted yet.
+
+    :param con: SQLite connection obj
+    """
+    query = """
+        SELECT c.id, c.replyCount, s.commentId, s.replyCount, s.newestReplyId
+        FROM comment_v2 c LEFT JOIN reply_state s ON s.commentId = c.id
+        WHERE c.replyCount > 0 AND c.replyCount <= c.storedReplies AND c.id > ?
+        ORDER BY c.id LIMIT ?
+    """
+    for row in _iter_keyset(con, query):
+        state = None
+        if row[2] is not None:
+            state = {"replyCount": row[3], "newestReplyId": row[4]}
+        yield row[0], row[1], state
+
+
+def count_refresh_threads(con):
+    """
+    Counts the comments yielded by iter_refresh_threads.
+    """
+    return con.execute("""
+        SELECT COUNT(*) FROM comment_v2
+        WHERE replyCount > 0 AND replyCount <= storedReplies
+    """).fetchone()[0]
+
+
+def get_stored_reply_ids(cur, reply_ids):
+    """
+    Fetches which of the given reply ids are stored, as a set.
+    """
+    stored = set()
+    for start in range(0, len(reply_ids), CHUNK_SIZE):
+        chunk = reply_ids[start:start + CHUNK_SIZE]
+        cur.execute(f"SELECT id FROM reply_v2 WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk)
+        stored.update(row[0] for row in cur.fetchall())
+    return stored
+
+
+def start_run(cur, mode, phase):
+    """Register a new crawl run and drop the checkpoints of older runs
+
+    Returns the id of the new run.
+
+    :param cur: SQLite cursor obj
+    :param mode: Crawl mode of the run (full or incremental)
+    :param phase: Name of the first phase of the run
+    """
+    started_at = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("DELETE FROM crawl_checkpoint")
+    cur.execute("INSERT INTO crawl_run (mode, phase, startedAt) VALUES (?, ?, ?)",
+                (mode, phase, started_at))
+    return cur.lastrowid
+
+
+def get_unfinished_run(cur):
+    """
+    Fetches the latest crawl run that has not finished,
+    as a tuple of (id, mode, phase) or None.
+    """
+    cur.execute("""
+        SELECT id, mode, phase FROM crawl_run
+        WHERE finishedAt IS NULL ORDER BY id DESC LIMIT 1
+    """)
+    return cur.fetchone()
+
+
+def set_run_phase(cur, run_id, phase):
+    """Record the phase a crawl run is currently in
+
+    :param cur: SQLite cursor obj
+    :param run_id: Id of the crawl run
+    :param phase: Name of the phase
+    """
+    cur.execute("UPDATE crawl_run SET phase = ? WHERE id = ?", (phase, run_id))
+
+
+def finish_run(cur, run_id):
+    """Mark a crawl run as finished and drop its checkpoints
+
+    :param cur: SQLite cursor obj
+    :param run_id: Id of the crawl run
+    """
+    finished_at = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("UPDATE crawl_run SET phase = NULL, finishedAt = ? WHERE id = ?",
+                (finished_at, run_id))
+    cur.execute("DELETE FROM crawl_checkpoint WHERE runId = ?", (run_id,))
+
+
+def save_checkpoint(cur, run_id, phase, item_id, offset, done):
+    """Store the progress of a single work item
+
+    :param cur: SQLite cursor obj
+    :param run_id: Id of the crawl run
+    :param phase: Name of the phase the item belongs to
+    :param item_id: Video or comment id (or another phase specific key)
+    :param offset: Offset of the next page to fetch
+    :param done: True if the item is completed
+    """
+    cur.execute("""
+        INSERT INTO crawl_checkpoint (runId, phase, itemId, pendingOffset, done)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(runId, phase, itemId) DO UPDATE SET
+            pendingOffset = excluded.pendingOffset, done = excluded.done
+    """, (run_id, phase, item_id, offset, int(done)))
+
+
+def get_checkpoints(cur, run_id, phase):
+    """
+    Fetches the stored progress of a phase,
+    as a dict of itemId to a tuple of (pendingOffset, done).
+    """
+    cur.execute("""
+        SELECT itemId, pendingOffset, done FROM crawl_checkpoint
+        WHERE runId = ? AND phase = ?
+    """, (run_id, phase))
+    return {row[0]: (row[1], bool(row[2])) for row in cur.fetchall()}
+
+
+def enqueue_dlq(cur, kind, item_id, offset, error):
+    """Add a failed item to the dead-letter queue, or refresh its entry
+
+    An item that is already queued keeps its lowest failing offset, and
+    becomes eligible right away with its attempts reset, as it failed again
+    in a regular fetch. This also revives entries that ran out of attempts.
+
+    :param cur: SQLite cursor obj
+    :param kind: Kind of the item (comment or reply)
+    :param item_id: Video id for comments, comment id for replies
+    :param offset: Offset of the page that failed
+    :param error: Reason of the failure
+    """
+    now = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("""
+        INSERT INTO dlq (kind, itemId, lastOffset, attempts, lastError,
+        nextEligible, enqueuedAt) VALUES (?, ?, ?, 0, ?, ?, ?)
+        ON CONFLICT(kind, itemId) DO UPDATE SET
+            lastOffset = MIN(lastOffset, excluded.lastOffset), attempts = 0,
+            lastError = excluded.lastError, nextEligible = excluded.nextEligible
+    """, (kind, item_id, offset, error, now, now))
+
+
+def get_eligible_dlq(cur, kind, max_attempts):
+    """
+    Fetches the DLQ entries of a kind that are due for another attempt,
+    as a list of (itemId, lastOffset, attempts), oldest first.
+    """
+    now = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    cur.execute("""
+        SELECT itemId, lastOffset, attempts FROM dlq
+        WHERE kind = ? AND nextEligible <= ? AND attempts < ?
+        ORDER BY nextEligible
+    """, (kind, now, max_attempts))
     return cur.fetchall()
 
-def get_all_video_ids(cur):
+
+def retry_dlq(cur, kind, item_id, offset, error, delay):
+    """Record a failed attempt and schedule the next one
+
+    :param cur: SQLite cursor obj
+    :param kind: Kind of the item (comment or reply)
+    :param item_id: Video id for comments, comment id for replies
+    :param offset: Offset to continue from on the next attempt
+    :param error: Reason of the failure
+    :param delay: Seconds until the item is eligible again
     """
-    Fetches all video IDs from the Video table.
+    next_eligible = (datetime.now(timezone.utc) + timedelta(seconds=delay)
+                     ).isoformat(timespec='milliseconds')
+    cur.execute("""
+        UPDATE dlq SET lastOffset = ?, attempts = attempts + 1,
+            lastError = ?, nextEligible = ?
+        WHERE kind = ? AND itemId = ?
+    """, (offset, error, next_eligible, kind, item_id))
+
+
+def remove_dlq(cur, kind, item_id):
+    """Remove a resolved item from the dead-letter queue
+
+    :param cur: SQLite cursor obj
+    :param kind: Kind of the item (comment or reply)
+    :param item_id: Video id for comments, comment id for replies
     """
-    query = "SELECT id FROM video"
-    cur.execute(query)
-    return [row[0] for row in cur.fetchall()]
+    cur.execute("DELETE FROM dlq WHERE kind = ? AND itemId = ?", (kind, item_id))
 
-def get_comment_reply_count(cur, comment_id):
+
+def get_dlq_sizes(cur, max_attempts):
     """
-    Fetches the current number of replies stored in the database for a given comment ID.
+    Fetches the number of DLQ entries per kind, as a dict of kind to a tuple of
+    (queued, exhausted). Exhausted entries used up max_attempts and are only
+    retried once a regular fetch of the item fails again.
     """
-    query = "SELECT COUNT(*) FROM reply WHERE replyTo = ?"
-    cur.execute(query, (comment_id,))
-    return cur.fetchone()[0]
\ No newline at end of file
+    cur.execute("""
+        SELECT kind, SUM(attempts < ?), SUM(attempts >= ?) FROM dlq GROUP BY kind
+    """, (max_attempts, max_attempts))
+    return {kind: (queued, exhausted) for kind, queued, exhausted in cur.fetchall()}
@@ -0,0 +1,167 @@
+"""
+Durable dead-letter queue of failed comment and reply fetches.
+
+Failed items are stored in the dlq table of the working database with the
+offset of the failing page, the number of attempts, the last error and the
+time the item is eligible again. Enqueueing the same item twice only refreshes
+its entry and resets its attempts. Entries that used up DLQ_MAX_ATTEMPTS are
+kept as exhausted and reported apart from the queued ones. A DLQ phase is drained by a pool of workers that run the bisecting
+recovery over the network, while the calling thread writes the recovered
+pages and settles every entry, so the SQLite connection never leaves it.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+import logging
+import os
+
+import requests
+from pydantic import ValidationError
+
+import config as conf
+from helpers import dbutils
+from helpers import metrics
+from helpers.recovery import BisectingRecovery, InvalidId
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(cur, kind, item_id, offset, error):
+    """Add a failed item to the dead-letter queue
+
+    :param cur: SQLite cursor obj
+    :param kind: Kind of the item (comment or reply)
+    :param item_id: Video id for comments, comment id for replies
+    :param offset: Offset of the page that failed
+    :param error: Reason of the failure
+    """
+    dbutils.enqueue_dlq(cur, kind, item_id, offset, str(error))
+    metrics.increment("dlq_enqueued")
+
+
+def import_legacy(con, kind, path):
+    """Move the request bodies left in an old errors/ directory into the queue
+
+    The files are only removed once the queue entries are committed.
+
+    Returns the number of imported items.
+
+    :param con: SQLite connection obj
+    :param kind: Kind of the items in the directory (comment or reply)
+    :param path: Legacy DLQ directory
+    """
+    if not os.path.isdir(path):
+        return 0
+
+    cur = con.cursor()
+    files = os.listdir(path)
+    for item_id in files:
+        with open(f"{path}/{item_id}", encoding="UTF-8") as file:
+            try:
+                offset = json.load(file)["variables"]["offset"]
+            except (json.JSONDecodeError, KeyError, TypeError):
+                offset = 0
+        enqueue(cur, kind, item_id, int(offset), "imported from errors/")
+    con.commit()
+
+    for item_id in files:
+        os.remove(f"{path}/{item_id}")
+    if files:
+        logger.info("Imported %d %s DLQ files from %s", len(files), kind, path)
+    return len(files)
+
+
+def _recover(fetch_page, item):
+    """Run the bisecting recovery of a single item, on a worker thread
+
+    The recovered pages are buffered and handed back to the writing thread.
+
+    Returns a tuple of (item id, recovery, pages, next offset, error), where
+    error is None if the item is resolved.
+
+    :param fetch_page: Function of (item id, offset, limit) returning a page
+    :param item: DLQ entry as (item id, last offset, attempts)
+    """
+    item_id, offset, _ = item
+    pages = []
+    progress = [offset]
+
+    def on_window(next_offset):
+        progress[0] = next_offset
+
+    recovery = BisectingRecovery(
+        lambda page_offset, limit: fetch_page(item_id, page_offset, limit))
+    error = None
+    try:
+        recovery.run(offset, lambda page_offset, items:
+                     pages.append((page_offset, items)), on_window)
+    except InvalidId:
+        logger.warning("[%s] invalid request id, stopping retries", item_id)
+
+    except requests.RequestException as e:
+        error = f"request error: {e}"
+
+    except ValidationError:
+        error = "malformed response"
+
+    return item_id, recovery, pages, progress[0], error
+
+
+def drain(cur, checkpoint, kind, fetch_page, write_page, totals, workers=None):
+    """Retry every eligible DLQ entry of a kind with a pool of workers
+
+    A resolved entry is removed in the same transaction as its recovered
+    rows. A failed entry keeps the offset it reached and is retried in a
+    later run, with an exponential delay, until DLQ_MAX_ATTEMPTS is reached.
+    It is then exhausted, and only retried once it is enqueued again.
+
+    :param cur: SQLite cursor obj
+    :param checkpoint: Checkpoint of the current run
+    :param kind: Kind of the entries (comment or reply)
+    :param fetch_page: Function of (item id, offset, limit) returning a page,
+        raising PoisonedRange or InvalidId for error responses
+    :param write_page: Function of (item id, offset, items) storing a page
+    :param totals: Dict of DLQ recovery counters, updated in place
+    :param workers: Number of items recovered at the same time
+    """
+    workers = workers or conf.DLQ_WORKERS
+    items = dbutils.get_eligible_dlq(cur, kind, conf.DLQ_MAX_ATTEMPTS)
+    logger.info("Draining %d %s DLQ entries with %d workers",
+                len(items), kind, workers)
+    attempts_of = {item_id: attempts for item_id, _, attempts in items}
+
+    def settle(future, position):
+        item_id, recovery, pages, next_offset, error = future.result()
+        for page_offset, page in pages:
+            write_page(item_id, page_offset, page)
+
+        totals["requests"] += recovery.requests
+        totals["recovered"] += recovery.recovered
+        totals["poisoned"] += len(recovery.poisoned)
+        if error is None:
+            dbutils.remove_dlq(cur, kind, item_id)
+            logger.info("[%s] done (%d/%d), %d recovered, %d poisoned, "
+                        "%.2f requests per item", item_id, position, len(items),
+                        recovery.recovered, len(recovery.poisoned),
+                        recovery.requests_per_item())
+        else:
+            attempts = attempts_of[item_id] + 1
+            dbutils.retry_dlq(cur, kind, item_id, next_offset, error,
+                              conf.DLQ_RETRY_DELAY * 2 ** (attempts - 1))
+            logger.error("[%s] attempt %d failed @ offset %d: %s",
+                         item_id, attempts, next_offset, error)
+        checkpoint.complete(item_id)
+
+    settled = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        for item in items:
+            in_flight.add(pool.submit(_recover, fetch_page, item))
+            # Bound the buffered pages to a couple of items per worker
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    settled += 1
+                    settle(future, settled)
+        for future in wait(in_flight).done:
+            settled += 1
+            settle(future, settled)
@@ -0,0 +1,367 @@
+"""
+Asynchronous fetch engine for the video and the per-video comment phases.
+
+Keeps a configurable number of channel video lists or video comment streams
+in flight at once. The blocking HTTP calls run on a dedicated thread pool
+while all database writes happen on the event loop thread, so the SQLite
+cursor is never shared between threads. Each page is written with a single
+bulk UPSERT.
+
+A video listed by several channels is stored and fingerprinted once per run,
+so the comment phase crawls it once. In incremental mode the stored per-video
+watermarks (see dbutils.crawl_state) are used to stop paging early or to skip
+unchanged videos.
+"""
+import asyncio
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from pydantic import ValidationError
+
+import config as conf
+from helpers import validator as pyd
+from helpers import get_request_bodies
+from helpers import dbutils
+from helpers import dlq
+from helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _post(transport, body, phase="comments"):
+    """Blocking POST of a request body, run on the engine's thread pool
+
+    :param transport: Shared HTTP transport
+    :param body: GraphQL request body
+    :param phase: Crawl phase the request is accounted to
+    """
+    return transport.post(body, phase).content
+
+
+async def _fetch_channel_videos(cur, transport, loop, pool, semaphore, checkpoint,
+                                channel_id, seen):
+    """Page through the videos of a single channel once a slot is free
+
+    Videos that another channel already listed in this run are only linked to
+    the channel, the first listing stored them. An error response, e.g.
+    INVALID_ID, stops the channel, and it is not marked as crawled.
+
+    Returns a tuple of (new videos, shared videos) of the channel.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param loop: Running event loop
+    :param pool: Thread pool used for the blocking requests
+    :param semaphore: Semaphore bounding the number of channels in flight
+    :param checkpoint: Checkpoint of the current run
+    :param channel_id: Id of the channel
+    :param seen: Dict of video id to meta hash of the videos listed so far,
+        shared by all channels and updated in place
+    """
+    offset = checkpoint.pending(channel_id)
+    if offset is None:
+        return 0, 0
+
+    new_videos, shared_videos = 0, 0
+    title = None
+    error = False
+    async with semaphore:
+        logger.info("[%s] fetching videos", channel_id)
+        while True:
+            body = get_request_bodies.get_video_request_body(
+                channel_id, conf.LIMIT, offset)
+            try:
+                raw = await loop.run_in_executor(pool, _post, transport, body, "videos")
+                validation = pyd.validate_response("GetChannelVideos", raw)
+                if isinstance(validation, pyd.GetChannelVideosResponse):
+                    videos = validation.data.getChannel.videos
+                    logger.info("[%s] fetched %d videos @ offset %d",
+                                channel_id, len(videos), offset)
+
+                    fresh = [video for video in videos if video.id not in seen]
+                    added, _ = dbutils.add_videos(cur, fresh, channel_id)
+                    dbutils.link_videos(cur, channel_id, [video.id for video in videos])
+                    for video in fresh:
+                        seen[video.id] = dbutils.video_fingerprint(video)
+                    for video in videos:
+                        if video.channel and video.channel.id == channel_id:
+                            title = video.channel.title or title
+                    new_videos += added
+                    shared_videos += len(videos) - len(fresh)
+                    checkpoint.advance(channel_id, offset + conf.LIMIT)
+
+                    if len(videos) < conf.LIMIT:
+                        break
+
+                else:
+                    # Every later offset would get the same error response
+                    logger.error("[%s] @ offset %d contains error, stopping the channel",
+                                 channel_id, offset)
+                    error = True
+                    break
+            except AttributeError as e:
+                logger.error(e)
+
+            except (requests.RequestException, requests.HTTPError):
+                logger.error("[%s] video fetch failed @ offset %s", channel_id, offset)
+
+            except ValidationError:
+                logger.error("[%s] malformed video response @ offset %d",
+                             channel_id, offset)
+
+            offset += conf.LIMIT
+
+    if not error:
+        dbutils.set_channel_crawled(cur, channel_id, title)
+    checkpoint.complete(channel_id)
+    logger.info("[%s] %d new videos, %d already listed by another channel",
+                channel_id, new_videos, shared_videos)
+    return new_videos, shared_videos
+
+
+async def _fetch_all_videos(cur, transport, checkpoint, channel_ids, concurrency):
+    """Schedule one video list per channel, bounded by the concurrency limit
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param channel_ids: List of channel ids
+    :param concurrency: Maximum number of channels fetched at the same time
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    seen = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = await asyncio.gather(*(
+            _fetch_channel_videos(cur, transport, loop, pool, semaphore, checkpoint,
+                                  channel_id, seen)
+            for channel_id in channel_ids
+        ))
+    return dict(zip(channel_ids, results)), seen
+
+
+def fetch_all_videos(cur, transport, checkpoint, channel_ids, concurrency=None):
+    """Fetch the videos of every channel in the list
+
+    Channels that the checkpoint marks as done are skipped, and channels that
+    were interrupted continue from their pending offset.
+
+    Returns a tuple of (dict of channel id to (new videos, shared videos),
+    dict of video id to meta hash).
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param channel_ids: List of channel ids
+    :param concurrency: Number of channels in flight, defaults to conf.CHANNEL_CONCURRENCY
+    """
+    if concurrency is None:
+        concurrency = conf.CHANNEL_CONCURRENCY
+    return asyncio.run(_fetch_all_videos(cur, transport, checkpoint,
+                                         list(dict.fromkeys(channel_ids)),
+                                         max(1, concurrency)))
+
+
+def _newest_first(comments):
+    """True if a page lists its comments newest first, None if it is too
+    short to tell
+
+    :param comments: Comments of a page, in the order of the API
+    """
+    if len(comments) < 2:
+        return None
+    return all(a.createdAt >= b.createdAt for a, b in zip(comments, comments[1:]))
+
+
+async def _fetch_video_comments(cur, transport, loop, pool, checkpoint,
+                                video, start_offset):
+    """Page through the comments of a single video
+
+    In incremental mode a video that has been crawled before is paged only
+    until a page contains comments that are already stored. If its metadata
+    is unchanged, the first request is a small probe, and the video is skipped
+    when the newest comment still matches the stored watermark.
+
+    The request does not pin an order, so both shortcuts are only taken once
+    the pages were seen to be newest first. The watermark is the newest
+    comment by createdAt, and it is only stored when that order was seen,
+    otherwise the next run pages through the whole video.
+
+    Returns a tuple of (new comments, skipped) for the video.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param loop: Running event loop
+    :param pool: Thread pool used for the blocking requests
+    :param checkpoint: Checkpoint of the current run
+    :param video: Work item with the video id, meta hash and crawl state
+    :param start_offset: Offset to start from, non-zero when resuming a video
+    """
+    video_id, meta_hash, state = video
+    new_comments = 0
+    retries, offset = 0, start_offset
+    newest_comment = None
+    # None until a page shows the order of the API
+    ordered = None
+    probing = (start_offset == 0 and state is not None and
+               state["metaHash"] == meta_hash)
+    limit = conf.PROBE_LIMIT if probing else conf.LIMIT
+
+    while True:
+        body = get_request_bodies.get_comment_request_body(
+            video_id, limit, offset)
+        try:
+            raw = await loop.run_in_executor(pool, _post, transport, body)
+            validation = pyd.validate_response("GetVideoComments", raw)
+
+            if isinstance(validation, pyd.GetVideoCommentsResponse):
+                comments = validation.data.getVideoComments
+                page_order = _newest_first(comments)
+                if page_order is not None and ordered is not False:
+                    ordered = page_order
+                for comment in comments:
+                    if newest_comment is None or comment.createdAt > newest_comment.createdAt:
+                        newest_comment = comment
+
+                if (probing and comments and
+                        comments[0].id == state["newestCommentId"]):
+                    logger.info("[%s] unchanged since last run, skipping",
+                                video_id)
+                    return new_comments, True
+
+                logger.info("[%s] fetched %d comments @ offset %d",
+                            video_id, len(comments), offset)
+                added, updated = dbutils.add_comments(cur, video_id, comments)
+                new_comments += added
+                checkpoint.advance(video_id, offset + limit)
+
+                # Don't need to query the next page if this is not full
+                if len(comments) < limit:
+                    break
+
+                # Everything after this page is already stored
+                if state is not None and updated > 0 and ordered:
+                    logger.info("[%s] reached stored comments @ offset %d",
+                                video_id, offset)
+                    break
+
+            else:
+                logger.error("[%s] @ offset %d contains error",
+                             video_id, offset)
+                dlq.enqueue(cur, "comment", video_id, offset,
+                            validation.errors[0].message)
+                logger.error(
+                    "[%s] failed fetching comments after 3 retries", video_id)
+                return new_comments, False
+
+        except (requests.RequestException, requests.HTTPError) as e:
+            if retries < 2:
+                retries += 1
+                metrics.increment("retries")
+                logger.warning("[%s] retry %d/3 due to %s",
+                               video_id, retries, e)
+                continue
+
+            dlq.enqueue(cur, "comment", video_id, offset, e)
+            logger.error(
+                "[%s] failed fetching comments after 3 retries", video_id)
+            return new_comments, False
+
+        except ValidationError:
+            logger.error("[%s] malformed response @ offset %d",
+                         video_id, offset)
+            return new_comments, False
+
+        offset += limit
+        limit = conf.LIMIT
+
+    # video.commentCount is recomputed by dbutils.rollup_videos at the end of the run
+    dbutils.set_crawl_state(cur, video_id, newest_comment if ordered else None,
+                            meta_hash)
+
+    return new_comments, False
+
+
+async def _run_video(cur, transport, loop, pool, checkpoint, video, position, total):
+    """Fetch a single video and mark it done
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param loop: Running event loop
+    :param pool: Thread pool used for the blocking requests
+    :param checkpoint: Checkpoint of the current run
+    :param video: Work item with the video id, meta hash and crawl state
+    :param position: Position of the video in the work list
+    :param total: Total number of videos in the work list
+    """
+    video_id = video[0]
+    start_offset = checkpoint.pending(video_id)
+    if start_offset is None:
+        return 0, False
+
+    logger.info("[%s] fetching comments (%d/%d)", video_id, position, total)
+    result = await _fetch_video_comments(cur, transport, loop, pool,
+                                         checkpoint, video, start_offset)
+    checkpoint.complete(video_id)
+    return result
+
+
+async def _fetch_all_comments(cur, transport, checkpoint, work, total, concurrency):
+    """Fetch the videos of the work list with a fixed number of workers
+
+    Every worker takes the next video from the shared work iterator, so only
+    the videos in flight are held in memory.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param work: Iterator of (video id, meta hash, crawl state) work items
+    :param total: Number of items of the work iterator, for the progress log
+    :param concurrency: Maximum number of videos fetched at the same time
+    """
+    loop = asyncio.get_running_loop()
+    positions = itertools.count(1)
+    totals = [0, 0]
+
+    async def worker():
+        # next() of the work iterator runs on the loop thread between two awaits
+        for video in work:
+            new, skipped = await _run_video(cur, transport, loop, pool, checkpoint,
+                                            video, next(positions), total)
+            totals[0] += new
+            totals[1] += skipped
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return totals[0], totals[1]
+
+
+def fetch_all_comments(cur, transport, checkpoint, reader, meta_hashes,
+                       incremental=True, concurrency=None):
+    """Fetch the comments for every stored video
+
+    The videos are streamed from the database in keyset pages through the
+    read-only connection. Videos that the checkpoint marks as done are
+    skipped, and videos that were interrupted continue from their pending
+    offset.
+
+    Returns a tuple of (new comments, skipped videos).
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param reader: Read-only SQLite connection obj (Publisher.open_reader)
+    :param meta_hashes: Dict of video id to the fingerprint of this run's metadata
+    :param incremental: Use the stored crawl state to stop early or skip videos
+    :param concurrency: Number of videos in flight, defaults to conf.COMMENT_CONCURRENCY
+    """
+    if concurrency is None:
+        concurrency = conf.COMMENT_CONCURRENCY
+    work = ((video_id, meta_hashes.get(video_id), state)
+            for video_id, state in dbutils.iter_videos(reader, incremental))
+    return asyncio.run(_fetch_all_comments(cur, transport, checkpoint, work,
+                                           dbutils.count_videos(reader),
+                                           max(1, concurrency)))
@@ -45,4 +45,53 @@ def get_comment_replies_request_body(comment_id, limit, offset):
     """
     return {"operationName": "GetCommentReplies",
             "variables": {"id": comment_id, "limit": limit, "offset": offset},
-            "query": "query GetCommentReplies($id: String!, $limit: Float, $offset: Float) {\n  getCommentReplies(id: $id, limit: $limit, offset: $offset) {\n    ...VideoComment\n    replyTo {\n      _id\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment VideoComment on Comment {\n  _id\n  content\n  liked\n  user {\n    _id\n    username\n    __typename\n  }\n  voteCount {\n    positive\n    __typename\n  }\n  linkedUser {\n    _id\n    username\n    __typename\n  }\n  createdAt\n  __typename\n}\n"}
+            "query": "query GetCommentReplies($id: String!, $limit: Float, $offset: Float) {\n  getCommentReplies(id: $id, limit: $limit, offset: $offset) {\n    ...VideoComment\n    replyTo {\n      _id\n      replyCount\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment VideoComment on Comment {\n  _id\n  content\n  liked\n  user {\n    _id\n    username\n    __typename\n  }\n  voteCount {\n    positive\n    __typename\n  }\n  linkedUser {\n    _id\n    username\n    __typename\n  }\n  createdAt\n  __typename\n}\n"}
+
+
+def get_batched_comment_replies_request_body(comment_ids, limit, offset):
+    """
+    Docstring for getBatchedRepliesRequestBody
+
+    Packs one aliased getCommentReplies field per comment into a single query,
+    the replies of comment_ids[n] are returned under the alias "r{n}".
+
+    :param comment_ids: Ids of the comments that are queried
+    :param limit: Limit for the response size of every comment
+    :param offset: Offset for the query of every comment
+    """
+    variables = {"limit": limit, "offset": offset}
+    params = []
+    fields = []
+    for n, comment_id in enumerate(comment_ids):
+        variables[f"id{n}"] = comment_id
+        params.append(f"$id{n}: String!")
+        fields.append(f"r{n}: getCommentReplies(id: $id{n}, limit: $limit, offset: $offset) {{ ...VideoComment replyTo {{ _id replyCount __typename }} __typename }}")
+    return {"operationName": "GetCommentRepliesBatch",
+            "variables": variables,
+            "query": f"query GetCommentRepliesBatch({', '.join(params)}, $limit: Float, $offset: Float) {{ {' '.join(fields)} }} fragment VideoComment on Comment {{ _id content liked user {{ _id username __typename }} voteCount {{ positive __typename }} linkedUser {{ _id username __typename }} createdAt __typename }}"}
+
+
+def get_reply_probe_request_body(threads, limit):
+    """
+    Docstring for getReplyProbeRequestBody
+
+    Packs a probe of the head and the tail of every thread into a single query,
+    the first page of threads[n] is returned under the alias "h{n}" and the page
+    at its tail offset under "t{n}". Every reply also carries the current
+    replyCount of its comment.
+
+    :param threads: List of (comment id, offset of the tail page)
+    :param limit: Limit for the response size of every page
+    """
+    variables = {"limit": limit, "head": 0}
+    params = []
+    fields = []
+    for n, (comment_id, tail) in enumerate(threads):
+        variables[f"id{n}"] = comment_id
+        variables[f"tail{n}"] = tail
+        params.append(f"$id{n}: String!, $tail{n}: Float")
+        fields.append(f"h{n}: getCommentReplies(id: $id{n}, limit: $limit, offset: $head) {{ ...ReplyProbe }}")
+        fields.append(f"t{n}: getCommentReplies(id: $id{n}, limit: $limit, offset: $tail{n}) {{ ...ReplyProbe }}")
+    return {"operationName": "GetCommentReplyProbe",
+            "variables": variables,
+            "query": f"query GetCommentReplyProbe({', '.join(params)}, $limit: Float, $head: Float) {{ {' '.join(fields)} }} fragment ReplyProbe on Comment {{ _id createdAt replyTo {{ _id replyCount __typename }} __typename }}"}
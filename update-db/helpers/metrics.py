@@ -0,0 +1,305 @@
+"""
+Run metrics, written as a JSON run report and a Prometheus textfile.
+
+The request, database and DLQ layers report into a process wide registry:
+
+- the transport reports every request (latency, bytes, failure),
+- dbutils reports the rows inserted and updated by every bulk write,
+- the fetch loops report retries, and dlq reports every enqueued item,
+- the checkpoint marks the start and end of every phase.
+
+Everything is accounted to the phase that is running. At the end of a run,
+write_report() stores the JSON report and the Prometheus textfile, so
+monitoring can alert when a run slows down or the DLQ grows.
+"""
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Prefix of every Prometheus metric
+_PREFIX = "update_db"
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram with interpolated quantiles.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add a value
+
+        :param value: Observed value
+        """
+        self.count += 1
+        self.sum += value
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """Estimated quantile, interpolated within its bucket
+
+        :param q: Quantile between 0 and 1
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for n, bound in enumerate(self.buckets):
+            if seen + self.counts[n] >= rank:
+                return lower + (bound - lower) * (rank - seen) / self.counts[n]
+            seen += self.counts[n]
+            lower = bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        """Quantiles and totals of the histogram"""
+        return {"count": self.count, "sum": self.sum,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99)}
+
+
+class PhaseMetrics:
+    """
+    Metrics of a single crawl phase.
+    """
+
+    def __init__(self):
+        self.wall = 0.0
+        self.started = None
+        self.requests = 0
+        self.failed = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.latency = Histogram()
+        self.rows = {}
+        self.counters = {}
+
+    def to_dict(self):
+        """Report of the phase"""
+        return {"wall_seconds": self.wall, "requests": self.requests,
+                "failed_requests": self.failed, "wire_bytes": self.wire_bytes,
+                "body_bytes": self.body_bytes, "latency": self.latency.to_dict(),
+                "rows": self.rows, **self.counters}
+
+
+class Registry:
+    """
+    Process wide metrics of a run, grouped per phase.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.gauges = {}
+        self.current = "setup"
+        self._lock = threading.Lock()
+
+    def _phase(self, name=None):
+        """Metrics of a phase, created on first use, called with the lock held"""
+        name = name or self.current
+        if name not in self.phases:
+            self.phases[name] = PhaseMetrics()
+        return self.phases[name]
+
+    def start_phase(self, name):
+        """Start the wall clock of a phase and account everything to it
+
+        :param name: Name of the phase
+        """
+        with self._lock:
+            self.current = name
+            self._phase(name).started = time.perf_counter()
+
+    def end_phase(self):
+        """Stop the wall clock of the current phase"""
+        with self._lock:
+            phase = self._phase()
+            if phase.started is not None:
+                phase.wall += time.perf_counter() - phase.started
+                phase.started = None
+
+    def observe_request(self, phase, latency, wire_bytes, body_bytes, failed):
+        """Record a finished request
+
+        :param phase: Name of the phase that sent the request
+        :param latency: Request latency in seconds
+        :param wire_bytes: Bytes received over the wire
+        :param body_bytes: Bytes of the decoded response body
+        :param failed: True if the request raised or returned an error status
+        """
+        with self._lock:
+            metrics = self._phase(phase)
+            metrics.requests += 1
+            metrics.failed += int(failed)
+            metrics.wire_bytes += wire_bytes
+            metrics.body_bytes += body_bytes
+            metrics.latency.observe(latency)
+
+    def record_rows(self, table, inserted, updated):
+        """Record the rows written by a bulk write
+
+        :param table: Name of the table
+        :param inserted: Number of new rows
+        :param updated: Number of existing rows that were updated
+        """
+        with self._lock:
+            rows = self._phase().rows.setdefault(table, {"inserted": 0, "updated": 0})
+            rows["inserted"] += inserted
+            rows["updated"] += updated
+
+    def increment(self, name, amount=1):
+        """Add to a counter of the current phase, e.g. retries
+
+        :param name: Name of the counter
+        :param amount: Amount to add
+        """
+        with self._lock:
+            counters = self._phase().counters
+            counters[name] = counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set a run level value, e.g. the DLQ size
+
+        :param name: Name of the gauge
+        :param value: Current value
+        :param labels: Prometheus labels of the value
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def report(self):
+        """The run report as a dict"""
+        with self._lock:
+            gauges = {}
+            for (name, labels), value in self.gauges.items():
+                key = name + "".join(f"[{v}]" for _, v in labels)
+                gauges[key] = value
+            return {"started": self.started,
+                    "duration_seconds": time.time() - self.started,
+                    "phases": {name: phase.to_dict()
+                               for name, phase in self.phases.items()},
+                    "gauges": gauges}
+
+    def prometheus(self):
+        """The run metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help_text, samples, series=None):
+            lines.append(f"# HELP {_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{_PREFIX}_{series or name}{{{label_text}}} {value}")
+
+        with self._lock:
+            phases = sorted(self.phases.items())
+            metric("phase_duration_seconds", "gauge", "Wall time of the phase",
+                   [((("phase", n),), p.wall) for n, p in phases])
+            metric("requests_total", "counter", "Requests sent",
+                   [((("phase", n),), p.requests) for n, p in phases])
+            metric("request_errors_total", "counter", "Requests that failed",
+                   [((("phase", n),), p.failed) for n, p in phases])
+            metric("received_bytes_total", "counter", "Bytes received over the wire",
+                   [((("phase", n),), p.wire_bytes) for n, p in phases])
+
+            samples = []
+            for n, p in phases:
+                cumulative = 0
+                for bound, count in zip(p.latency.buckets, p.latency.counts):
+                    cumulative += count
+                    samples.append(((("phase", n), ("le", bound)), cumulative))
+                samples.append(((("phase", n), ("le", "+Inf")), p.latency.count))
+            metric("request_duration_seconds", "histogram", "Request latency",
+                   samples, series="request_duration_seconds_bucket")
+            lines += [f'{_PREFIX}_request_duration_seconds_sum{{phase="{n}"}} '
+                      f'{p.latency.sum}' for n, p in phases]
+            lines += [f'{_PREFIX}_request_duration_seconds_count{{phase="{n}"}} '
+                      f'{p.latency.count}' for n, p in phases]
+
+            metric("rows_total", "counter", "Rows written to the database",
+                   [((("phase", n), ("table", t), ("action", a)), c)
+                    for n, p in phases for t, rows in sorted(p.rows.items())
+                    for a, c in rows.items()])
+            counters = sorted({c for _, p in phases for c in p.counters})
+            for counter in counters:
+                metric(f"{counter}_total", "counter", f"Number of {counter}",
+                       [((("phase", n),), p.counters.get(counter, 0))
+                        for n, p in phases])
+
+            gauges = {}
+            for (name, labels), value in sorted(self.gauges.items()):
+                gauges.setdefault(name, []).append((labels, value))
+            for name, samples in gauges.items():
+                metric(name, "gauge", name.replace("_", " ").capitalize(), samples)
+            metric("last_run_timestamp_seconds", "gauge",
+                   "End time of the last run", [((), time.time())])
+            metric("run_duration_seconds", "gauge", "Wall time of the last run",
+                   [((), time.time() - self.started)])
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def start_phase(name):
+    """Start accounting to a phase, see Registry.start_phase"""
+    REGISTRY.start_phase(name)
+
+
+def end_phase():
+    """Stop the wall clock of the current phase"""
+    REGISTRY.end_phase()
+
+
+def observe_request(phase, latency, wire_bytes, body_bytes, failed):
+    """Record a finished request, see Registry.observe_request"""
+    REGISTRY.observe_request(phase, latency, wire_bytes, body_bytes, failed)
+
+
+def record_rows(table, inserted, updated):
+    """Record the rows of a bulk write, see Registry.record_rows"""
+    REGISTRY.record_rows(table, inserted, updated)
+
+
+def increment(name, amount=1):
+    """Add to a counter of the current phase, see Registry.increment"""
+    REGISTRY.increment(name, amount)
+
+
+def set_gauge(name, value, **labels):
+    """Set a run level value, see Registry.set_gauge"""
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def write_report(json_path, prometheus_path=None):
+    """Write the JSON run report and the Prometheus textfile
+
+    The textfile is replaced atomically, so a collector never reads half of it.
+
+    :param json_path: Path of the JSON run report
+    :param prometheus_path: Path of the Prometheus textfile, None to skip it
+    """
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    with open(json_path, "w", encoding="UTF-8") as file:
+        json.dump(REGISTRY.report(), file, indent=2)
+
+    if prometheus_path:
+        os.makedirs(os.path.dirname(prometheus_path), exist_ok=True)
+        with open(f"{prometheus_path}.tmp", "w", encoding="UTF-8") as file:
+            file.write(REGISTRY.prometheus())
+        os.replace(f"{prometheus_path}.tmp", prometheus_path)
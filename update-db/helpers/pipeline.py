@@ -0,0 +1,246 @@
+"""
+Staged producer/consumer pipeline for paged fetches.
+
+A pipeline is made of three stages connected by bounded queues:
+
+- fetch workers POST the request of a page and hand over the raw response,
+- validation workers parse the response and schedule the next page of the
+  item while the current one is written,
+- a single writer thread owns the SQLite connection, writes every page and
+  commits in batches of WRITER_COMMIT_EVERY pages.
+
+The number of items in flight is bounded by the queue size, so a slow stage
+fills its input queue and blocks the stage before it. The depth of every
+queue is sampled for the run summary to show which stage is the bottleneck.
+"""
+import logging
+import queue
+import threading
+import time
+
+import requests
+
+import config as conf
+from helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the work for a stage worker
+_STOP = object()
+
+# Seconds between two depth reports in the log
+_REPORT_INTERVAL = 10
+
+
+class StageStats:
+    """
+    Sampled depth of the input queue of a stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def sample(self, depth):
+        """Record the current depth of the queue
+
+        :param depth: Number of queued jobs
+        """
+        self.samples += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        """One line summary of the queue depth"""
+        avg = self.total_depth / self.samples if self.samples else 0
+        return f"{self.name} queue avg {avg:.1f} / max {self.max_depth}"
+
+
+class Pipeline:
+    """
+    Pages through many items with fetch workers, validation workers and a
+    single writer thread.
+
+    The stage functions are:
+
+    - fetch(item_id, offset): returns the raw response of a page, raises
+      requests.RequestException on transport errors (retried three times)
+    - validate(item_id, offset, raw): returns the list of items of the page,
+      raises on error responses
+    - write(cur, item_id, offset, items, last): stores a page, called on the
+      writer thread, last is True for the final page of the item
+    - fail(cur, item_id, offset, error): called on the writer thread when
+      a page of the item could not be fetched or validated
+    """
+
+    def __init__(self, con, fetch, validate, write, fail, limit,
+                 fetch_workers=None, validate_workers=None,
+                 queue_size=None, commit_every=None):
+        self.con = con
+        self.fetch = fetch
+        self.validate = validate
+        self.write = write
+        self.fail = fail
+        self.limit = limit
+        self.fetch_workers = fetch_workers or conf.PIPELINE_FETCH_WORKERS
+        self.validate_workers = validate_workers or conf.PIPELINE_VALIDATE_WORKERS
+        self.queue_size = queue_size or conf.PIPELINE_QUEUE_SIZE
+        self.commit_every = commit_every or conf.WRITER_COMMIT_EVERY
+
+        # The fetch queue holds at most one page per item in flight, so pages
+        # scheduled by the validation stage never block on it
+        self.fetch_queue = queue.Queue(maxsize=self.queue_size)
+        self.validate_queue = queue.Queue(maxsize=self.queue_size)
+        self.write_queue = queue.Queue(maxsize=self.queue_size)
+        self.stats = {name: StageStats(name)
+                      for name in ("fetch", "validate", "write")}
+
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self._error = None
+        self.pages = 0
+        self.commits = 0
+
+    def depths(self):
+        """Current number of queued jobs per stage"""
+        return {"fetch": self.fetch_queue.qsize(),
+                "validate": self.validate_queue.qsize(),
+                "write": self.write_queue.qsize()}
+
+    def run(self, jobs):
+        """Fetch every item, blocks until all of them are written
+
+        :param jobs: Iterable of (item id, start offset)
+        """
+        threads = [threading.Thread(target=self._fetch_worker, daemon=True)
+                   for _ in range(self.fetch_workers)]
+        threads += [threading.Thread(target=self._validate_worker, daemon=True)
+                    for _ in range(self.validate_workers)]
+        writer = threading.Thread(target=self._writer, daemon=True)
+        for thread in threads + [writer]:
+            thread.start()
+
+        last_report = time.monotonic()
+        for item_id, offset in jobs:
+            # Blocks while the pipeline is full
+            self._slots.acquire()
+            with self._idle:
+                self._in_flight += 1
+            self.stats["fetch"].sample(self.fetch_queue.qsize())
+            self.fetch_queue.put((item_id, offset))
+            if time.monotonic() - last_report >= _REPORT_INTERVAL:
+                last_report = time.monotonic()
+                logger.info("Pipeline depths: %s", self.depths())
+
+        with self._idle:
+            while self._in_flight:
+                self._idle.wait()
+
+        for _ in range(self.fetch_workers):
+            self.fetch_queue.put(_STOP)
+        for _ in range(self.validate_workers):
+            self.validate_queue.put(_STOP)
+        self.write_queue.put(_STOP)
+        for thread in threads + [writer]:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+        logger.info("Pipeline wrote %d pages in %d commits",
+                    self.pages, self.commits)
+
+    def _fetch_worker(self):
+        """Fetch stage, retries transport errors three times"""
+        while True:
+            job = self.fetch_queue.get()
+            if job is _STOP:
+                return
+            item_id, offset = job
+            for retries in range(3):
+                try:
+                    raw = self.fetch(item_id, offset)
+                except requests.RequestException as e:
+                    if retries < 2:
+                        metrics.increment("retries")
+                        logger.warning("[%s] retry %d/3 due to %s",
+                                       item_id, retries + 1, e)
+                        continue
+                    self._put_write(("fail", item_id, offset, e))
+                    break
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    self._put_write(("fail", item_id, offset, e))
+                    break
+                self.stats["validate"].sample(self.validate_queue.qsize())
+                self.validate_queue.put((item_id, offset, raw))
+                break
+
+    def _validate_worker(self):
+        """Validation stage, schedules the next page of full pages"""
+        while True:
+            job = self.validate_queue.get()
+            if job is _STOP:
+                return
+            item_id, offset, raw = job
+            try:
+                items = self.validate(item_id, offset, raw)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self._put_write(("fail", item_id, offset, e))
+                continue
+
+            last = len(items) < self.limit
+            self._put_write(("page", item_id, offset, items, last))
+            if not last:
+                self.stats["fetch"].sample(self.fetch_queue.qsize())
+                self.fetch_queue.put((item_id, offset + self.limit))
+
+    def _put_write(self, job):
+        """Queue a job for the writer, blocks while the writer is behind
+
+        :param job: Page or failure of an item
+        """
+        self.stats["write"].sample(self.write_queue.qsize())
+        self.write_queue.put(job)
+
+    def _writer(self):
+        """Writer stage, the only thread that uses the connection"""
+        cur = self.con.cursor()
+        pending = 0
+        while True:
+            job = self.write_queue.get()
+            if job is _STOP:
+                break
+
+            done = job[0] == "fail" or job[4]
+            if self._error is None:
+                try:
+                    if job[0] == "page":
+                        self.write(cur, *job[1:])
+                        self.pages += 1
+                        pending += 1
+                    else:
+                        self.fail(cur, *job[1:])
+                    if pending >= self.commit_every:
+                        self.con.commit()
+                        self.commits += 1
+                        pending = 0
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # Keep draining the queues so the other stages can stop
+                    logger.error("Writer failed: %s", e)
+                    self._error = e
+
+            if done:
+                self._slots.release()
+                with self._idle:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+
+        if self._error is None:
+            self.con.commit()
+            self.commits += 1
+
+    def summary(self):
+        """One line summary of the sampled queue depths"""
+        return ", ".join(stats.summary() for stats in self.stats.values())
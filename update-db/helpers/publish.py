@@ -0,0 +1,208 @@
+"""
+Opening and publishing the database that a run writes to.
+
+Two modes are supported, selected with conf.PUBLISH_MODE:
+
+- "wal", the default: the run writes straight into store.db in WAL mode, as a
+  single write transaction. No copy is made, only the pages the run changes
+  are written to the WAL. The viewer keeps reading the last published state
+  during the crawl, and the one commit in Publisher.commit makes the finished
+  run visible atomically. An interrupted run is rolled back, so it cannot be
+  resumed.
+- "backup": the run writes to temp.db, which is created with the sqlite3
+  online backup API, and is published back into store.db with the same API in
+  a single write transaction. This costs two full copies, but the run commits
+  its checkpoints as it goes and can be resumed.
+
+A --replay run uses the "replay" mode: it works on a scratch copy, replay.db,
+of the database the recorded run started from (see replay.start_db_path), which
+is left in place for inspection and never published.
+
+Copy time and peak disk usage of the database files are measured for the
+run summary.
+"""
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+
+import config as conf
+
+logger = logging.getLogger(__name__)
+
+# Files SQLite may create next to a database
+_SIDECARS = ("", "-wal", "-shm", "-journal")
+
+
+class _RunConnection(sqlite3.Connection):
+    """
+    Connection of a "wal" run. The whole run is a single write transaction,
+    the commits of the crawl (checkpoints, pipeline writer) are held back
+    until Publisher.commit releases the transaction.
+    """
+    held = False
+
+    def commit(self):
+        if not self.held:
+            super().commit()
+
+
+class Publisher:
+    """
+    Opens the working database of a run and publishes it when the run is done.
+    """
+
+    def __init__(self, mode=None, source=None):
+        self.mode = mode or conf.PUBLISH_MODE
+        if self.mode not in ("wal", "backup", "replay"):
+            raise ValueError(f"Unknown publish mode: {self.mode}")
+        self.path = {"wal": conf.MAIN_DB_PATH, "backup": conf.TEMP_DB_PATH,
+                     "replay": conf.REPLAY_DB_PATH}[self.mode]
+        # Database the working copy is made from
+        self.source = source or conf.MAIN_DB_PATH
+        # Runs on a scratch database never reach store.db or the snapshots
+        self.publishes = self.mode != "replay"
+        # A "wal" run commits nothing before it is done, so it has no checkpoints
+        self.resumable = self.mode != "wal"
+        self.con = None
+        self.copy_seconds = 0.0
+        self.peak_bytes = 0
+
+    def open(self, resume):
+        """Open the working database, returns an SQLite connection obj
+
+        :param resume: Continue on the existing working database
+        """
+        if self.mode != "wal":
+            name = os.path.basename(self.path)
+            if resume:
+                if not os.path.exists(self.path):
+                    raise FileNotFoundError(self.path)
+                logger.info("Resuming on existing database: %s", name)
+            else:
+                if not os.path.exists(self.source):
+                    logger.warning("%s not found, copying store.db instead", self.source)
+                    self.source = conf.MAIN_DB_PATH
+                self._copy(self.source, self.path)
+                logger.info("Backed up database: %s → %s in %.1fs",
+                            os.path.basename(self.source), name, self.copy_seconds)
+
+        # The connection is handed to the pipeline writer thread (see pipeline)
+        if self.mode == "wal":
+            con = sqlite3.connect(self.path, check_same_thread=False,
+                                  factory=_RunConnection)
+            con.execute("PRAGMA journal_mode = WAL")
+            # Taken up front, so the schema migration is part of the run as well
+            con.execute("BEGIN IMMEDIATE")
+            con.held = True
+            logger.info("Writing to store.db in WAL mode, in a single transaction")
+        else:
+            con = sqlite3.connect(self.path, check_same_thread=False)
+        self.con = con
+        self.sample_disk()
+        return con
+
+    def open_reader(self):
+        """Open a connection the work lists are read through
+
+        The work lists of the comment and reply phases are read through it in
+        keyset pages (see dbutils.iter_videos), every page in a statement of
+        its own. It is a read-only connection that only sees committed rows,
+        except for a "wal" run: nothing is committed before the run is done,
+        so the run connection itself is returned.
+        """
+        if self.mode == "wal":
+            return self.con
+        uri = f"{pathlib.Path(self.path).absolute().as_uri()}?mode=ro"
+        return sqlite3.connect(uri, uri=True)
+
+    def close_reader(self, reader):
+        """Close a connection returned by open_reader
+
+        :param reader: SQLite connection obj returned by open_reader
+        """
+        if reader is not self.con:
+            reader.close()
+
+    def save_copy(self, path):
+        """Save a copy of store.db as it is before the run, e.g. the database a
+        recorded run starts from
+
+        :param path: Path of the copy
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._copy(conf.MAIN_DB_PATH, path)
+        logger.info("Saved store.db as %s", path)
+
+    def commit(self, con):
+        """Commit everything the run wrote
+
+        For a "wal" run this is the one commit of the run, which makes it
+        visible to the viewer atomically. Later commits are not held back.
+
+        :param con: SQLite connection obj of the working database
+        """
+        if self.mode == "wal":
+            con.held = False
+        con.commit()
+
+    def publish(self, con):
+        """Make the finished run visible and close the connection
+
+        :param con: SQLite connection obj of the working database
+        """
+        self.commit(con)
+        self.sample_disk()
+        if self.mode == "wal":
+            # Fold the WAL back into store.db so the file is complete on its own
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            con.close()
+            logger.info("Database published in place (store.db)")
+            return
+
+        if not self.publishes:
+            con.close()
+            logger.info("Replay run kept in %s, store.db is not touched",
+                        os.path.basename(self.path))
+            return
+
+        con.close()
+        self._copy(conf.TEMP_DB_PATH, conf.MAIN_DB_PATH)
+        os.remove(conf.TEMP_DB_PATH)
+        logger.info("Database published (temp.db → store.db) in %.1fs",
+                    self.copy_seconds)
+
+    def _copy(self, src_path, dst_path):
+        """Copy a database with the online backup API
+
+        :param src_path: Path of the database to copy
+        :param dst_path: Path of the database to overwrite
+        """
+        start = time.perf_counter()
+        src = sqlite3.connect(src_path)
+        dst = sqlite3.connect(dst_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        self.copy_seconds += time.perf_counter() - start
+        self.sample_disk()
+
+    def sample_disk(self):
+        """Record the current size of all database files, keeps the peak"""
+        total = 0
+        for path in {conf.MAIN_DB_PATH, self.path}:
+            for suffix in _SIDECARS:
+                try:
+                    total += os.path.getsize(path + suffix)
+                except OSError:
+                    pass
+        self.peak_bytes = max(self.peak_bytes, total)
+        return total
+
+    def summary(self):
+        """One line summary of the publish cost"""
+        return (f"{self.mode}, copy time {self.copy_seconds:.1f}s, "
+                f"peak disk usage {self.peak_bytes / 1e6:.1f} MB")
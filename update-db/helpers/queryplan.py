@@ -0,0 +1,190 @@
+"""
+Query plan report of the viewer's queries.
+
+Loads the checked-in list of viewer queries (viewer_queries.sql), fills their
+parameters with sample values from the database, and reports for each one its
+EXPLAIN QUERY PLAN, the time it takes and what makes it slow:
+
+- a full scan of a table (SCAN without an index),
+- a temp B-tree, i.e. a sort or DISTINCT that no index delivers.
+
+A flagged query that also takes longer than SLOW_QUERY_MS is reported as
+slow. A run writes the report to conf.PLAN_REPORT_FILE, and maintenance.py
+query-plans prints it for any database. time_inserts measures the write side
+of the indexes, the cost of inserting comments and replies like a crawl does.
+"""
+import logging
+import os
+import re
+import time
+
+import config as conf
+
+logger = logging.getLogger(__name__)
+
+# A flagged query that takes longer than this is reported as slow
+SLOW_QUERY_MS = 50
+
+# "-- name:" header that starts every query of the list
+_NAME = re.compile(r"^--\s*name:\s*(.+)$", re.MULTILINE)
+
+# Rows of each table inserted by time_inserts
+INSERT_ROWS = 10000
+
+# Values of the parameters that do not come from the database
+_FIXED_PARAMS = {"limit": 20, "offset": 0}
+
+
+def load_queries(path=None):
+    """List of (name, sql) of the viewer queries
+
+    :param path: Path of the query list, conf.VIEWER_QUERIES_PATH by default
+    """
+    with open(path or conf.VIEWER_QUERIES_PATH, encoding="UTF-8") as file:
+        text = file.read()
+    parts = _NAME.split(text)
+    # parts is [preamble, name, sql, name, sql, ...]
+    queries = []
+    for name, body in zip(parts[1::2], parts[2::2]):
+        sql = "\n".join(line for line in body.splitlines()
+                        if not line.lstrip().startswith("--")).strip().rstrip(";")
+        queries.append((name.strip(), sql))
+    return queries
+
+
+def sample_params(cur):
+    """Sample values of the named query parameters, taken from the database
+
+    :param cur: SQLite cursor obj
+    """
+    params = dict(_FIXED_PARAMS)
+    cur.execute("SELECT id FROM video ORDER BY commentCount DESC LIMIT 1")
+    row = cur.fetchone()
+    params["videoId"] = row[0] if row else None
+    cur.execute("SELECT userId FROM user_stats ORDER BY commentCount DESC LIMIT 1")
+    row = cur.fetchone()
+    params["userId"] = row[0] if row else None
+    cur.execute("SELECT id FROM comment_v2 ORDER BY storedReplies DESC LIMIT 1")
+    row = cur.fetchone()
+    params["commentId"] = row[0] if row else None
+    cur.execute("SELECT id FROM reply_v2 LIMIT 1")
+    row = cur.fetchone()
+    params["replyId"] = row[0] if row else None
+    cur.execute("SELECT id FROM channel ORDER BY videoCount DESC LIMIT 1")
+    row = cur.fetchone()
+    params["channelId"] = row[0] if row else None
+    cur.execute("SELECT content FROM comment_v2 ORDER BY createdAt DESC LIMIT 1")
+    row = cur.fetchone()
+    words = sorted(re.findall(r"\w{3,}", row[0] or "") if row else [], key=len)
+    params["search"] = words[-1] if words else "the"
+    return params
+
+
+def _flags(plan):
+    """What makes a plan slow, as a list of short descriptions
+
+    :param plan: Detail lines of EXPLAIN QUERY PLAN
+    """
+    flags = []
+    for detail in plan:
+        if detail.startswith("USE TEMP B-TREE"):
+            flags.append(detail.lower().replace("use ", ""))
+        elif (detail.startswith("SCAN ") and " USING " not in detail
+              and "VIRTUAL TABLE" not in detail and "CONSTANT ROW" not in detail):
+            flags.append(f"full scan of {detail.split()[1]}")
+    return flags
+
+
+def explain(cur, name, sql, params):
+    """Plan, flags and timing of a query, as a dict
+
+    :param cur: SQLite cursor obj
+    :param name: Name of the query
+    :param sql: SQL of the query
+    :param params: Dict of named parameters, see sample_params
+    """
+    cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    plan = [row[3] for row in cur.fetchall()]
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    rows = len(cur.fetchall())
+    elapsed = (time.perf_counter() - start) * 1000
+    flags = _flags(plan)
+    return {"name": name, "plan": plan, "flags": flags, "ms": elapsed, "rows": rows,
+            "slow": bool(flags) and elapsed >= SLOW_QUERY_MS}
+
+
+def check_queries(cur, path=None):
+    """Explain and time every viewer query, returns a list of results
+
+    :param cur: SQLite cursor obj
+    :param path: Path of the query list, conf.VIEWER_QUERIES_PATH by default
+    """
+    params = sample_params(cur)
+    return [explain(cur, name, sql, params) for name, sql in load_queries(path)]
+
+
+def time_inserts(cur, rows=INSERT_ROWS):
+    """Seconds it takes to insert comments and replies, as a dict of table to
+    (rows, seconds)
+
+    Existing rows are copied under new ids, so the indexed values are real
+    ones, and the triggers of the tables fire like in a crawl. Run it in a
+    transaction that is rolled back afterwards.
+
+    :param cur: SQLite cursor obj
+    :param rows: Rows to insert into each table, fewer if the table has fewer
+    """
+    columns = {
+        "comment_v2": "videoId, content, userKey, linkedUserKey, posVotes, createdAt, "
+                      "replyCount, storedReplies",
+        "reply_v2": "content, liked, userKey, voteCount, linkedUserKey, createdAt, replyTo",
+    }
+    timings = {}
+    for table, names in columns.items():
+        start = time.perf_counter()
+        cur.execute(f"""
+            INSERT INTO {table} (id, {names})
+            SELECT 'insert-cost-' || id, {names} FROM {table} LIMIT ?
+        """, (rows,))
+        timings[table] = (cur.rowcount, time.perf_counter() - start)
+    return timings
+
+
+def format_report(results):
+    """The results as a Markdown report
+
+    :param results: List of results of check_queries
+    """
+    slow = [result for result in results if result["slow"]]
+    lines = ["# Viewer query plans", "",
+             f"{len(results)} queries, {len(slow)} slow "
+             f"(flagged and over {SLOW_QUERY_MS} ms)", "",
+             "| Query | Time (ms) | Rows | Flags |", "|---|---|---|---|"]
+    for result in results:
+        name = f"**{result['name']}**" if result["slow"] else result["name"]
+        lines.append(f"| {name} | {result['ms']:.1f} | {result['rows']} "
+                     f"| {', '.join(result['flags'])} |")
+    for result in results:
+        lines += ["", f"## {result['name']}", "", "```"] + result["plan"] + ["```"]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(cur, path=None):
+    """Check the viewer queries, write the report and log the slow ones
+
+    Returns the number of slow queries.
+
+    :param cur: SQLite cursor obj
+    :param path: Path of the report, conf.PLAN_REPORT_FILE by default
+    """
+    path = path or conf.PLAN_REPORT_FILE
+    results = check_queries(cur)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="UTF-8") as file:
+        file.write(format_report(results))
+    slow = [result for result in results if result["slow"]]
+    for result in slow:
+        logger.warning("Slow viewer query %s: %.0f ms, %s", result["name"],
+                       result["ms"], ", ".join(result["flags"]))
+    return len(slow)
@@ -0,0 +1,235 @@
+"""
+Adaptive concurrency and rate control for requests to conf.HOST.
+
+Two limits are applied to every request of the transport:
+
+- an AIMD (additive increase, multiplicative decrease) window bounds the
+  number of requests in flight. It grows by AIMD_INCREASE per window of
+  successful requests, and is multiplied by AIMD_DECREASE on HTTP 429/5xx,
+  timeouts and latency spikes,
+- a token bucket bounds the number of requests per second. Its rate is
+  adapted the same way on HTTP 429, between RATE_MIN and RATE_LIMIT, and a
+  Retry-After header pauses it for the requested time.
+
+A congestion signal only shrinks the window once per round trip, responses of
+requests sent before the last decrease are ignored.
+"""
+import logging
+import threading
+import time
+
+import config as conf
+
+logger = logging.getLogger(__name__)
+
+# Response outcomes reported to the controller
+OK = "ok"
+THROTTLED = "throttled"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+# Seconds between two window reports in the log
+_REPORT_INTERVAL = 30
+
+
+class TokenBucket:
+    """
+    Requests per second limit, refilled continuously.
+    """
+
+    def __init__(self, rate, burst, minimum=None):
+        self.rate = rate
+        self.limit = rate
+        self.minimum = minimum or conf.RATE_MIN
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeps until one is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate <= 0:
+                        return
+                    self.tokens = min(self.burst,
+                                      self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adapt(self, throttled, increase, decrease):
+        """Grow the rate after a success, shrink it after HTTP 429
+
+        :param throttled: True if the server asked to slow down
+        :param increase: Requests per second added per second of successes
+        :param decrease: Factor applied to the rate when throttled
+        """
+        if self.limit <= 0:
+            return
+        with self._lock:
+            if throttled:
+                self.rate = max(self.minimum, self.rate * decrease)
+            else:
+                self.rate = min(self.limit, self.rate + increase / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while
+
+        :param seconds: Seconds to pause, e.g. from a Retry-After header
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+
+class AimdController:
+    """
+    Number of requests allowed in flight, adapted to the health of the API.
+    """
+
+    def __init__(self, initial=None, minimum=None, maximum=None,
+                 increase=None, decrease=None, spike_factor=None):
+        self.minimum = minimum or conf.AIMD_MIN_WINDOW
+        self.maximum = maximum or conf.AIMD_MAX_WINDOW
+        self.window = float(initial or conf.AIMD_INITIAL_WINDOW)
+        self.increase = increase or conf.AIMD_INCREASE
+        self.decrease = decrease or conf.AIMD_DECREASE
+        self.spike_factor = spike_factor or conf.LATENCY_SPIKE_FACTOR
+
+        self.in_flight = 0
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.peak = self.window
+        self._last_report = time.monotonic()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot in the window, returns the send time"""
+        with self._cond:
+            while self.in_flight >= int(self.window):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, sent, latency, outcome):
+        """Free the slot of a finished request and adapt the window
+
+        Returns True if the window was decreased.
+
+        :param sent: Send time returned by acquire
+        :param latency: Latency of the request in seconds
+        :param outcome: One of OK, THROTTLED, FAILED or TIMEOUT
+        """
+        decreased = False
+        with self._cond:
+            self.in_flight -= 1
+            congested = outcome != OK or self._is_spike(latency)
+            if outcome == OK:
+                # Slow moving latency baseline of healthy responses
+                self.baseline = (latency if self.baseline is None
+                                 else 0.9 * self.baseline + 0.1 * latency)
+
+            if congested:
+                # Only react once to the requests of the same round trip
+                if sent >= self.last_decrease:
+                    self.window = max(self.minimum, self.window * self.decrease)
+                    self.last_decrease = time.monotonic()
+                    self.decreases += 1
+                    decreased = True
+                    logger.info("Backing off (%s, %.0f ms): window %d",
+                                outcome, latency * 1000, int(self.window))
+            else:
+                self.window = min(self.maximum,
+                                  self.window + self.increase / self.window)
+                self.peak = max(self.peak, self.window)
+
+            now = time.monotonic()
+            if now - self._last_report >= _REPORT_INTERVAL:
+                self._last_report = now
+                logger.info("Concurrency window %d (%d in flight)",
+                            int(self.window), self.in_flight)
+            self._cond.notify_all()
+        return decreased
+
+    def _is_spike(self, latency):
+        """True if a latency is far above the healthy baseline
+
+        :param latency: Latency of the request in seconds
+        """
+        return (self.baseline is not None and
+                latency > max(self.baseline * self.spike_factor,
+                              conf.LATENCY_SPIKE_MIN))
+
+
+class RateControl:
+    """
+    Combined window and token bucket used by the transport.
+    """
+
+    def __init__(self, controller=None, bucket=None):
+        self.controller = controller or AimdController()
+        self.bucket = bucket or TokenBucket(conf.RATE_LIMIT, conf.RATE_BURST)
+
+    def acquire(self):
+        """Wait until a request may be sent, returns the send time"""
+        sent = self.controller.acquire()
+        self.bucket.acquire()
+        return sent
+
+    def release(self, sent, latency, outcome, retry_after=None):
+        """Report the outcome of a request
+
+        :param sent: Send time returned by acquire
+        :param latency: Latency of the request in seconds
+        :param outcome: One of OK, THROTTLED, FAILED or TIMEOUT
+        :param retry_after: Seconds from a Retry-After header, if any
+        """
+        if retry_after:
+            self.bucket.pause(retry_after)
+        decreased = self.controller.release(sent, latency, outcome)
+        if outcome == THROTTLED and decreased:
+            self.bucket.adapt(True, conf.RATE_INCREASE, self.controller.decrease)
+            logger.info("Throttled: rate %.1f/s", self.bucket.rate)
+        elif outcome == OK:
+            self.bucket.adapt(False, conf.RATE_INCREASE, self.controller.decrease)
+
+    def summary(self):
+        """One line summary of the controller state"""
+        rate = f"{self.bucket.rate:.1f}/s" if self.bucket.rate > 0 else "off"
+        return (f"window {int(self.controller.window)} "
+                f"(peak {int(self.controller.peak)}), "
+                f"{self.controller.decreases} backoffs, rate limit {rate}")
+
+
+def outcome_of(status):
+    """Controller outcome of an HTTP status code
+
+    :param status: HTTP status code of the response
+    """
+    if status == 429:
+        return THROTTLED
+    if status >= 500:
+        return FAILED
+    return OK
+
+
+def retry_after(resp):
+    """Seconds to wait from the Retry-After header of a response, or None
+
+    :param resp: HTTP response
+    """
+    value = resp.headers.get("Retry-After")
+    try:
+        return min(float(value), conf.MAX_RETRY_AFTER) if value else None
+    except ValueError:
+        return None
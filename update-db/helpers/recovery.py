@@ -0,0 +1,95 @@
+"""
+Bisection-based recovery of pages that contain poisoned records.
+
+A page that the API refuses to serve is split in halves until every poisoned
+offset is isolated. The items of every good sub-range are kept as they are
+fetched, so no good item is downloaded twice, and k poisoned records in a
+window of n items cost roughly O(k log n) requests.
+"""
+import logging
+
+import config as conf
+
+logger = logging.getLogger(__name__)
+
+
+class PoisonedRange(Exception):
+    """
+    Raised by a fetch function when the API returns an error for a range.
+    """
+
+
+class InvalidId(Exception):
+    """
+    Raised by a fetch function when the API reports the id itself as invalid.
+    """
+
+
+class BisectingRecovery:
+    """
+    Pages through a list with a fetch(offset, limit) function, bisecting
+    every range that raises PoisonedRange.
+    """
+
+    def __init__(self, fetch, window=None):
+        self.fetch = fetch
+        self.window = window or conf.EXP_BACKOFF_LIMIT
+        self.requests = 0
+        self.recovered = 0
+        self.poisoned = []
+
+    def run(self, offset, on_items, on_window=None):
+        """Recover every item from offset until the end of the list
+
+        Returns the number of items recovered.
+
+        :param offset: Offset to start from
+        :param on_items: Called with (offset, items) for every good sub-range
+        :param on_window: Called with the next offset after every finished window
+        """
+        while True:
+            poisoned = len(self.poisoned)
+            recovered = self.recovered
+            end = self._bisect(offset, self.window, on_items)
+            offset += self.window
+            if on_window is not None:
+                on_window(offset)
+            if end:
+                break
+            if (self.recovered == recovered and
+                    len(self.poisoned) - poisoned == self.window):
+                logger.warning("Every offset in window @ %d is poisoned, giving up",
+                               offset - self.window)
+                break
+        return self.recovered
+
+    def _bisect(self, offset, limit, on_items):
+        """Fetch a range, splitting it in halves while it is poisoned
+
+        Returns True if the range reached the end of the list.
+
+        :param offset: Offset of the range
+        :param limit: Size of the range
+        :param on_items: Called with (offset, items) for every good sub-range
+        """
+        self.requests += 1
+        try:
+            items = self.fetch(offset, limit)
+        except PoisonedRange:
+            if limit == 1:
+                logger.warning("Isolated poisoned record @ offset %d", offset)
+                self.poisoned.append(offset)
+                return False
+            half = limit // 2
+            if self._bisect(offset, half, on_items):
+                return True
+            return self._bisect(offset + half, limit - half, on_items)
+
+        if items:
+            on_items(offset, items)
+            self.recovered += len(items)
+        return len(items) < limit
+
+    def requests_per_item(self):
+        """Requests spent per recovered item"""
+        return self.requests / self.recovered if self.recovered else float(self.requests)
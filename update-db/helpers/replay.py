@@ -0,0 +1,267 @@
+"""
+Record/replay store of GraphQL responses.
+
+In record mode every response of a crawl is saved in an on-disk store next to
+its request key and attempt number, including timeouts and connection errors,
+and the database the crawl starts from is saved as start.db. In replay mode the
+transport answers from the store only and never touches the network: the n-th
+request with a key gets the n-th recorded outcome (the last one once they run
+out), so a crawl can be rerun offline at full local speed from the same
+database, with the same failures and DLQ retries as the recorded run.
+
+Response bodies are gzip-compressed and content-addressed by their SHA-256:
+identical responses are stored once under objects/<2 hex>/<digest>.gz. An
+SQLite index maps every request key to its body, and the least recently used
+entries are evicted once the store grows past its size cap.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+import config as conf
+
+logger = logging.getLogger(__name__)
+
+# Database a recorded crawl started from, saved in the store
+START_DB = "start.db"
+
+
+def request_key(body):
+    """Lookup key of a GraphQL request body
+
+    Returns a tuple of (operation, item id, offset, limit, query hash). Batched
+    requests have no single id, their item id is a hash of their variables.
+
+    :param body: GraphQL request body, as built by get_request_bodies
+    """
+    variables = body.get("variables", {})
+    item_id = variables.get("id")
+    if item_id is None:
+        item_id = hashlib.sha1(json.dumps(variables, sort_keys=True)
+                               .encode("UTF-8")).hexdigest()
+    query_hash = hashlib.sha1(body.get("query", "").encode("UTF-8")).hexdigest()
+    return (body.get("operationName"), item_id, int(variables.get("offset", 0)),
+            int(variables.get("limit", 0)), query_hash)
+
+
+def start_db_path(path=None):
+    """Path of the database a recorded crawl started from
+
+    :param path: Directory of the store, CACHE_DIR if None
+    """
+    return os.path.join(path or conf.CACHE_DIR, START_DB)
+
+
+class ResponseStore:
+    """
+    Compressed, content-addressed store of recorded responses.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or conf.CACHE_DIR
+        self.max_bytes = conf.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(os.path.join(self.path, "index.db"),
+                                   check_same_thread=False)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS entry (
+            operation TEXT NOT NULL, itemId TEXT NOT NULL, offset INTEGER NOT NULL,
+            lim INTEGER NOT NULL, queryHash TEXT NOT NULL, attempt INTEGER NOT NULL,
+            status INTEGER, error TEXT, digest TEXT NOT NULL, recordedAt REAL, usedAt REAL,
+            PRIMARY KEY (operation, itemId, offset, lim, queryHash, attempt)
+        )
+        """)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS object (
+            digest TEXT PRIMARY KEY NOT NULL, size INTEGER
+        )
+        """)
+        self.con.execute("CREATE INDEX IF NOT EXISTS idx_entry_usedAt ON entry (usedAt)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS idx_entry_digest ON entry (digest)")
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.commit()
+        self.bytes = self.con.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM object").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        # Requests sent (record) or answered (replay) so far per request key
+        self._attempts = {}
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], f"{digest}.gz")
+
+    def put(self, body, status, content, error=None):
+        """Record the outcome of a request
+
+        The first outcome of a key in this run replaces the ones of older runs.
+
+        :param body: GraphQL request body
+        :param status: HTTP status code of the response, None for a failure
+        :param content: Raw (decoded) response body, the message of a failure
+        :param error: Name of the requests exception a failure raised
+        """
+        key = request_key(body)
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        now = time.time()
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = gzip.compress(content)
+                with open(f"{path}.tmp", "wb") as file:
+                    file.write(data)
+                os.replace(f"{path}.tmp", path)
+                self.con.execute("INSERT OR REPLACE INTO object VALUES (?, ?)",
+                                 (digest, len(data)))
+                self.bytes += len(data)
+            attempt = self._attempts.get(key, 0)
+            if attempt == 0:
+                self.con.execute("""
+                    DELETE FROM entry WHERE operation = ? AND itemId = ? AND offset = ?
+                    AND lim = ? AND queryHash = ?
+                """, key)
+            self._attempts[key] = attempt + 1
+            self.con.execute("""
+                INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (*key, attempt, status, error, digest, now, now))
+            self.con.commit()
+            self._evict()
+
+    def put_error(self, body, error):
+        """Record a request that failed without a response
+
+        :param body: GraphQL request body
+        :param error: requests exception raised by the request
+        """
+        self.put(body, None, str(error).encode("UTF-8"), type(error).__name__)
+
+    def get(self, body):
+        """Recorded (status, content, error) of the next attempt of a request,
+        or None if not recorded
+
+        :param body: GraphQL request body
+        """
+        key = request_key(body)
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+        return self._read("""
+            SELECT rowid, status, error, digest FROM entry
+            WHERE operation = ? AND itemId = ? AND offset = ? AND lim = ?
+            AND queryHash = ? AND attempt <= ?
+            ORDER BY attempt DESC LIMIT 1
+        """, (*key, attempt))
+
+    def lookup(self, operation, item_id, offset, limit=None):
+        """Last recorded (status, content, error) of a request by its
+        parameters, or None
+
+        :param operation: GraphQL operation name
+        :param item_id: Channel, video or comment id of the request
+        :param offset: Offset of the page
+        :param limit: Size of the page, the largest recorded one if None
+        """
+        if limit is None:
+            return self._read("""
+                SELECT rowid, status, error, digest FROM entry
+                WHERE operation = ? AND itemId = ? AND offset = ?
+                ORDER BY lim DESC, attempt DESC LIMIT 1
+            """, (operation, item_id, offset))
+        return self._read("""
+            SELECT rowid, status, error, digest FROM entry
+            WHERE operation = ? AND itemId = ? AND offset = ? AND lim = ?
+            ORDER BY attempt DESC LIMIT 1
+        """, (operation, item_id, offset, limit))
+
+    def _read(self, sql, params):
+        with self._lock:
+            row = self.con.execute(sql, params).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            rowid, status, error, digest = row
+            self.con.execute("UPDATE entry SET usedAt = ? WHERE rowid = ?",
+                             (time.time(), rowid))
+            self.hits += 1
+        with open(self._object_path(digest), "rb") as file:
+            return status, gzip.decompress(file.read()), error
+
+    def _evict(self):
+        """Drop the least recently used entries while the store is over its cap"""
+        if not self.max_bytes:
+            return
+        while self.bytes > self.max_bytes:
+            rows = self.con.execute(
+                "SELECT rowid, digest FROM entry ORDER BY usedAt LIMIT 100").fetchall()
+            if not rows:
+                break
+            self.con.executemany("DELETE FROM entry WHERE rowid = ?",
+                                 [(rowid,) for rowid, _ in rows])
+            # Only the bodies of the evicted entries can have become unused
+            orphans = []
+            for digest in {digest for _, digest in rows}:
+                if self.con.execute("SELECT 1 FROM entry WHERE digest = ? LIMIT 1",
+                                    (digest,)).fetchone() is None:
+                    orphans += self.con.execute(
+                        "SELECT digest, size FROM object WHERE digest = ?",
+                        (digest,)).fetchall()
+            for digest, size in orphans:
+                try:
+                    os.remove(self._object_path(digest))
+                except FileNotFoundError:
+                    pass
+                self.bytes -= size
+            self.con.executemany("DELETE FROM object WHERE digest = ?",
+                                 [(digest,) for digest, _ in orphans])
+            self.con.commit()
+            logger.info("Evicted %d cached responses, %.1f MB left",
+                        len(rows), self.bytes / 1e6)
+
+    def summary(self):
+        """One line summary of the store"""
+        with self._lock:
+            entries = self.con.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+        return (f"{entries} responses, {self.bytes / 1e6:.1f} MB, "
+                f"{self.hits} hits / {self.misses} misses")
+
+    def close(self):
+        """Commit the last lookups and close the index"""
+        with self._lock:
+            self.con.commit()
+            self.con.close()
+
+
+def replayed_error(error, message):
+    """Build the exception of a recorded failure
+
+    :param error: Name of the recorded requests exception
+    :param message: Recorded message of the exception
+    """
+    cls = getattr(requests.exceptions, error, None)
+    if not (isinstance(cls, type) and issubclass(cls, requests.RequestException)):
+        cls = requests.ConnectionError
+    return cls(message.decode("UTF-8"))
+
+
+def replayed_response(status, content):
+    """Build a response object from a recorded response
+
+    :param status: Recorded HTTP status code
+    :param content: Recorded response body
+    """
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = content  # pylint: disable=protected-access
+    resp.headers["Content-Type"] = "application/json"
+    resp.url = conf.HOST
+    return resp
@@ -0,0 +1,270 @@
+"""
+Snapshots and delta files of the archive, for consumers of store.db.
+
+At the end of a run, export_run() publishes into conf.SNAPSHOT_DIR:
+
+- store-<id>.db, a compacted VACUUM INTO copy of the database,
+- delta-<base>-<id>.jsonl.gz, the rows inserted, updated or deleted since
+  the previous snapshot,
+- manifest.json, listing the latest snapshot and the deltas with their sizes
+  and SHA-256 digests.
+
+Snapshots are named after the id of their last modified row. The rows that
+change are recorded by the change_log triggers (see
+dbutils.setup_change_log), so a delta holds the current version of every
+changed row and the key of every deleted one. Derived tables, the full-text
+indexes and user_stats, are not part of a delta: the triggers of the
+consumer's database rebuild them while the delta is applied.
+
+A consumer downloads a snapshot once, then runs apply_delta() (maintenance.py
+apply-delta) with every newer delta to bring it up to date.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import config as conf
+from helpers import dbutils
+
+logger = logging.getLogger(__name__)
+
+# Version of the delta file layout
+DELTA_FORMAT = 1
+
+
+def _columns(cur, table):
+    """Column names of a table, in table order"""
+    cur.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cur.fetchall()]
+
+
+def _sha256(path):
+    """Hex SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_delta(cur, base, target, path):
+    """Write the rows of change_log to a gzip-compressed JSON lines file
+
+    The first line is a header with the base and target ids and the columns of
+    every table. It is followed by a {"table": ..., "delete": key} line for
+    every deleted row and a {"table": ..., "row": [...]} line for every
+    inserted or updated row, in the order they are applied. Returns the
+    number of rows written.
+
+    :param cur: SQLite cursor obj
+    :param base: modified id of the snapshot the delta applies to
+    :param target: modified id of the snapshot the delta leads to
+    :param path: Path of the delta file
+    """
+    columns = {table: _columns(cur, table) for table, _ in dbutils.CHANGE_LOG_TABLES}
+    rows = 0
+    with gzip.open(f"{path}.tmp", "wt", encoding="UTF-8") as file:
+        file.write(json.dumps({
+            "format": DELTA_FORMAT, "base": base, "target": target,
+            "createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "keys": dict(dbutils.CHANGE_LOG_TABLES), "columns": columns,
+        }) + "\n")
+        # Deletes come first and children first, so the delete triggers of the
+        # consumer run before the rows of the delta set the final values
+        for table, key in reversed(dbutils.CHANGE_LOG_TABLES):
+            cur.execute(f"""
+                SELECT rowKey FROM change_log c WHERE c.tbl = ?
+                AND NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = c.rowKey)
+            """, (table,))
+            for (row_key,) in cur:
+                file.write(json.dumps({"table": table, "delete": row_key}) + "\n")
+                rows += 1
+        for table, key in dbutils.CHANGE_LOG_TABLES:
+            cur.execute(f"""
+                SELECT t.* FROM change_log c JOIN {table} t ON t.{key} = c.rowKey
+                WHERE c.tbl = ?
+            """, (table,))
+            for row in cur:
+                file.write(json.dumps({"table": table, "row": row}) + "\n")
+                rows += 1
+    os.replace(f"{path}.tmp", path)
+    return rows
+
+
+def export_run(con, directory=None):
+    """Export the snapshot and the delta of a finished run
+
+    Returns a dict describing the export, or None if nothing changed since
+    the previous snapshot. The change log is emptied in the same transaction
+    that records the export.
+
+    :param con: SQLite connection obj of the working database
+    :param directory: Output directory, conf.SNAPSHOT_DIR by default
+    """
+    directory = directory or conf.SNAPSHOT_DIR
+    cur = con.cursor()
+    cur.execute("SELECT MAX(id) FROM modified")
+    target = cur.fetchone()[0]
+    cur.execute("SELECT MAX(modifiedId) FROM snapshot_export")
+    base = cur.fetchone()[0]
+    if target is None or target == base:
+        return None
+    os.makedirs(directory, exist_ok=True)
+
+    export = {"target": target, "base": base, "delta": None, "rows": 0, "delta_bytes": 0}
+    if base is not None:
+        export["delta"] = os.path.join(directory, f"delta-{base}-{target}.jsonl.gz")
+        export["rows"] = write_delta(cur, base, target, export["delta"])
+        export["delta_bytes"] = os.path.getsize(export["delta"])
+    cur.execute("DELETE FROM change_log")
+    cur.execute("""
+        INSERT INTO snapshot_export (modifiedId, exportedAt, baseId, deltaRows, deltaBytes)
+        VALUES (?, ?, ?, ?, ?)
+    """, (target, datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+          base, export["rows"], export["delta_bytes"]))
+    con.commit()
+
+    export["snapshot"] = os.path.join(directory, f"store-{target}.db")
+    if os.path.exists(export["snapshot"]):
+        os.remove(export["snapshot"])
+    cur.execute("VACUUM INTO ?", (export["snapshot"],))
+    export["snapshot_bytes"] = os.path.getsize(export["snapshot"])
+    cur.execute("UPDATE snapshot_export SET snapshotBytes = ? WHERE modifiedId = ?",
+                (export["snapshot_bytes"], target))
+    con.commit()
+
+    prune(directory)
+    write_manifest(directory)
+    logger.info("Exported snapshot %d (%.1f MB) and %d changed rows (%.1f MB)",
+                target, export["snapshot_bytes"] / 1e6, export["rows"],
+                export["delta_bytes"] / 1e6)
+    return export
+
+
+def summary(export):
+    """One line summary of an export
+
+    :param export: Result of export_run, may be None
+    """
+    if export is None:
+        return "not exported"
+    delta = (f"delta {export['base']} → {export['target']}, {export['rows']} rows, "
+             f"{export['delta_bytes'] / 1e6:.1f} MB" if export["delta"]
+             else "no delta (first snapshot)")
+    return (f"{os.path.basename(export['snapshot'])} "
+            f"{export['snapshot_bytes'] / 1e6:.1f} MB, {delta}")
+
+
+def _files(directory, prefix):
+    """Snapshot or delta files of a directory, oldest first, as (ids, name)"""
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and not name.endswith(".tmp"):
+            ids = tuple(int(part) for part in
+                        name[len(prefix):].split(".")[0].split("-"))
+            files.append((ids, name))
+    return sorted(files)
+
+
+def prune(directory):
+    """Delete the snapshots and deltas past SNAPSHOT_KEEP and DELTA_KEEP
+
+    :param directory: Snapshot directory
+    """
+    snapshots = _files(directory, "store-")
+    deltas = _files(directory, "delta-")
+    for _, name in snapshots[:-conf.SNAPSHOT_KEEP] + deltas[:-conf.DELTA_KEEP]:
+        os.remove(os.path.join(directory, name))
+
+
+def write_manifest(directory):
+    """Write manifest.json, the index of the snapshot directory
+
+    :param directory: Snapshot directory
+    """
+    snapshots = _files(directory, "store-")
+    manifest = {"latest": snapshots[-1][0][0] if snapshots else None,
+                "snapshots": [], "deltas": []}
+    for (target,), name in snapshots:
+        manifest["snapshots"].append({
+            "id": target, "file": name,
+            "bytes": os.path.getsize(os.path.join(directory, name))})
+    for (base, target), name in _files(directory, "delta-"):
+        path = os.path.join(directory, name)
+        manifest["deltas"].append({"base": base, "target": target, "file": name,
+                                   "bytes": os.path.getsize(path),
+                                   "sha256": _sha256(path)})
+    with open(os.path.join(directory, "manifest.json.tmp"), "w", encoding="UTF-8") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(os.path.join(directory, "manifest.json.tmp"),
+               os.path.join(directory, "manifest.json"))
+
+
+def read_header(path):
+    """Header of a delta file, as a dict
+
+    :param path: Path of the delta file
+    """
+    with gzip.open(path, "rt", encoding="UTF-8") as file:
+        return json.loads(file.readline())
+
+
+def apply_delta(con, path):
+    """Apply a delta file to an older copy of the archive
+
+    The database must be at the base snapshot of the delta, i.e. its newest
+    modified row must be the base id. The whole delta is applied in one
+    transaction, with the foreign keys checked at its end. Returns the number
+    of rows applied.
+
+    :param con: SQLite connection obj of the consumer's database
+    :param path: Path of the delta file
+    """
+    cur = con.cursor()
+    header = read_header(path)
+    if header["format"] != DELTA_FORMAT:
+        raise ValueError(f"{path}: unsupported delta format {header['format']}")
+    cur.execute("SELECT MAX(id) FROM modified")
+    current = cur.fetchone()[0]
+    if current != header["base"]:
+        raise ValueError(f"{path}: the delta applies to snapshot {header['base']}, "
+                         f"the database is at {current}")
+
+    statements = {}
+    for table, key in header["keys"].items():
+        columns = [f'"{column}"' for column in header["columns"][table]]
+        updates = ", ".join(f"{column} = excluded.{column}"
+                            for column in columns if column != f'"{key}"')
+        statements[table] = (
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT({key}) DO UPDATE SET {updates}")
+    rows = 0
+    cur.execute("BEGIN")
+    try:
+        cur.execute("PRAGMA defer_foreign_keys = ON")
+        with gzip.open(path, "rt", encoding="UTF-8") as file:
+            file.readline()
+            for line in file:
+                change = json.loads(line)
+                table = change["table"]
+                if "delete" in change:
+                    cur.execute(f"DELETE FROM {table} WHERE {header['keys'][table]} = ?",
+                                (change["delete"],))
+                else:
+                    cur.execute(statements[table], change["row"])
+                rows += 1
+        dbutils.rollup_videos(cur)
+        cur.execute("DELETE FROM change_log")
+        cur.execute("""
+            INSERT OR REPLACE INTO snapshot_export (modifiedId, exportedAt, baseId, deltaRows)
+            VALUES (?, ?, ?, ?)
+        """, (header["target"], header["createdAt"], header["base"], rows))
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return rows
@@ -0,0 +1,209 @@
+"""
+Shared HTTP transport for all crawl phases.
+
+Wraps a single requests.Session with a bounded, keep-alive connection pool so
+the GraphQL calls reuse TCP/TLS connections instead of opening a new one per
+request. Responses are negotiated with compression (gzip, and br when the
+brotli package is installed) and every request is accounted for per phase.
+Every request passes the adaptive rate control (see ratecontrol) first.
+Responses can be recorded to, or replayed from, a response store (see replay).
+"""
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config as conf
+from helpers import metrics
+from helpers import ratecontrol
+from helpers import replay
+
+try:
+    import brotli  # pylint: disable=unused-import # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseStats:
+    """
+    Request accounting for a single crawl phase.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, latency, wire_bytes, body_bytes, failed):
+        """Add a finished request to the counters
+
+        :param latency: Request latency in seconds
+        :param wire_bytes: Bytes received over the wire (compressed)
+        :param body_bytes: Bytes of the decoded response body
+        :param failed: True if the request raised or returned an error status
+        """
+        self.requests += 1
+        self.errors += int(failed)
+        self.wire_bytes += wire_bytes
+        self.body_bytes += body_bytes
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def summary(self):
+        """One line summary of the phase counters"""
+        avg = (self.latency_total / self.requests * 1000) if self.requests else 0
+        return (f"{self.requests} requests, {self.errors} failed, "
+                f"{self.wire_bytes / 1e6:.1f} MB received "
+                f"({self.body_bytes / 1e6:.1f} MB decoded), "
+                f"avg {avg:.0f} ms / max {self.latency_max * 1000:.0f} ms")
+
+
+class Transport:
+    """
+    Pooled keep-alive transport used by every crawl phase.
+    """
+
+    def __init__(self, host=None, pool_size=None, timeouts=None, control=None,
+                 cache_mode=None, store=None):
+        self.host = host or conf.HOST
+        self.timeouts = timeouts or conf.PHASE_TIMEOUTS
+        pool_size = pool_size or conf.POOL_SIZE
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept-Encoding": ACCEPT_ENCODING,
+            "Connection": "keep-alive",
+        })
+
+        self.control = control or ratecontrol.RateControl()
+        self.cache_mode = cache_mode
+        self.store = store
+        if cache_mode is not None and store is None:
+            self.store = replay.ResponseStore()
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def timeout(self, phase):
+        """(connect, read) timeout tuple for a phase
+
+        :param phase: Name of the crawl phase
+        """
+        return (conf.CONNECT_TIMEOUT, self.timeouts.get(phase, conf.READ_TIMEOUT))
+
+    def post(self, body, phase, check=True):
+        """POST a GraphQL request body and return the response
+
+        :param body: GraphQL request body
+        :param phase: Name of the crawl phase, used for timeouts and accounting
+        :param check: Raise requests.HTTPError on 4xx/5xx responses
+        """
+        if self.cache_mode == "replay":
+            return self._replay(body, phase, check)
+
+        sent = self.control.acquire()
+        start = time.perf_counter()
+        wire_bytes, body_bytes, failed = 0, 0, True
+        outcome, wait = ratecontrol.FAILED, None
+        try:
+            resp = self.session.post(self.host, json=body,
+                                     timeout=self.timeout(phase))
+            body_bytes = len(resp.content)
+            wire_bytes = _wire_bytes(resp, body_bytes)
+            failed = not resp.ok
+            outcome = ratecontrol.outcome_of(resp.status_code)
+            wait = ratecontrol.retry_after(resp)
+            if self.cache_mode == "record":
+                self.store.put(body, resp.status_code, resp.content)
+            if check:
+                resp.raise_for_status()
+            return resp
+        except requests.RequestException as e:
+            if isinstance(e, requests.Timeout):
+                outcome = ratecontrol.TIMEOUT
+            # HTTP errors were recorded with their response above
+            if self.cache_mode == "record" and not isinstance(e, requests.HTTPError):
+                self.store.put_error(body, e)
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            self.control.release(sent, latency, outcome, wait)
+            self._record(phase, latency, wire_bytes, body_bytes, failed)
+
+    def _replay(self, body, phase, check):
+        """Answer a request from the response store, without any network
+
+        A recorded failure raises the recorded exception again, a request that
+        was not recorded fails like a connection error.
+
+        :param body: GraphQL request body
+        :param phase: Name of the crawl phase, used for accounting
+        :param check: Raise requests.HTTPError on 4xx/5xx responses
+        """
+        start = time.perf_counter()
+        recorded = self.store.get(body)
+        if recorded is None:
+            self._record(phase, time.perf_counter() - start, 0, 0, True)
+            raise requests.ConnectionError(
+                f"No recorded response for {replay.request_key(body)[:4]}")
+
+        status, content, error = recorded
+        if error is not None:
+            self._record(phase, time.perf_counter() - start, 0, 0, True)
+            raise replay.replayed_error(error, content)
+
+        resp = replay.replayed_response(status, content)
+        self._record(phase, time.perf_counter() - start,
+                     len(resp.content), len(resp.content), not resp.ok)
+        if check:
+            resp.raise_for_status()
+        return resp
+
+    def _record(self, phase, latency, wire_bytes, body_bytes, failed):
+        with self._lock:
+            if phase not in self.stats:
+                self.stats[phase] = PhaseStats()
+            self.stats[phase].record(latency, wire_bytes, body_bytes, failed)
+        metrics.observe_request(phase, latency, wire_bytes, body_bytes, failed)
+
+    def summary(self):
+        """Markdown lines with the request accounting of every phase"""
+        with self._lock:
+            lines = [f"- Requests ({phase}): {stats.summary()}"
+                     for phase, stats in self.stats.items()]
+        if self.cache_mode == "replay":
+            lines.append(f"- Replayed from {self.store.path}: {self.store.summary()}")
+        else:
+            lines.append(f"- Rate control: {self.control.summary()}")
+            if self.cache_mode == "record":
+                lines.append(f"- Recorded to {self.store.path}: {self.store.summary()}")
+        return "\n".join(lines)
+
+    def close(self):
+        """Close all pooled connections and the response store"""
+        self.session.close()
+        if self.store is not None:
+            self.store.close()
+
+
+def _wire_bytes(resp, fallback):
+    """Number of (possibly compressed) bytes read from the socket
+
+    :param resp: Response with a consumed body
+    :param fallback: Value used when the raw stream does not report a position
+    """
+    try:
+        return resp.raw.tell() or fallback
+    except (AttributeError, OSError):
+        return fallback
@@ -2,8 +2,8 @@
 Docstring for update-db.helpers.validator
 """
 from datetime import datetime
-from typing import List, Union, Optional
-from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, List, Union, Optional
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 
 # Base model configuration
 
@@ -36,6 +36,16 @@ class ErrorResponse(GraphQLBaseModel):
 # Get Channel Videos Validation
 
 
+class VideoChannel(BaseModel):
+    """
+    Channel that published a video.
+    """
+    id: str = Field(alias="_id")
+    title: Optional[str] = None
+
+    model_config = ConfigDict(extra="ignore")
+
+
 class Video(BaseModel):
     """
     Docstring for Video
@@ -48,6 +58,7 @@ class Video(BaseModel):
     angerCount: int
     videoDuration: float | None = None
     createdAt: datetime
+    channel: Optional[VideoChannel] = None
 
     model_config = ConfigDict(extra="ignore")
 
@@ -131,6 +142,7 @@ class ReplyTo(GraphQLBaseModel):
     Docstring for ReplyTo
     """
     id: str = Field(alias="_id")
+    replyCount: Optional[int] = None
 
 
 class Reply(GraphQLBaseModel):
@@ -161,7 +173,76 @@ class GetCommentRepliesResponse(GraphQLBaseModel):
     data: GetCommentReplies
 
 
+# Batched Get Comment Replies Validation
+
+
+class GraphQLPathErrorMsg(GraphQLErrorMsg):
+    """
+    Error message of a single field in a batched query, the path holds
+    the alias of the field that failed.
+    """
+    path: Optional[List[Union[str, int]]] = None
+
+
+class GetCommentRepliesBatchResponse(GraphQLBaseModel):
+    """
+    Response of an aliased GetCommentRepliesBatch query. Data maps every
+    alias to its replies, or to None when that field failed.
+    """
+    data: Optional[Dict[str, Optional[List[Reply]]]] = None
+    errors: Optional[List[GraphQLPathErrorMsg]] = None
+
+
+# Reply Probe Validation
+
+
+class ProbedReply(GraphQLBaseModel):
+    """
+    Reply of a GetCommentReplyProbe query, only what the fingerprint needs.
+    """
+    id: str = Field(alias="_id")
+    createdAt: datetime
+    replyTo: ReplyTo
+
+
+class GetCommentReplyProbeResponse(GraphQLBaseModel):
+    """
+    Response of an aliased GetCommentReplyProbe query. Data maps every
+    alias to its replies, or to None when that field failed.
+    """
+    data: Optional[Dict[str, Optional[List[ProbedReply]]]] = None
+    errors: Optional[List[GraphQLPathErrorMsg]] = None
+
+
 # Unions
 GetChannelVideosUnion = Union[GetChannelVideosResponse, ErrorResponse]
 GetVideoCommentsUnion = Union[GetVideoCommentsResponse, ErrorResponse]
 GetCommentRepliesUnion = Union[GetCommentRepliesResponse, ErrorResponse]
+
+# Prebuilt adapters, building a TypeAdapter is expensive so they are created once
+GetChannelVideosAdapter = TypeAdapter(GetChannelVideosUnion)
+GetVideoCommentsAdapter = TypeAdapter(GetVideoCommentsUnion)
+GetCommentRepliesAdapter = TypeAdapter(GetCommentRepliesUnion)
+GetCommentRepliesBatchAdapter = TypeAdapter(GetCommentRepliesBatchResponse)
+GetCommentReplyProbeAdapter = TypeAdapter(GetCommentReplyProbeResponse)
+
+ADAPTERS = {
+    "GetChannelVideos": GetChannelVideosAdapter,
+    "GetVideoComments": GetVideoCommentsAdapter,
+    "GetCommentReplies": GetCommentRepliesAdapter,
+    "GetCommentRepliesBatch": GetCommentRepliesBatchAdapter,
+    "GetCommentReplyProbe": GetCommentReplyProbeAdapter,
+}
+
+
+def validate_response(operation, raw):
+    """
+    Validates a raw response body directly from JSON, without parsing it
+    into Python objects first. Returns the response model of the operation
+    (or an ErrorResponse for the single operations), and raises
+    pydantic.ValidationError otherwise (including for invalid JSON).
+
+    :param operation: GraphQL operation name of the request
+    :param raw: Response body as bytes or str
+    """
+    return ADAPTERS[operation].validate_json(raw)
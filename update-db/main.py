@@ -8,439 +8,646 @@ Date Updated: 2026-02-04
 """
 
 import os
-import json
-import sqlite3
+import sys
+import itertools
+import argparse
 import logging
 import shutil
 from datetime import datetime, timezone
-from pydantic import ValidationError, TypeAdapter
+from pydantic import ValidationError
 
 import config as conf
 from helpers import validator as pyd
 from helpers import get_request_bodies
 from helpers import dbutils
+from helpers import dlq
+from helpers import fetch_engine
+from helpers import metrics
+from helpers import queryplan
+from helpers import replay
+from helpers import snapshot
+from helpers.batching import ReplyBatcher
+from helpers.checkpoint import Checkpoint
+from helpers.pipeline import Pipeline
+from helpers.publish import Publisher
+from helpers.recovery import InvalidId, PoisonedRange
+from helpers.transport import Transport
 
 import requests
 
-start_time = datetime.now(timezone.utc)
-
-conf.setup_logger()
-logger = logging.getLogger(__name__)
-
-"""Sets up the database connection and cursor"""
-# Copy the database to not update it in place
 logger = logging.getLogger(__name__)
-shutil.copyfile(conf.MAIN_DB_PATH, conf.TEMP_DB_PATH)
-logger.info("Copied database: store.db → temp.db")
-
-# Create database connection and cursor
-logger.info("Connecting to database and initializing tables")
-con = sqlite3.connect(conf.TEMP_DB_PATH)
-cur = con.cursor()
-dbutils.initialize_tables(cur)
-dbutils.setup_indexes(cur)
-con.commit()
-
-# Stat counters
-new_videos = 0
-new_comments = 0
-new_replies = 0
-
-# Fetch all videos
-logger.info("Fetching videos from %s", conf.HOST)
-total_videos = 0
-offset = 0
-while True:
-    body = get_request_bodies.get_video_request_body(
-        conf.CHANNEL_ID, conf.LIMIT, offset)
-    try:
-        resp = requests.post(conf.HOST, json=body, timeout=30)
-        resp.raise_for_status()
-        obj = resp.json()
-
-        validation = pyd.GetChannelVideosResponse.model_validate(obj)
-        if isinstance(validation, pyd.GetChannelVideosResponse):
-            videos = validation.data.getChannel.videos
-
-            logger.info("Fetched %d videos @ offset %d", len(videos), offset)
-            for video in videos:
-                new_videos += dbutils.add_video(cur, video.id, video.title,
-                                                video.summary, video.playCount, video.likeCount,
-                                                video.angerCount, video.videoDuration,
-                                                video.createdAt, None)
-                total_videos += 1
-
-            if len(videos) < conf.LIMIT:
-                break
-
-        else:
-            logger.error("[%s] @ offset %d contains error",
-                         conf.CHANNEL_ID, offset)
-    except (AttributeError) as e:
-        logger.error(e)
-
-    except (requests.RequestException, requests.HTTPError):
-        logger.error("Video fetch failed @ offset %s", offset)
-
-    except (json.JSONDecodeError, TypeError, ValidationError):
-        logger.error("Malformed video response @ offset %d", offset)
 
-    offset += conf.LIMIT
-con.commit()
 
-# Fetch all comments
-logger.info("Fetching all video comments")
-id_list = dbutils.get_all_video_ids(cur)
-counter = 0
-
-for idx, video_id in enumerate(id_list):
-    retries, comment_count, offset = 0, 0, 0
-    logger.info("[%s] fetching comments (%d/%d)",
-                video_id, counter, total_videos)
-    counter += 1
-
-    while True:
+def parse_args():
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Update the local database with new videos, comments and replies")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--full", dest="incremental", action="store_false", default=False,
+                      help="re-sync the full comment history of every video, "
+                           "the default")
+    mode.add_argument("--incremental", action="store_true",
+                      help="only page through the new comments of every video, "
+                           "the counters of older comments are not updated")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last unfinished run from its "
+                             "checkpoint in the existing working database")
+    parser.add_argument("--refresh-replies", action="store_true",
+                        help="probe every complete reply thread and re-sync the "
+                             "ones that changed since they were fetched")
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument("--record", dest="cache_mode", action="store_const",
+                       const="record", default=conf.CACHE_MODE,
+                       help="save every response to the response store")
+    cache.add_argument("--replay", dest="cache_mode", action="store_const",
+                       const="replay",
+                       help="answer every request from the response store, "
+                            "without any network")
+    return parser.parse_args()
+
+
+def open_database(publisher, resume):
+    """Open the working database and initialize its tables
+
+    :param publisher: Publisher of the run
+    :param resume: Continue the unfinished run in the existing working database
+    """
+    try:
+        con = publisher.open(resume)
+    except FileNotFoundError:
+        sys.exit(f"Nothing to resume: {os.path.basename(publisher.path)} does not exist")
+
+    logger.info("Connecting to database and initializing tables")
+    cur = con.cursor()
+    dbutils.prepare_database(cur, conf.VIEWER_INDEXES, conf.SNAPSHOT_DIR is not None)
+    con.commit()
+    dlq.import_legacy(con, "comment", conf.COMMENT_ERROR_PATH)
+    dlq.import_legacy(con, "reply", conf.REPLY_ERROR_PATH)
+    return con, cur
+
+
+def fetch_videos(cur, transport, checkpoint):
+    """Fetch all videos of the configured channels
+
+    Returns a tuple of (dict of channel id to (new videos, shared videos),
+    dict of video id to meta hash).
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    """
+    logger.info("Fetching videos of %d channels from %s (%d in flight)",
+                len(conf.CHANNEL_IDS), conf.HOST, conf.CHANNEL_CONCURRENCY)
+    return fetch_engine.fetch_all_videos(cur, transport, checkpoint, conf.CHANNEL_IDS)
+
+
+def fetch_comments(cur, transport, checkpoint, reader, meta_hashes, full):
+    """Fetch the comments of every stored video
+
+    Returns a tuple of (new comments, skipped videos).
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param reader: Read-only SQLite connection obj the videos are streamed from
+    :param meta_hashes: Dict of video id to meta hash from the video phase
+    :param full: Re-sync the full comment history instead of crawling incrementally
+    """
+    logger.info("Fetching all video comments (%d in flight, %s)",
+                conf.COMMENT_CONCURRENCY, "full" if full else "incremental")
+    return fetch_engine.fetch_all_comments(
+        cur, transport, checkpoint, reader, meta_hashes, incremental=not full)
+
+
+def resolve_comment_errors(cur, transport, checkpoint, totals):
+    """Trying to resolve comment errors (bisection)
+
+    Returns the number of new comments.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param totals: Dict of DLQ recovery counters, updated in place
+    """
+    logger.info("Resolving comment errors")
+    new_comments = 0
+
+    def fetch_page(video_id, page_offset, limit):
         body = get_request_bodies.get_comment_request_body(
-            video_id, conf.LIMIT, offset)
-        try:
-            resp = requests.post(conf.HOST, json=body, timeout=30)
-            resp.raise_for_status()
-            obj = resp.json()
-
-            adapter = TypeAdapter(pyd.GetVideoCommentsUnion)
-            validation = adapter.validate_python(obj)
-
-            if isinstance(validation, pyd.GetVideoCommentsResponse):
-                comments = validation.data.getVideoComments
-
-                logger.info("[%s] fetched %d comments @ offset %d",
-                            video_id, len(comments), offset)
-                for comment in comments:
-                    linked_user_name = None
-                    linked_user_id = None
-                    if comment.linkedUser:
-                        linked_user_name = comment.linkedUser.username
-                        linked_user_id = comment.linkedUser.id
-                    new_comments += dbutils.add_comment(
-                        cur, video_id, comment.id, comment.content,
-                        comment.user.id, comment.user.username,
-                        comment.user.typename, comment.voteCount.positive,
-                        linked_user_name, linked_user_id, comment.createdAt, comment.replyCount
-                    )
-                    comment_count += 1
-
-                # Don't need to query the next page if this is not full
-                if len(comments) < conf.LIMIT:
-                    dbutils.add_comment_count(cur, comment_count, video_id)
-                    break
-
-            else:
-                logger.error("[%s] @ offset %d contains error",
-                             video_id, offset)
-                with open(f'{conf.COMMENT_ERROR_PATH}/{video_id}', 'w', encoding="UTF-8") as file:
-                    json.dump(body, file)
-                logger.error(
-                    "[%s] failed fetching comments after 3 retries", video_id)
-                break
-
-        except (requests.RequestException, requests.HTTPError) as e:
-            if retries < 2:
-                retries += 1
-                logger.warning("[%s] retry %d/3 due to %s",
-                               video_id, retries, e)
-                continue
-
-            with open(f'{conf.COMMENT_ERROR_PATH}/{video_id}', 'w', encoding="UTF-8") as file:
-                json.dump(body, file)
-                logger.error(
-                    "[%s] failed fetching comments after 3 retries", video_id)
-                break
-
-        except (json.JSONDecodeError, TypeError, ValidationError):
-            logger.error("[%s] malformed response @ offset %d",
-                         video_id, offset)
+            video_id, limit, page_offset)
+        resp = transport.post(body, "comment_dlq")
+        validation = pyd.validate_response("GetVideoComments", resp.content)
+        if isinstance(validation, pyd.ErrorResponse):
+            if f"INVALID_ID: {video_id}" in validation.errors[0].message:
+                raise InvalidId(validation.errors[0].message)
+            raise PoisonedRange(validation.errors[0].message)
+        return validation.data.getVideoComments
+
+    def write_page(video_id, page_offset, comments):
+        nonlocal new_comments
+        added, _ = dbutils.add_comments(cur, video_id, comments)
+        new_comments += added
+        logger.info("[%s] added %d comments @ %s",
+                    video_id, len(comments), page_offset)
+
+    dlq.drain(cur, checkpoint, "comment", fetch_page, write_page, totals)
+    return new_comments
+
+
+def newest_reply(replies):
+    """Newest of the given replies by createdAt, ties broken by id
+
+    Returns None if there are no replies.
+
+    :param replies: List of replies
+    """
+    return max(replies, key=lambda reply: (reply.createdAt, reply.id), default=None)
+
+
+def reported_reply_count(replies, default):
+    """replyCount of the comment as reported with its replies
+
+    Returns default if none of the replies carries it.
+
+    :param replies: List of replies of a single comment
+    :param default: Count used when the server does not report one
+    """
+    return next((reply.replyTo.replyCount for reply in replies
+                 if reply.replyTo.replyCount is not None), default)
+
+
+def fetch_reply_batches(cur, transport, checkpoint, reader):
+    """Fetch the replies of small threads in batched requests
+
+    Threads expected to fit in one page are packed REPLY_BATCH_SIZE at a time
+    into one request. Every comment that the batch could not serve is left
+    pending for the single request path.
+
+    Returns the number of new replies.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param reader: Read-only SQLite connection obj the comments are streamed from
+    """
+    new_replies = 0
+    if conf.REPLY_BATCH_SIZE <= 1:
+        return new_replies
+
+    batcher = ReplyBatcher(transport, conf.LIMIT)
+    total = dbutils.count_pending_comments(reader, conf.LIMIT)
+    small = (comment_id for comment_id, _, _
+             in dbutils.iter_pending_comments(reader, conf.LIMIT)
+             if checkpoint.pending(comment_id) == 0)
+    logger.info("Fetching replies of up to %d small threads in batches of %d",
+                total, conf.REPLY_BATCH_SIZE)
+
+    batched = 0
+    while batcher.supported:
+        batch = list(itertools.islice(small, conf.REPLY_BATCH_SIZE))
+        if not batch:
             break
-
-        offset += conf.LIMIT
-con.commit()
-
-# Trying to resolve comment errors
-logger.info("Resolving comment errors")
-ids_to_fetch = os.listdir(conf.COMMENT_ERROR_PATH)
-
-for counter, video_id in enumerate(ids_to_fetch):
-    offset = 0
-    comment_count = 0
-
-    logger.info("[%s] retrying comments (%d/%d)",
-                video_id, counter, len(ids_to_fetch))
-    current_limit = conf.EXP_BACKOFF_LIMIT
-
-    while True:
-        body = get_request_bodies.get_comment_request_body(
-            video_id, current_limit, offset)
-        try:
-            resp = requests.post(conf.HOST, json=body, timeout=30)
-            resp.raise_for_status()
-            obj = json.loads(resp.text)
-
-            validation = pyd.GetVideoCommentsUnion(obj)
-            if isinstance(validation, pyd.GetVideoCommentsResponse):
-                comments = validation.data.getVideoComments
-                for comment in comments:
-                    linked_user_name = None
-                    linked_user_id = None
-                    if comment.linkedUser:
-                        linked_user_name = comment.linkedUser.username
-                        linked_user_id = comment.linkedUser.id
-                    new_comments += dbutils.add_comment(
-                        cur, video_id, comment.id, comment.content,
-                        comment.user.id, comment.user.username,
-                        comment.user.typename, comment.voteCount.positive,
-                        linked_user_name, linked_user_id, comment.createdAt, comment.replyCount
-                    )
-                    logger.info("[%s] added comment @ %s", video_id, offset)
-                    comment_count += 1
-
-                offset += len(comments)
-                current_limit = conf.EXP_BACKOFF_LIMIT
-
-                if len(validation.data.getVideoComments) == 0:
-                    logger.info("[%s] no more comments to index", video_id)
-                    break
-
-            elif isinstance(validation, pyd.ErrorResponse):
-                if f"INVALID_ID: {video_id}" in validation.errors[0].message:
-                    logger.warning(
-                        "[%s] invalid request id, stopping retries", video_id
-                    )
-                    break
-
-                logger.warning(
-                    "[%s] bad comment @ offset %s with limit %s", video_id, offset, current_limit)
-
-                if current_limit == 1:
-                    logger.warning(
-                        "[%s] skipping bad comment @ offset %s", video_id, offset)
-                    offset += 1
-                    current_limit = conf.EXP_BACKOFF_LIMIT
-                    continue
-
-                current_limit = max(1, current_limit // 2)
+        fetched = []
+        for comment_id, replies in batcher.fetch(batch).items():
+            # The thread grew past one page, page through it on its own
+            if len(replies) >= conf.LIMIT:
                 continue
-
-        except requests.RequestException as e:
-            logger.error("[%s] request error @ offset %s",
-                         video_id, offset)
-            break
-
-        except (json.JSONDecodeError, TypeError, ValidationError):
-            logger.error(
-                "[%s] malformed response @ offset %s", video_id, offset)
-            break
-
-    logger.info("[%s] Done — %d recovered comments", video_id, comment_count)
-    dbutils.add_comment_count(cur, comment_count, video_id)
-    os.remove(f"{conf.COMMENT_ERROR_PATH}/{video_id}")
-con.commit()
-
-# Fetch all comment replies
-logger.info("Fetching comment replies")
-comments = dbutils.get_pending_comments(cur)
-counter = 0
-
-for idx, (comment_id, video_id, reply_count) in enumerate(comments):
-    retries, reply_count_fetched, offset = 0, 0, 0
-    logger.info("[%s] fetching replies (%d/%d)",
-                comment_id, counter, len(comments))
-    counter += 1
-
-    while True:
+            added, _ = dbutils.add_replies(cur, replies)
+            new_replies += added
+            fetched.append((comment_id, reported_reply_count(replies, len(replies)),
+                            newest_reply(replies)))
+            checkpoint.complete(comment_id)
+        dbutils.set_reply_states(cur, fetched)
+        batched += len(batch)
+        logger.info("Batched replies (%d/%d)", batched, total)
+
+    logger.info("Batched %d threads in %d requests",
+                batcher.batched, batcher.requests)
+    return new_replies
+
+
+def fetch_replies(con, cur, transport, checkpoint, reader):
+    """Fetch all comment replies
+
+    Threads that are not served by the batched requests are paged through
+    the fetch/validate/write pipeline. Both paths stream the pending comments
+    in keyset pages, so memory use does not grow with their number.
+
+    Returns a tuple of (new replies, pipeline), pipeline is None if no
+    thread was left for it.
+
+    :param con: SQLite connection obj, owned by the pipeline writer meanwhile
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param reader: Read-only SQLite connection obj the comments are streamed from
+    """
+    logger.info("Fetching comment replies")
+    new_replies = fetch_reply_batches(cur, transport, checkpoint, reader)
+    # Commit the batched threads, so a read-only reader no longer returns them
+    con.commit()
+
+    def pending_jobs():
+        for comment_id, _, _ in dbutils.iter_pending_comments(reader):
+            offset = checkpoint.pending(comment_id)
+            if offset is not None:
+                yield comment_id, offset
+
+    jobs = pending_jobs()
+    first = next(jobs, None)
+    if first is None:
+        return new_replies, None
+
+    logger.info("Fetching replies of up to %d threads through the pipeline",
+                dbutils.count_pending_comments(reader))
+    added, pipeline = run_reply_pipeline(con, transport, checkpoint,
+                                         itertools.chain([first], jobs))
+    return new_replies + added, pipeline
+
+
+def run_reply_pipeline(con, transport, checkpoint, jobs, phase="replies"):
+    """Page through reply threads with the fetch/validate/write pipeline
+
+    A thread paged through from offset 0 also stores its fingerprint once
+    its last page is written, see dbutils.set_reply_states.
+
+    Returns a tuple of (new replies, pipeline).
+
+    :param con: SQLite connection obj, owned by the pipeline writer meanwhile
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param jobs: Iterable of (comment id, start offset)
+    :param phase: Crawl phase the requests are accounted to
+    """
+    new_replies = 0
+    # Newest reply so far of the threads paged through from offset 0
+    newest = {}
+
+    def fetch(comment_id, offset):
         body = get_request_bodies.get_comment_replies_request_body(
             comment_id, conf.LIMIT, offset)
-
+        return transport.post(body, phase).content
+
+    def validate(comment_id, offset, raw):
+        validation = pyd.validate_response("GetCommentReplies", raw)
+        if isinstance(validation, pyd.ErrorResponse):
+            raise PoisonedRange(validation.errors[0].message)
+        return validation.data.getCommentReplies
+
+    def write(write_cur, comment_id, offset, replies, last):
+        nonlocal new_replies
+        logger.info("[%s] %d replies @ offset %d", comment_id, len(replies), offset)
+        added, _ = dbutils.add_replies(write_cur, replies)
+        new_replies += added
+        if offset == 0:
+            newest[comment_id] = None
+        if comment_id in newest:
+            newest[comment_id] = newest_reply(
+                replies + ([newest[comment_id]] if newest[comment_id] else []))
+        checkpoint.advance(comment_id, offset + conf.LIMIT)
+        if last:
+            # Don't need to query the next page if this is not full
+            logger.info("[%s] no more replies @ offset %d", comment_id, offset)
+            if comment_id in newest:
+                reply_count = reported_reply_count(replies, offset + len(replies))
+                dbutils.set_reply_states(
+                    write_cur, [(comment_id, reply_count, newest.pop(comment_id))])
+            checkpoint.complete(comment_id)
+
+    def fail(write_cur, comment_id, offset, error):
+        if isinstance(error, ValidationError):
+            logger.error("[%s] malformed response @ offset %d", comment_id, offset)
+        else:
+            logger.error("[%s] failed to fetch replies @ offset %d: %s",
+                         comment_id, offset, error)
+            dlq.enqueue(write_cur, "reply", comment_id, offset, error)
+        newest.pop(comment_id, None)
+        checkpoint.complete(comment_id)
+
+    pipeline = Pipeline(con, fetch, validate, write, fail, conf.LIMIT)
+    pipeline.run(jobs)
+    return new_replies, pipeline
+
+
+def probe_reply_threads(transport, batcher, threads):
+    """Fetch the head and the tail page of PROBE_LIMIT replies of every thread
+
+    The threads are probed in one batched request, the ones the batch could
+    not serve with two single requests. Returns a dict of comment id to the
+    replies of both pages, threads that failed are left out.
+
+    :param transport: Shared HTTP transport
+    :param batcher: ReplyBatcher with a limit of PROBE_LIMIT
+    :param threads: List of (comment id, offset of the tail page)
+    """
+    probes = batcher.probe(threads)
+    for comment_id, tail in threads:
+        if comment_id in probes:
+            continue
+        replies = []
         try:
-            resp = requests.post(conf.HOST, json=body, timeout=30)
-            resp.raise_for_status()
-            obj = resp.json()
-
-            adapter = TypeAdapter(pyd.GetCommentRepliesUnion)
-            validation = adapter.validate_python(obj)
-
-            if isinstance(validation, pyd.GetCommentRepliesResponse):
-                replies = validation.data.getCommentReplies
-                logger.info(
-                    "[%s] %d replies @ offset %d", comment_id, len(replies), offset)
-                for reply in replies:
-                    linked_user_name = None
-                    linked_user_id = None
-                    if reply.linkedUser:
-                        linked_user_name = reply.linkedUser.username
-                        linked_user_id = reply.linkedUser.id
-                    new_replies += dbutils.add_reply(
-                        cur, reply.id, reply.content,
-                        reply.liked, reply.user.id,
-                        reply.user.username, reply.voteCount.positive,
-                        linked_user_name, linked_user_id, reply.createdAt, reply.replyTo.id
-                    )
-                    reply_count_fetched += 1
-
-                # Don't need to query the next page if this is not full
-                if len(replies) < conf.LIMIT:
-                    logger.info("[%s] no more replies @ offset %d",
-                                comment_id, offset)
+            for offset in (0, tail):
+                body = get_request_bodies.get_comment_replies_request_body(
+                    comment_id, conf.PROBE_LIMIT, offset)
+                resp = transport.post(body, "reply_refresh")
+                validation = pyd.validate_response("GetCommentReplies", resp.content)
+                if isinstance(validation, pyd.ErrorResponse):
+                    logger.error("[%s] reply probe contains error", comment_id)
                     break
+                replies += validation.data.getCommentReplies
             else:
-                logger.error("[%s] bad response @ offset %d",
-                             comment_id, offset)
-                with open(f'{conf.REPLY_ERROR_PATH}/{comment_id}', 'w', encoding="UTF-8") as file:
-                    json.dump(body, file)
-                logger.error(
-                    "[%s] failed to fetch replies after 3 retries", comment_id)
-                break
-
-        except (requests.RequestException) as e:
-            if retries < 2:
-                retries += 1
-                logger.warning("[%s] retry %d/3 due to %s",
-                               comment_id, retries, e)
-                continue
-            with open(f'{conf.REPLY_ERROR_PATH}/{comment_id}', 'w', encoding="UTF-8") as file:
-                json.dump(body, file)
-            logger.error(
-                "[%s] failed to fetch replies after 3 retries", comment_id)
-            break
-
-        except (json.JSONDecodeError, TypeError, ValidationError):
-            logger.error("[%s] malformed response @ offset %d",
-                         comment_id, offset)
-            break
-
-        offset += conf.LIMIT
-con.commit()
-
-# Trying to resolve reply errors (exponential back-off)
-logger.info("Resolving reply errors")
-ids_to_fetch = os.listdir(conf.REPLY_ERROR_PATH)
-
-for counter, comment_id in enumerate(ids_to_fetch):
-    offset = 0
-    reply_count_fetched = 0
-    current_limit = conf.EXP_BACKOFF_LIMIT
-    comment_reply_count = dbutils.get_comment_reply_count(cur, comment_id)
-
-    logger.info(
-        "[%s] retrying replies (%d/%d) expecting %d comments",
-        comment_id,
-        counter,
-        len(ids_to_fetch),
-        comment_reply_count
-    )
-
+                probes[comment_id] = replies
+        except (requests.RequestException, requests.HTTPError):
+            logger.error("[%s] reply probe failed", comment_id)
+        except ValidationError:
+            logger.error("[%s] malformed reply probe response", comment_id)
+    return probes
+
+
+def refresh_replies(con, cur, transport, checkpoint, reader):
+    """Re-sync the reply threads whose fingerprint changed
+
+    Threads with no missing replies are probed with a head and a tail page
+    of PROBE_LIMIT replies, REPLY_BATCH_SIZE threads per request. The probe
+    also returns the current replyCount of the comment. A thread is
+    re-synced when that count or its newest reply differs from the stored
+    fingerprint, or, if it has no fingerprint yet, when the count differs
+    from the stored replyCount or its newest reply is not stored. Unchanged
+    threads get a fresh fingerprint.
+
+    Returns a dict with the probed, changed, new replies and request counts.
+
+    :param con: SQLite connection obj, owned by the pipeline writer meanwhile
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param reader: Read-only SQLite connection obj the comments are streamed from
+    """
+    total = dbutils.count_refresh_threads(reader)
+    logger.info("Probing up to %d reply threads for changes", total)
+    batcher = ReplyBatcher(transport, conf.PROBE_LIMIT, phase="reply_refresh")
+    threads = (thread for thread in dbutils.iter_refresh_threads(reader)
+               if checkpoint.pending(thread[0]) is not None)
+    refresh = {"probed": 0, "changed": 0, "replies": 0}
+    # (comment id, offset) of the threads to re-sync
+    changed = []
     while True:
+        batch = list(itertools.islice(threads, max(1, conf.REPLY_BATCH_SIZE)))
+        if not batch:
+            break
+        # (comment id, last known reply count, stored fingerprint)
+        to_probe = []
+        for comment_id, reply_count, state in batch:
+            offset = checkpoint.pending(comment_id)
+            if offset > 0:
+                # Re-sync interrupted by a crash, continue it
+                changed.append((comment_id, offset))
+            else:
+                known = state["replyCount"] if state is not None else reply_count
+                to_probe.append((comment_id, known, state))
+
+        # The tail page holds the newest reply if the API returns the oldest first
+        probes = probe_reply_threads(
+            transport, batcher, [(comment_id, max(0, known - conf.PROBE_LIMIT))
+                                 for comment_id, known, _ in to_probe])
+        newest = {comment_id: newest_reply(replies)
+                  for comment_id, replies in probes.items()}
+        stored = dbutils.get_stored_reply_ids(
+            cur, [reply.id for reply in newest.values() if reply])
+        unchanged = []
+        for comment_id, known, state in to_probe:
+            if comment_id not in probes:
+                continue
+            replies = probes[comment_id]
+            # A thread without a first page has no replies left
+            reply_count = reported_reply_count(replies, None if replies else 0)
+            reply = newest[comment_id]
+            if reply_count is not None and reply_count != known:
+                same = False
+            elif state is not None:
+                same = (reply.id if reply else None) == state["newestReplyId"]
+            else:
+                same = reply is None or reply.id in stored
+            if same:
+                unchanged.append((comment_id, known if reply_count is None else reply_count,
+                                  reply))
+                checkpoint.complete(comment_id)
+            else:
+                changed.append((comment_id, 0))
+        dbutils.set_reply_states(cur, unchanged)
+        refresh["probed"] += len(probes)
+        logger.info("Probed reply threads (%d/%d), %d changed",
+                    refresh["probed"], total, len(changed))
+
+    refresh["changed"] = len(changed)
+    stats = transport.stats.get("reply_refresh")
+    refresh["probe_requests"] = stats.requests if stats else 0
+    if changed:
+        logger.info("Re-syncing %d changed reply threads", len(changed))
+        # The pipeline writer takes over the connection
+        con.commit()
+        refresh["replies"], _ = run_reply_pipeline(con, transport, checkpoint,
+                                                   changed, "reply_refresh")
+    return refresh
+
+
+def resolve_reply_errors(cur, transport, checkpoint, totals):
+    """Trying to resolve reply errors (bisection)
+
+    Returns the number of new replies.
+
+    :param cur: SQLite cursor obj
+    :param transport: Shared HTTP transport
+    :param checkpoint: Checkpoint of the current run
+    :param totals: Dict of DLQ recovery counters, updated in place
+    """
+    logger.info("Resolving reply errors")
+    new_replies = 0
+
+    def fetch_page(comment_id, page_offset, limit):
         body = get_request_bodies.get_comment_replies_request_body(
-            comment_id, current_limit, offset
+            comment_id, limit, page_offset
         )
-
-        try:
-            resp = requests.post(conf.HOST, json=body, timeout=30)
-            obj = resp.json()
-
-            adapter = TypeAdapter(pyd.GetCommentRepliesUnion)
-            validation = adapter.validate_python(obj)
-
-            if isinstance(validation, pyd.GetCommentRepliesResponse):
-                replies = validation.data.getCommentReplies
-                for reply in replies:
-                    linked_user_name = None
-                    linked_user_id = None
-                    if reply.linkedUser:
-                        linked_user_name = reply.linkedUser.username
-                        linked_user_id = reply.linkedUser.id
-                    new_replies += dbutils.add_reply(
-                        cur, reply.id, reply.content,
-                        reply.liked, reply.user.id,
-                        reply.user.username,
-                        reply.voteCount.positive,
-                        linked_user_name, linked_user_id, reply.createdAt,
-                        reply.replyTo.id
-                    )
-
-                    logger.info("[%s] added reply @ %d", comment_id, offset)
-                    reply_count_fetched += 1
-
-                if len(replies) == 0:
-                    logger.info("[%s] no more replies to index", comment_id)
-                    break
-
-                offset += len(replies)
-                current_limit = conf.EXP_BACKOFF_LIMIT
-
-            elif isinstance(validation, pyd.ErrorResponse):
-                if f"INVALID_ID: {comment_id}" in validation.errors[0].message:
-                    logger.warning(
-                        "[%s] invalid request id, stopping retries", comment_id
-                    )
-                    break
-
-                logger.warning(
-                    "[%s] bad reply @ offset %d with limit %d", comment_id, offset, current_limit
-                )
-
-                if current_limit == 1:
-                    logger.warning(
-                        "[%s] skipping poisoned reply @ offset %d", comment_id, offset
-                    )
-                    offset += 1
-
-                    if offset >= comment_reply_count:
-                        logger.warning(
-                            "[%s] reached expected reply count, stopping retries", comment_id
-                        )
-                        break
-
-                    current_limit = conf.EXP_BACKOFF_LIMIT
-
-                else:
-                    current_limit = max(1, current_limit // 2)
-
-                continue
-
-        except requests.RequestException:
-            logger.error("[%s] request error @ offset %d",
-                         comment_id, offset)
-            break
-        except (json.JSONDecodeError, TypeError, ValidationError):
-            logger.error("[%s] malformed response @ offset %d",
-                         comment_id, offset)
-            break
-
-    logger.info("[%s] done, got %d replies", comment_id, reply_count_fetched)
-    os.remove(f"{conf.REPLY_ERROR_PATH}/{comment_id}")
-
-# Clean-up and timestamp database
-dbutils.add_timestamp(cur)
-con.commit()
-con.close()
-logger.info("Added timestamp and closed database")
-
-shutil.move(conf.TEMP_DB_PATH, conf.MAIN_DB_PATH)
-logger.info("Database updated successfully (temp.db → store.db)")
-
-# Print run-time information
-end_time = datetime.now(timezone.utc)
-duration = end_time - start_time
-hours, remainder = divmod(duration.seconds, 3600)
-minutes = remainder // 60
-
-# Log summary
-summary = f"""**Archive Summary**
+        resp = transport.post(body, "reply_dlq", check=False)
+        validation = pyd.validate_response("GetCommentReplies", resp.content)
+        if isinstance(validation, pyd.ErrorResponse):
+            if f"INVALID_ID: {comment_id}" in validation.errors[0].message:
+                raise InvalidId(validation.errors[0].message)
+            raise PoisonedRange(validation.errors[0].message)
+        return validation.data.getCommentReplies
+
+    def write_page(comment_id, page_offset, replies):
+        nonlocal new_replies
+        added, _ = dbutils.add_replies(cur, replies)
+        new_replies += added
+        logger.info("[%s] added %d replies @ %d",
+                    comment_id, len(replies), page_offset)
+
+    dlq.drain(cur, checkpoint, "reply", fetch_page, write_page, totals)
+    return new_replies
+
+
+def dlq_summary(sizes):
+    """One line summary of the DLQ entries of a kind
+
+    :param sizes: Tuple of (queued, exhausted), None if there are none
+    """
+    queued, exhausted = sizes or (0, 0)
+    return f"{queued} ({exhausted} exhausted after {conf.DLQ_MAX_ATTEMPTS} attempts)"
+
+
+def refresh_summary(refresh):
+    """One line summary of the reply refresh
+
+    :param refresh: Result of refresh_replies, None if it was not run
+    """
+    if refresh is None:
+        return "not run"
+    return (f"probed {refresh['probed']} threads in {refresh['probe_requests']} requests, "
+            f"re-synced {refresh['changed']} ({refresh['replies']} new replies)")
+
+
+def main():
+    """Run all crawl phases and publish the updated database"""
+    args = parse_args()
+    start_time = datetime.now(timezone.utc)
+    conf.setup_logger()
+
+    # A replayed run must not overwrite the archive with recorded responses, and
+    # starts from the database the recorded run started from
+    if args.cache_mode == "replay":
+        publisher = Publisher("replay", source=replay.start_db_path())
+    else:
+        publisher = Publisher()
+    if args.resume and not publisher.resumable:
+        sys.exit(f'Nothing to resume: an interrupted "{publisher.mode}" run is rolled back, '
+                 'set PUBLISH_MODE = "backup" for resumable runs')
+    if args.cache_mode == "record" and not args.resume:
+        publisher.save_copy(replay.start_db_path())
+    con, cur = open_database(publisher, args.resume)
+    reader = publisher.open_reader()
+    transport = Transport(cache_mode=args.cache_mode)
+    if args.resume:
+        checkpoint = Checkpoint.resume(con)
+        if checkpoint is None:
+            sys.exit("Nothing to resume: no unfinished run in the database")
+    else:
+        checkpoint = Checkpoint.start(con, "incremental" if args.incremental else "full")
+    full = checkpoint.mode == "full"
+
+    # Stat counters
+    new_videos = 0
+    shared_videos = 0
+    new_comments = 0
+    new_replies = 0
+    skipped_videos = 0
+    meta_hashes = {}
+    pipeline = None
+    refresh = None
+    dlq_totals = {"requests": 0, "recovered": 0, "poisoned": 0}
+
+    if checkpoint.enter("videos"):
+        channel_videos, meta_hashes = fetch_videos(cur, transport, checkpoint)
+        new_videos = sum(new for new, _ in channel_videos.values())
+        shared_videos = sum(shared for _, shared in channel_videos.values())
+        checkpoint.leave()
+        publisher.sample_disk()
+    if args.resume:
+        # Channels listed before the interruption are not listed again
+        meta_hashes = {**dbutils.get_video_fingerprints(reader), **meta_hashes}
+
+    if checkpoint.enter("comments"):
+        added, skipped_videos = fetch_comments(cur, transport, checkpoint, reader,
+                                               meta_hashes, full)
+        new_comments += added
+        checkpoint.leave()
+        publisher.sample_disk()
+
+    if checkpoint.enter("comment_dlq"):
+        new_comments += resolve_comment_errors(cur, transport, checkpoint, dlq_totals)
+        checkpoint.leave()
+
+    if checkpoint.enter("replies"):
+        added, pipeline = fetch_replies(con, cur, transport, checkpoint, reader)
+        new_replies += added
+        checkpoint.leave()
+        publisher.sample_disk()
+
+    if args.refresh_replies and checkpoint.enter("reply_refresh"):
+        refresh = refresh_replies(con, cur, transport, checkpoint, reader)
+        new_replies += refresh["replies"]
+        checkpoint.leave()
+
+    if checkpoint.enter("reply_dlq"):
+        new_replies += resolve_reply_errors(cur, transport, checkpoint, dlq_totals)
+        checkpoint.leave()
+
+    # Clean-up and timestamp database
+    rolled_up = dbutils.rollup_videos(cur)
+    logger.info("Rolled up counts of %d videos", rolled_up)
+    dbutils.rollup_channels(cur)
+    channels = dbutils.get_channel_stats(cur)
+    dbutils.optimize(cur)
+    slow_queries = queryplan.write_report(cur)
+    logger.info("Refreshed planner statistics, %d slow viewer queries", slow_queries)
+    dbutils.add_timestamp(cur)
+    # Commits the rollups and the timestamp together with the end of the run
+    checkpoint.finish()
+    dlq_sizes = dbutils.get_dlq_sizes(cur, conf.DLQ_MAX_ATTEMPTS)
+    for kind in ("comment", "reply"):
+        queued, exhausted = dlq_sizes.get(kind, (0, 0))
+        metrics.set_gauge("dlq_size", queued, kind=kind)
+        metrics.set_gauge("dlq_exhausted", exhausted, kind=kind)
+    metrics.set_gauge("dlq_poisoned", dlq_totals["poisoned"])
+    for channel_id, channel in channels.items():
+        metrics.set_gauge("channel_videos", channel["videoCount"], channel=channel_id)
+        metrics.set_gauge("channel_comments", channel["commentCount"], channel=channel_id)
+        metrics.set_gauge("channel_replies", channel["replyCount"], channel=channel_id)
+    logger.info("Added timestamp")
+
+    publisher.close_reader(reader)
+    # Publishes a "wal" run, the snapshot is exported from the published state
+    publisher.commit(con)
+    export = snapshot.export_run(con) if conf.SNAPSHOT_DIR and publisher.publishes else None
+    publisher.publish(con)
+    logger.info("Database updated successfully")
+
+    # Print run-time information
+    end_time = datetime.now(timezone.utc)
+    duration = end_time - start_time
+    hours, remainder = divmod(duration.seconds, 3600)
+    minutes = remainder // 60
+
+    recovered = dlq_totals["recovered"]
+    per_item = dlq_totals["requests"] / recovered if recovered else 0
+
+    # Log summary
+    summary = f"""**Archive Summary**
 - Finished in: {hours}h {minutes}m
+- Mode: {checkpoint.mode}{" (resumed)" if args.resume else ""}
+- Channels: {len(channels)}
 - New videos: {new_videos}
+- Videos shared with another channel: {shared_videos}
+- Unchanged videos skipped: {skipped_videos}
 - New comments: {new_comments}
 - New replies: {new_replies}
-- Comments DLQ size: {len(os.listdir(conf.COMMENT_ERROR_PATH))}
-- Reply DLQ size: {len(os.listdir(conf.REPLY_ERROR_PATH))}
+- Video counts rolled up: {rolled_up}
+- Slow viewer queries: {slow_queries} (see {conf.PLAN_REPORT_FILE})
+- Comments DLQ size: {dlq_summary(dlq_sizes.get("comment"))}
+- Reply DLQ size: {dlq_summary(dlq_sizes.get("reply"))}
+- DLQ recovery: {recovered} items in {dlq_totals["requests"]} requests \
+({per_item:.2f} per item), {dlq_totals["poisoned"]} poisoned
+- Reply pipeline: {pipeline.summary() if pipeline else "not run"}
+- Reply refresh: {refresh_summary(refresh)}
+- Publish: {publisher.summary()}
+- Snapshot: {snapshot.summary(export)}
+{transport.summary()}
 """
-print(summary)
-shutil.copy(f"{conf.LOG_DIR}/current.txt", conf.LOG_FILE)
+    print(summary)
+    transport.close()
+    metrics.write_report(conf.REPORT_FILE, conf.PROMETHEUS_TEXTFILE)
+    shutil.copy(f"{conf.LOG_DIR}/current.txt", conf.LOG_FILE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Maintenance commands for an existing archive database.
+
+Usage:
+    python maintenance.py rebuild-search
+    python maintenance.py rebuild-user-stats
+    python maintenance.py rollup-videos
+    python maintenance.py migrate-storage
+    python maintenance.py search "some text" --table reply
+    python maintenance.py query-plans --compare
+    python maintenance.py export-snapshot
+    python maintenance.py --db store.db apply-delta delta-11-12.jsonl.gz delta-12-13.jsonl.gz
+    python maintenance.py cache-lookup GetCommentReplies <comment id> --offset 40
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import sqlite3
+import sys
+import time
+
+import config as conf
+from helpers import dbutils
+from helpers import queryplan
+from helpers import replay
+from helpers import snapshot
+
+
+def connect(path, prepare=True, writes=True):
+    """Open an archive database, returns a tuple of (connection, cursor)
+
+    :param path: Path of the SQLite database
+    :param prepare: Create and migrate the tables like a crawl run does
+    :param writes: The command writes to the database, which is switched to
+        WAL mode so the viewer keeps reading in the meantime
+    """
+    con = sqlite3.connect(path)
+    if writes:
+        con.execute("PRAGMA journal_mode = WAL")
+    cur = con.cursor()
+    if prepare:
+        dbutils.prepare_database(cur, conf.VIEWER_INDEXES, conf.SNAPSHOT_DIR is not None)
+        con.commit()
+    return con, cur
+
+
+def rebuild_search(args):
+    """Create the full-text indexes if needed and rebuild them from scratch
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db)
+    start = time.perf_counter()
+    dbutils.rebuild_search(cur, args.table or dbutils.SEARCH_TABLES)
+    con.commit()
+    con.close()
+    print(f"Rebuilt full-text index of {', '.join(args.table or dbutils.SEARCH_TABLES)} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+def rebuild_user_stats(args):
+    """Recompute the user_stats rollup from the comment and reply tables
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db)
+    start = time.perf_counter()
+    dbutils.rebuild_user_stats(cur)
+    con.commit()
+    cur.execute("SELECT COUNT(*) FROM user_stats")
+    users = cur.fetchone()[0]
+    con.close()
+    print(f"Rebuilt user_stats of {users} users in {time.perf_counter() - start:.1f}s")
+
+
+def rollup_videos(args):
+    """Recompute the comment and reply rollups of every video
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db)
+    start = time.perf_counter()
+    cur.execute("INSERT OR IGNORE INTO video_rollup_pending SELECT id FROM video")
+    updated = dbutils.rollup_videos(cur)
+    con.commit()
+    con.close()
+    print(f"Rolled up {updated} videos in {time.perf_counter() - start:.1f}s")
+
+
+def _newest_comment(cur, v1_layout):
+    """Creation time of the newest comment, as a datetime"""
+    if v1_layout:
+        cur.execute("SELECT MAX(createdAt) FROM comment")
+        return datetime.fromisoformat(cur.fetchone()[0])
+    cur.execute(f"SELECT {dbutils.iso_time('MAX(createdAt)')} FROM comment_v2")
+    return datetime.fromisoformat(cur.fetchone()[0])
+
+
+def _measure(cur, v1_layout, start, end):
+    """Used bytes of the database and the best of three timings of a date
+    range query over the comments, returns a tuple of (bytes, seconds, rows)
+
+    :param cur: SQLite cursor obj
+    :param v1_layout: True if comment is still a v1 table with ISO text dates
+    :param start: Start of the date range
+    :param end: End of the date range
+    """
+    pragmas = {}
+    for pragma in ("page_size", "page_count", "freelist_count"):
+        cur.execute(f"PRAGMA {pragma}")
+        pragmas[pragma] = cur.fetchone()[0]
+    used = (pragmas["page_count"] - pragmas["freelist_count"]) * pragmas["page_size"]
+
+    if v1_layout:
+        sql = ("SELECT id FROM comment WHERE createdAt >= ? AND createdAt < ? "
+               "ORDER BY createdAt")
+        params = (start.isoformat(" "), end.isoformat(" "))
+    else:
+        sql = ("SELECT id FROM comment_v2 WHERE createdAt >= ? AND createdAt < ? "
+               "ORDER BY createdAt")
+        params = (dbutils.epoch_ms(start), dbutils.epoch_ms(end))
+    timings = []
+    for _ in range(3):
+        begin = time.perf_counter()
+        cur.execute(sql, params)
+        rows = len(cur.fetchall())
+        timings.append(time.perf_counter() - begin)
+    return used, min(timings), rows
+
+
+def migrate_storage(args):
+    """Move a v1 archive into the v2 layout, VACUUM it and report the size and
+    the speed of a date range query before and after
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db, prepare=False)
+    cur.execute("SELECT type FROM sqlite_master WHERE name = 'comment'")
+    row = cur.fetchone()
+    v1_layout = row is not None and row[0] == "table"
+    end = _newest_comment(cur, v1_layout) + timedelta(seconds=1)
+    start = end - timedelta(days=args.days)
+    before = _measure(cur, v1_layout, start, end)
+
+    begin = time.perf_counter()
+    dbutils.prepare_database(cur)
+    con.commit()
+    migrated = time.perf_counter() - begin
+    cur.execute("VACUUM")
+    after = _measure(cur, False, start, end)
+    con.close()
+
+    print(f"Migrated in {migrated:.1f}s ({'v1 layout' if v1_layout else 'already v2'})")
+    print(f"Date range: {start:%Y-%m-%d} to {end:%Y-%m-%d}, {after[2]} comments")
+    print("| | Before | After |")
+    print("|---|---|---|")
+    print(f"| Database size | {before[0] / 1e6:.1f} MB | {after[0] / 1e6:.1f} MB |")
+    print(f"| Date range query | {before[1] * 1000:.1f} ms | {after[1] * 1000:.1f} ms |")
+
+
+def search(args):
+    """Print the ids matching a term and the time the lookup took
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db, writes=False)
+    start = time.perf_counter()
+    ids = dbutils.search_content(cur, args.table, args.term, args.limit)
+    elapsed = time.perf_counter() - start
+    con.close()
+    print("\n".join(ids))
+    print(f"{len(ids)} {args.table} ids in {elapsed * 1000:.1f} ms")
+
+
+def query_plans(args):
+    """Print the plan report of the viewer queries, and with --compare the
+    timings without the viewer indexes next to it, insert timings included
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db, writes=False)
+    dbutils.optimize(cur)
+    con.commit()
+    results = queryplan.check_queries(cur, args.queries)
+    if not args.compare:
+        con.close()
+        print(queryplan.format_report(results))
+        return
+
+    # Insert and drop the viewer indexes in transactions that are rolled back afterwards
+    cur.execute("BEGIN")
+    inserts = queryplan.time_inserts(cur, args.insert_rows)
+    con.rollback()
+    cur.execute("BEGIN")
+    dbutils.setup_indexes(cur, viewer=False)
+    without = queryplan.check_queries(cur, args.queries)
+    inserts_without = queryplan.time_inserts(cur, args.insert_rows)
+    con.rollback()
+    con.close()
+    print("| Query | With indexes (ms) | Without (ms) | Flags without |")
+    print("|---|---|---|---|")
+    for result, other in zip(results, without):
+        print(f"| {result['name']} | {result['ms']:.1f} | {other['ms']:.1f} "
+              f"| {', '.join(other['flags'])} |")
+    for table, (rows, seconds) in inserts.items():
+        print(f"| Inserting {rows} rows into {table} | {seconds * 1000:.1f} "
+              f"| {inserts_without[table][1] * 1000:.1f} | |")
+
+
+def export_snapshot(args):
+    """Export a snapshot and the delta since the previous one, like the end of
+    a run does, e.g. to seed the snapshot directory of an existing archive
+
+    :param args: Parsed command line arguments
+    """
+    con, _ = connect(args.db)
+    export = snapshot.export_run(con, args.output)
+    con.close()
+    print(snapshot.summary(export))
+
+
+def apply_delta(args):
+    """Bring an older archive up to date with delta files
+
+    :param args: Parsed command line arguments
+    """
+    con, cur = connect(args.db)
+    headers = sorted((snapshot.read_header(path)["target"], path) for path in args.delta)
+    for target, path in headers:
+        cur.execute("SELECT MAX(id) FROM modified")
+        if target <= (cur.fetchone()[0] or 0):
+            print(f"Skipped {path}: already applied")
+            continue
+        start = time.perf_counter()
+        try:
+            rows = snapshot.apply_delta(con, path)
+        except ValueError as error:
+            con.close()
+            sys.exit(str(error))
+        print(f"Applied {path}: {rows} rows in {time.perf_counter() - start:.1f}s")
+    con.close()
+
+
+def cache_lookup(args):
+    """Print the last recorded response of a request from the response store
+
+    :param args: Parsed command line arguments
+    """
+    store = replay.ResponseStore(args.cache)
+    recorded = store.lookup(args.operation, args.id, args.offset, args.limit)
+    store.close()
+    if recorded is None:
+        sys.exit(f"No recorded response for {args.operation} {args.id} at offset {args.offset}")
+    status, content, error = recorded
+    print(f"Failed: {error}" if error is not None else f"HTTP {status}")
+    print(content.decode("UTF-8"))
+
+
+def parse_args():
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description="Maintain the archive database")
+    parser.add_argument("--db", default=conf.MAIN_DB_PATH,
+                        help="database to work on, store.db by default")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser(
+        "rebuild-search", help="rebuild the full-text indexes of comment and reply content")
+    rebuild.add_argument("--table", action="append", choices=dbutils.SEARCH_TABLES,
+                         help="only rebuild the index of this table, may be repeated")
+    rebuild.set_defaults(func=rebuild_search)
+
+    users = commands.add_parser(
+        "rebuild-user-stats", help="recompute the per-user rollup from scratch")
+    users.set_defaults(func=rebuild_user_stats)
+
+    rollup = commands.add_parser(
+        "rollup-videos", help="recompute the comment and reply counts of every video")
+    rollup.set_defaults(func=rollup_videos)
+
+    migrate = commands.add_parser(
+        "migrate-storage", help="move the archive into the v2 layout and report the gain")
+    migrate.add_argument("--days", type=int, default=30,
+                         help="length of the timed date range, ending at the newest comment")
+    migrate.set_defaults(func=migrate_storage)
+
+    lookup = commands.add_parser("search", help="search comment or reply content")
+    lookup.add_argument("term")
+    lookup.add_argument("--table", choices=dbutils.SEARCH_TABLES, default="comment")
+    lookup.add_argument("--limit", type=int, default=100)
+    lookup.set_defaults(func=search)
+
+    plans = commands.add_parser(
+        "query-plans", help="explain and time the viewer queries, flag the slow ones")
+    plans.add_argument("--queries", default=conf.VIEWER_QUERIES_PATH,
+                       help="query list to check, viewer_queries.sql by default")
+    plans.add_argument("--compare", action="store_true",
+                       help="also time every query, and inserts, without the viewer indexes")
+    plans.add_argument("--insert-rows", type=int, default=queryplan.INSERT_ROWS,
+                       help="rows of each table inserted by --compare to time the index upkeep")
+    plans.set_defaults(func=query_plans)
+
+    export = commands.add_parser(
+        "export-snapshot", help="write a snapshot and the delta since the previous one")
+    export.add_argument("--output", default=conf.SNAPSHOT_DIR,
+                        help="snapshot directory, snapshots/ by default")
+    export.set_defaults(func=export_snapshot)
+
+    apply = commands.add_parser(
+        "apply-delta", help="upgrade an older archive with delta files, oldest first")
+    apply.add_argument("delta", nargs="+", help="delta files (delta-<base>-<id>.jsonl.gz)")
+    apply.set_defaults(func=apply_delta)
+
+    cached = commands.add_parser(
+        "cache-lookup", help="print a recorded response of the --record response store")
+    cached.add_argument("operation", help="GraphQL operation name, e.g. GetCommentReplies")
+    cached.add_argument("id", help="channel, video or comment id of the request")
+    cached.add_argument("--offset", type=int, default=0)
+    cached.add_argument("--limit", type=int, help="page size, the largest recorded one by default")
+    cached.add_argument("--cache", default=conf.CACHE_DIR,
+                        help="response store directory, cache/ by default")
+    cached.set_defaults(func=cache_lookup)
+    return parser.parse_args()
+
+
+def main():
+    """Run a maintenance command"""
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
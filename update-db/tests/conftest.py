@@ -0,0 +1,5 @@
+"""Makes the update-db modules importable the way main.py imports them"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
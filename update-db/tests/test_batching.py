@@ -0,0 +1,46 @@
+"""Tests of helpers.batching"""
+import requests
+
+import config as conf
+from helpers.batching import ReplyBatcher
+
+
+class FakeTransport:
+    """Answers every POST with the next of a list of response bodies"""
+
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+        self.posts = 0
+
+    def post(self, body, phase):
+        self.posts += 1
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = self.bodies.pop(0)
+        return resp
+
+
+def test_malformed_responses_switch_batching_off():
+    transport = FakeTransport([b"not json"] * conf.BATCH_MAX_FAILURES)
+    batcher = ReplyBatcher(transport, limit=10)
+    for _ in range(conf.BATCH_MAX_FAILURES - 1):
+        assert batcher.fetch(["c1", "c2"]) == {}
+        assert batcher.supported
+
+    assert batcher.fetch(["c1", "c2"]) == {}
+    assert not batcher.supported
+    # Switched off batchers leave every thread to single requests
+    assert batcher.fetch(["c1", "c2"]) == {}
+    assert transport.posts == conf.BATCH_MAX_FAILURES
+
+
+def test_good_response_resets_the_failure_count():
+    bodies = [b"not json"] * (conf.BATCH_MAX_FAILURES - 1)
+    bodies += [b'{"data": {"r0": [], "r1": null}}']
+    bodies += [b"not json"] * (conf.BATCH_MAX_FAILURES - 1)
+    batcher = ReplyBatcher(FakeTransport(bodies), limit=10)
+    results = [batcher.fetch(["c1", "c2"]) for _ in bodies]
+
+    assert results[conf.BATCH_MAX_FAILURES - 1] == {"c1": []}
+    assert batcher.failures == conf.BATCH_MAX_FAILURES - 1
+    assert batcher.supported
@@ -0,0 +1,99 @@
+"""Tests of helpers.pipeline"""
+import sqlite3
+import threading
+
+import pytest
+import requests
+
+from helpers.pipeline import Pipeline
+
+LIMIT = 2
+# Pages of every item, the last page is short
+PAGES = {"a": [[1, 2], [3]], "b": [[4, 5], [6, 7], []], "c": [[8]]}
+
+
+def fetch(item_id, offset):
+    return PAGES[item_id][offset // LIMIT]
+
+
+def validate(item_id, offset, raw):
+    return raw
+
+
+def run_pipeline(pipeline, jobs):
+    """Run a pipeline on a thread, fails the test instead of hanging on it"""
+    result = {}
+
+    def target():
+        try:
+            pipeline.run(jobs)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "pipeline did not shut down"
+    return result.get("error")
+
+
+def make_pipeline(fetch=fetch, validate=validate, write=None, fail=None):
+    written, failed = [], []
+    pipeline = Pipeline(
+        sqlite3.connect(":memory:", check_same_thread=False), fetch, validate,
+        write or (lambda cur, item_id, offset, items, last: written.append((item_id, offset, items))),
+        fail or (lambda cur, item_id, offset, error: failed.append((item_id, offset, error))),
+        LIMIT, fetch_workers=2, validate_workers=2, queue_size=2, commit_every=2)
+    return pipeline, written, failed
+
+
+def test_pages_every_item_to_its_last_page():
+    pipeline, written, failed = make_pipeline()
+    assert run_pipeline(pipeline, [(item_id, 0) for item_id in PAGES]) is None
+
+    assert sorted(written) == [("a", 0, [1, 2]), ("a", 2, [3]), ("b", 0, [4, 5]),
+                               ("b", 2, [6, 7]), ("b", 4, []), ("c", 0, [8])]
+    assert failed == []
+
+
+def test_writer_error_shuts_the_pipeline_down():
+    def write(cur, item_id, offset, items, last):
+        if item_id == "b":
+            raise sqlite3.OperationalError("disk I/O error")
+
+    pipeline, _, _ = make_pipeline(write=write)
+    error = run_pipeline(pipeline, [(item_id, 0) for item_id in PAGES] * 3)
+
+    assert isinstance(error, sqlite3.OperationalError)
+
+
+def test_validation_error_fails_the_item_only():
+    def failing_validate(item_id, offset, raw):
+        if item_id == "b":
+            raise ValueError("malformed")
+        return raw
+
+    pipeline, written, failed = make_pipeline(validate=failing_validate)
+    assert run_pipeline(pipeline, [(item_id, 0) for item_id in PAGES]) is None
+
+    assert [(item_id, offset) for item_id, offset, _ in failed] == [("b", 0)]
+    assert isinstance(failed[0][2], ValueError)
+    assert sorted(item_id for item_id, _, _ in written) == ["a", "a", "c"]
+
+
+@pytest.mark.parametrize("failures, fails", [(2, False), (3, True)])
+def test_transport_errors_are_retried_three_times(failures, fails):
+    attempts = []
+
+    def flaky_fetch(item_id, offset):
+        attempts.append(item_id)
+        if len(attempts) <= failures:
+            raise requests.ConnectionError("connection reset")
+        return fetch(item_id, offset)
+
+    pipeline, written, failed = make_pipeline(fetch=flaky_fetch)
+    assert run_pipeline(pipeline, [("c", 0)]) is None
+
+    assert len(attempts) == min(failures + 1, 3)
+    assert bool(failed) == fails
+    assert bool(written) != fails
@@ -0,0 +1,70 @@
+"""Tests of helpers.ratecontrol"""
+import time
+
+import pytest
+import requests
+
+import config as conf
+from helpers import ratecontrol
+from helpers.ratecontrol import AimdController, RateControl, TokenBucket
+
+
+def make_controller(initial=4):
+    return AimdController(initial=initial, minimum=2, maximum=8,
+                          increase=1, decrease=0.5, spike_factor=10)
+
+
+def test_window_does_not_shrink_below_the_floor():
+    controller = make_controller()
+    for _ in range(10):
+        controller.release(controller.acquire(), 0.01, ratecontrol.FAILED)
+
+    assert controller.window == 2
+    assert controller.in_flight == 0
+
+
+def test_window_does_not_grow_above_the_ceiling():
+    controller = make_controller()
+    for _ in range(200):
+        controller.release(controller.acquire(), 0.01, ratecontrol.OK)
+
+    assert controller.window == 8
+    assert controller.peak == 8
+
+
+def test_window_shrinks_once_per_round_trip():
+    controller = make_controller(initial=8)
+    sent = [controller.acquire() for _ in range(4)]
+    decreased = [controller.release(at, 0.01, ratecontrol.THROTTLED) for at in sent]
+
+    assert decreased == [True, False, False, False]
+    assert controller.window == 4
+
+
+def response(retry_after):
+    resp = requests.Response()
+    resp.status_code = 429
+    if retry_after is not None:
+        resp.headers["Retry-After"] = retry_after
+    return resp
+
+
+@pytest.mark.parametrize("header, seconds", [
+    ("5", 5.0),
+    (str(conf.MAX_RETRY_AFTER * 10), conf.MAX_RETRY_AFTER),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", None),
+    (None, None),
+])
+def test_retry_after_is_capped(header, seconds):
+    assert ratecontrol.retry_after(response(header)) == seconds
+
+
+def test_retry_after_pauses_the_bucket():
+    control = RateControl(make_controller(), TokenBucket(rate=10, burst=10, minimum=1))
+    before = time.monotonic()
+    control.release(control.acquire(), 0.01, ratecontrol.THROTTLED,
+                    ratecontrol.retry_after(response("3600")))
+
+    assert control.bucket.tokens == 0
+    assert control.bucket.paused_until <= before + conf.MAX_RETRY_AFTER + 1
+    assert control.bucket.paused_until >= before + conf.MAX_RETRY_AFTER
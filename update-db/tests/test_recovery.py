@@ -0,0 +1,51 @@
+"""Tests of helpers.recovery"""
+from helpers.recovery import BisectingRecovery, PoisonedRange
+
+
+def make_fetch(size, poisoned):
+    """fetch(offset, limit) over a list of size items, refusing any range
+    that contains a poisoned offset"""
+    calls = []
+
+    def fetch(offset, limit):
+        calls.append((offset, limit))
+        if any(offset <= bad < offset + limit for bad in poisoned):
+            raise PoisonedRange()
+        return list(range(offset, min(offset + limit, size)))
+
+    return fetch, calls
+
+
+def test_bisects_down_to_a_single_poisoned_item():
+    fetch, _ = make_fetch(20, {5})
+    recovery = BisectingRecovery(fetch, window=16)
+    pages = []
+    recovered = recovery.run(0, lambda offset, items: pages.append(items))
+
+    assert recovery.poisoned == [5]
+    assert recovered == 19
+    # Every good item is kept exactly once
+    assert sorted(item for page in pages for item in page) == [
+        item for item in range(20) if item != 5]
+
+
+def test_poisoned_item_costs_logarithmic_requests():
+    fetch, calls = make_fetch(64, {37})
+    recovery = BisectingRecovery(fetch, window=64)
+    recovery.run(0, lambda offset, items: None)
+
+    assert recovery.poisoned == [37]
+    # One request per level on the way down, plus the good halves next to it
+    assert len(calls) <= 2 * 6 + 2
+    assert recovery.requests == len(calls)
+
+
+def test_gives_up_on_a_window_of_poisoned_items():
+    fetch, _ = make_fetch(100, set(range(8, 16)))
+    recovery = BisectingRecovery(fetch, window=8)
+    windows = []
+    recovered = recovery.run(0, lambda offset, items: None, windows.append)
+
+    assert recovered == 8
+    assert recovery.poisoned == list(range(8, 16))
+    assert windows == [8, 16]
@@ -0,0 +1,89 @@
+-- Queries of the viewer (src/app/api), as Prisma sends them to store.db.
+-- The plan report of update-db (see helpers/queryplan.py) runs EXPLAIN QUERY
+-- PLAN on every query below and flags full table scans and temp B-tree sorts.
+--
+-- Every query starts with a "-- name:" line. Named parameters are filled with
+-- sample values from the database: :videoId (video with the most comments),
+-- :userId (user with the most comments), :commentId (comment with the most
+-- replies), :replyId, :channelId (channel with the most videos), :search (a
+-- word of a recent comment), :limit, :offset.
+-- Keep this list in line with the routes when they change.
+
+-- name: video comments by date (videos/[videoId]/comments)
+SELECT * FROM comment WHERE videoId = :videoId ORDER BY createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: video comments by votes (comments?videoId&orderBy=Likes)
+SELECT * FROM comment WHERE videoId = :videoId ORDER BY posVotes DESC LIMIT :limit OFFSET :offset;
+
+-- name: video comment count (comments/count?videoId)
+SELECT COUNT(*) FROM comment WHERE videoId = :videoId;
+
+-- name: comments by date (comments)
+SELECT * FROM comment ORDER BY createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: comments by votes (comments?orderBy=Likes)
+SELECT * FROM comment ORDER BY posVotes DESC LIMIT :limit OFFSET :offset;
+
+-- name: comments by replies (comments?orderBy=Replies)
+SELECT * FROM comment ORDER BY replyCount DESC LIMIT :limit OFFSET :offset;
+
+-- name: comment count (comments/count)
+SELECT SUM(commentCount) FROM video;
+
+-- name: comment search (comments?search)
+SELECT c.id FROM comment_fts f JOIN comment c ON c.rowid = f.rowid
+WHERE comment_fts MATCH '"' || :search || '"'
+ORDER BY c.createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: user comments by date (comments?userId)
+SELECT * FROM comment WHERE userId = :userId ORDER BY createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: videos of comments (include video)
+SELECT * FROM video WHERE id IN (:videoId);
+
+-- name: username of a user (users/[userId]/username)
+SELECT * FROM comment WHERE userId = :userId LIMIT 1;
+
+-- name: comment by id (comments/[commentId])
+SELECT * FROM comment WHERE id = :commentId LIMIT 1;
+
+-- name: replies of a comment (comments/[commentId]/replies)
+SELECT * FROM reply WHERE replyTo = :commentId;
+
+-- name: reply by id (replies/[replyId])
+SELECT * FROM reply WHERE id = :replyId LIMIT 1;
+
+-- name: reply count (replies/count)
+SELECT SUM(replyCount) FROM video;
+
+-- name: videos by date (videos)
+SELECT * FROM video ORDER BY createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: videos by views (videos?orderBy=Views)
+SELECT * FROM video ORDER BY playCount DESC LIMIT :limit OFFSET :offset;
+
+-- name: videos by comments (videos?orderBy=Comments)
+SELECT * FROM video ORDER BY commentCount DESC LIMIT :limit OFFSET :offset;
+
+-- name: videos by activity (videos?orderBy=Activity)
+SELECT * FROM video ORDER BY lastActivityAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: videos of a channel (videos?channelId&orderBy=Date)
+SELECT * FROM video v WHERE EXISTS (
+    SELECT 1 FROM video_channel vc WHERE vc.videoId = v.id AND vc.channelId = :channelId
+) ORDER BY createdAt DESC LIMIT :limit OFFSET :offset;
+
+-- name: channels (channels)
+SELECT * FROM channel ORDER BY videoCount DESC;
+
+-- name: video by id (videos/[videoId])
+SELECT * FROM video WHERE id = :videoId LIMIT 1;
+
+-- name: users by comments (users)
+SELECT * FROM user_stats ORDER BY commentCount DESC LIMIT :limit OFFSET :offset;
+
+-- name: user comment count (comments/count?userId)
+SELECT * FROM user_stats WHERE userId = :userId LIMIT 1;
+
+-- name: last update (archive/last-updated)
+SELECT * FROM modified ORDER BY id DESC LIMIT 1;